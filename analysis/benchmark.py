@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Benchmark the engines of src/average_degree.py on generated workloads,
+and write the results as csv in the layout of analysis/data.csv, so that
+`make plot` can be used on them. Each workload is written to a file once,
+and each run happens in its own process, streaming the file, so that the
+peak RSS and the cpu times belong to that run alone. The growth of the
+peak RSS during the run is that of the graph, give or take a tweet.
+
+For each run, one row is written for the whole run (kind is the engine),
+and one row for each stage (kind is engine.stage). The stages are:
+
+    parse      json decoding of the line
+    timestamp  conversion of created_at
+    update     adding the edges of the tweet
+    gc         eviction of expired edges
+    average    computing the average degree
+"""
+import argparse
+import bisect
+import csv
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from typing import Any, Dict, Iterator, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import average_degree  # noqa: E402 pylint: disable=wrong-import-position
+
+STAGES = ['parse', 'timestamp', 'update', 'gc', 'average']
+COLUMNS = ['tweets', 'user.time', 'system.time', 'total.time', 'kind',
+           'engine', 'stage', 'tags', 'cardinality', 'zipf', 'window',
+           'throughput', 'p50.us', 'p99.us', 'peak.rss.kb', 'graph.rss.kb']
+# The number of latencies kept per stage to compute percentiles.
+SAMPLES = 100000
+START = 1459207392
+
+
+def workload(tweets: int, tags: int, cardinality: int, zipf: float, seed: int) -> Iterator[str]:
+    """
+    Generate tweets with about `tags` hashtags each, drawn from
+    `cardinality` hashtags, a few seconds apart with some arriving late.
+    As in bin/gen-tweet.py, the k-th most popular hashtag is drawn with a
+    probability proportional to 1/k^zipf, so 0 draws them uniformly.
+    """
+    rand = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1.0 / (k ** zipf) for k in range(1, cardinality + 1)))
+    total = cum_weights[-1]
+    ctime = START
+    for _ in range(tweets):
+        ctime += rand.choice((0, 0, 1, 1, 2))
+        created = ctime - rand.choice((0, 0, 0, 0, 0, 0, 0, 3, 30))
+        count = max(0, int(rand.gauss(tags, 1)))
+        hashtags = [{'text': 'tag%d' % bisect.bisect(cum_weights, rand.random() * total), 'indices': [0, 1]}
+                    for _ in range(count)]
+        yield json.dumps({'created_at': time.strftime(average_degree.TIME_FMT, time.gmtime(created)),
+                          'text': 'benchmark', 'entities': {'hashtags': hashtags}})
+
+
+def write_workload(path: str, tweets: int, tags: int, cardinality: int, zipf: float, seed: int) -> None:
+    """
+    Write a workload to a file, a tweet per line (see workload).
+    """
+    with open(path, 'w') as out:
+        for line in workload(tweets, tags, cardinality, zipf, seed):
+            out.write(line + '\n')
+
+
+def percentile(samples: List[int], fraction: float) -> float:
+    """
+    The given percentile of the sorted samples, in microseconds.
+    """
+    if not samples:
+        return 0.0
+    return round(samples[min(len(samples) - 1, int(fraction * len(samples)))] / 1000.0, 2)
+
+
+def run(engine: str, path: str, tweets: int, window: int) -> Dict[str, Any]:
+    """
+    Run a single benchmark in this process on the workload in the file,
+    timing each stage.
+    """
+    average_degree.parse_created_at.cache_clear()
+    graph = average_degree.ENGINES[engine](0, window)
+    stride = max(1, tweets // SAMPLES)
+    totals = dict.fromkeys(STAGES, 0)
+    samples = {stage: array('q') for stage in STAGES + ['total']}
+    clock = time.perf_counter_ns
+    with open(path) as lines:
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        start = clock()
+        for index, line in enumerate(lines):
+            t0 = clock()
+            tweet = json.loads(line)
+            t1 = clock()
+            tweet['ctime'] = average_degree.parse_created_at(tweet['created_at'])
+            ctime, htags = graph.trim_tweet(tweet)
+            t2 = clock()
+            if graph.in_window(ctime) and ctime > graph.latest:
+                graph.latest = ctime
+                graph.collect_garbage()
+            t3 = clock()
+            # The garbage is already collected, so this only adds the edges.
+            graph.update_hashtags(ctime, htags)
+            t4 = clock()
+            graph.avg_vdegree  # pylint: disable=pointless-statement
+            t5 = clock()
+            spent = {'parse': t1 - t0, 'timestamp': t2 - t1, 'gc': t3 - t2, 'update': t4 - t3, 'average': t5 - t4}
+            for stage in STAGES:
+                totals[stage] += spent[stage]
+            if index % stride == 0:
+                for stage in STAGES:
+                    samples[stage].append(spent[stage])
+                samples['total'].append(t5 - t0)
+        elapsed = clock() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+    return {'elapsed': elapsed, 'totals': totals,
+            # Only the percentiles are sent back, so that the parent does
+            # not grow, since its children inherit its peak RSS.
+            'percentiles': {stage: [percentile(sorted(samples[stage]), fraction) for fraction in (0.5, 0.99)]
+                            for stage in samples},
+            'user': round(after.ru_utime - before.ru_utime, 3),
+            'system': round(after.ru_stime - before.ru_stime, 3), 'maxrss': after.ru_maxrss,
+            'graphrss': after.ru_maxrss - before.ru_maxrss}
+
+
+def rows(result: Dict[str, Any], engine: str, tweets: int, tags: int, cardinality: int, zipf: float,
+         window: int) -> Iterator[Dict[str, Any]]:
+    """
+    The csv rows of a result, for the whole run and for each stage.
+    """
+    common = {'tweets': tweets, 'engine': engine, 'tags': tags, 'cardinality': cardinality, 'zipf': zipf,
+              'window': window, 'peak.rss.kb': result['maxrss'], 'graph.rss.kb': result['graphrss']}
+    percentiles = result['percentiles']
+    yield dict(common, **{'user.time': result['user'], 'system.time': result['system'],
+                          'total.time': round(result['elapsed'] / 1e9, 3), 'kind': engine, 'stage': 'total',
+                          'throughput': round(tweets / (result['elapsed'] / 1e9)),
+                          'p50.us': percentiles['total'][0], 'p99.us': percentiles['total'][1]})
+    for stage in STAGES:
+        spent = result['totals'][stage] / 1e9
+        yield dict(common, **{'user.time': 'NA', 'system.time': 'NA', 'total.time': round(spent, 6),
+                              'kind': '%s.%s' % (engine, stage), 'stage': stage,
+                              'throughput': round(tweets / spent) if spent else 'NA',
+                              'p50.us': percentiles[stage][0], 'p99.us': percentiles[stage][1]})
+
+
+def main():
+    """
+    The entry point. Runs every combination of the given parameters, each
+    in a child process, and writes the csv to stdout.
+    """
+    pcmd = argparse.ArgumentParser()
+    pcmd.add_argument('--engines', nargs='+', default=sorted(average_degree.ENGINES))
+    pcmd.add_argument('--tweets', nargs='+', type=int, default=[1000, 10000, 100000],
+                      help='workload sizes, e.g. 1000 10000 100000 1000000 10000000')
+    pcmd.add_argument('--tags', nargs='+', type=int, default=[3], help='mean hashtags per tweet')
+    pcmd.add_argument('--cardinality', nargs='+', type=int, default=[1000], help='distinct hashtags')
+    pcmd.add_argument('--zipf', nargs='+', type=float, default=[1.1],
+                      help='exponents of hashtag popularity, 0 for uniform (see bin/gen-tweet.py)')
+    pcmd.add_argument('--window', nargs='+', type=int, default=[60])
+    pcmd.add_argument('--seed', type=int, default=1)
+    pcmd.add_argument('--child', metavar='WORKLOAD', help=argparse.SUPPRESS)
+    args = pcmd.parse_args()
+    if args.child:
+        result = run(args.engines[0], args.child, args.tweets[0], args.window[0])
+        json.dump(result, sys.stdout)
+        return
+
+    writer = csv.DictWriter(sys.stdout, COLUMNS)
+    writer.writeheader()
+    with tempfile.TemporaryDirectory() as tmp:
+        for tweets in args.tweets:
+            for tags in args.tags:
+                for cardinality, zipf in itertools.product(args.cardinality, args.zipf):
+                    path = os.path.join(tmp, 'workload-%d-%d-%d-%g.txt' % (tweets, tags, cardinality, zipf))
+                    write_workload(path, tweets, tags, cardinality, zipf, args.seed)
+                    for engine in args.engines:
+                        for window in args.window:
+                            params = ['--engines', engine, '--tweets', str(tweets), '--window', str(window)]
+                            print('running', *params, '--tags', tags, '--cardinality', cardinality, '--zipf', zipf,
+                                  file=sys.stderr)
+                            out = subprocess.run([sys.executable, __file__, '--child', path] + params,
+                                                 check=True, stdout=subprocess.PIPE).stdout
+                            result = json.loads(out.decode('utf-8'))
+                            writer.writerows(rows(result, engine, tweets, tags, cardinality, zipf, window))
+                            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
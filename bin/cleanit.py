@@ -2,34 +2,47 @@
 import sys
 import json
 import time
+import calendar
+import hashlib
+from tweet import TweetWriter
+
+def node_id(tag):
+    # hash() is randomized for each process, so the same tweets would be
+    # cleaned differently by each run. This is a signed 64 bit digest, as
+    # the records store them (see tweet.py).
+    return int.from_bytes(hashlib.blake2b(tag.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
 
 def process(my_hash):
     created_at = my_hash.get('created_at', None)
     if not created_at: return None
-    ctime = int(time.mktime(time.strptime(created_at,"%a %b %d %H:%M:%S +0000 %Y")))
+    # created_at is always in UTC.
+    ctime = calendar.timegm(time.strptime(created_at,"%a %b %d %H:%M:%S +0000 %Y"))
 
-    entities = my_hash.get('entities', None)
-    if not entities: return None
-    
-    htags = entities.get('hashtags', None)
-    if not htags: return None
-    
-    hset = set([hm['text'] for hm in  htags])
-    if len(hset) < 2: return None
+    entities = my_hash.get('entities', None) or {}
+    htags = entities.get('hashtags', None) or []
 
-    nodes = sorted(hash(a)  for a in hset)
+    hset = set([hm['text'] for hm in  htags])
+    nodes = sorted(node_id(a)  for a in hset)
     return {'ctime':ctime, 'nodes':nodes}
 
 binary = False if (len(sys.argv) > 1 and sys.argv[1] == '-a') else True
 
-
+writer = TweetWriter(sys.stdout.buffer)
 for line in sys.stdin:
-    v = process(json.loads(line))
+    try:
+        v = process(json.loads(line))
+    except ValueError:
+        # a malformed line or creation time, as average_degree.py drops
+        continue
     if not v: continue
     if binary:
-        #print('binary')
-        pass
+        # see tweet.py for the record layout. Every valid tweet is kept,
+        # even with fewer than two hashtags, since it still advances the
+        # latest time (see average_degree.py --offline).
+        writer.write(v['ctime'], v['nodes'])
 
-    else:
+    elif len(v['nodes']) >= 2:
         print(v['ctime'], end=',')
         print(','.join(map(str,v['nodes'])))
+if binary:
+    writer.flush()
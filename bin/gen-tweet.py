@@ -1,10 +1,29 @@
 #!/usr/bin/env python3
+"""
+Generate tweets for tests and load tests.
+
+    gen-tweet.py 10 A B C
+
+prints a single tweet created 10 seconds after the template, with the
+hashtags A, B and C (this is what `make gentest` uses), while
+
+    gen-tweet.py --count 1000000 --rate 50 --vocabulary 10000 --seed 7
+
+prints a million tweets, 50 per second of created_at, with hashtags drawn
+from 10000 hashtags with Zipf distributed popularity. The same seed gives
+the same stream.
+"""
+import argparse
+import bisect
+import calendar
+import itertools
 import json
+import random
 import time
 import sys
 TIME_FMT = "%a %b %d %H:%M:%S +0000 %Y"
 
-JSONSTR = '''{
+JSONSTR = r'''{
     "created_at":"Mon Mar 28 23:23:12 +0000 2016",
     "id":714593712530042880,
     "id_str":"714593712530042880",
@@ -98,18 +117,120 @@ JSONSTR = '''{
     "filter_level":"low",
     "lang":"en",
     "timestamp_ms":"1459207392233"}'''
+
+
+# The fields that vary between the tweets of the template.
+FIELDS = ('id', 'id_str', 'created_at', 'timestamp_ms', 'hashtags')
+
+
+class Template:
+    """
+    The template tweet, serialized once with a slot for each of FIELDS,
+    so that a tweet is written by formatting its values into the slots
+    rather than by copying and serializing the whole template.
+    """
+    def __init__(self):
+        j = json.loads(JSONSTR)
+        self.orig_time = calendar.timegm(time.strptime(j['created_at'], TIME_FMT))
+        self.orig_ms = int(j['timestamp_ms'])
+        self.orig_id = j['id']
+        for name in FIELDS[:-1]:
+            j[name] = '@@%s@@' % name
+        j['entities']['hashtags'] = '@@hashtags@@'
+        self.fmt = json.dumps(j).replace('%', '%%')
+        for name in FIELDS:
+            self.fmt = self.fmt.replace('"@@%s@@"' % name, '%%(%s)s' % name)
+
+    def tweet(self, add_id, add_time, myhashtags):
+        """
+        The line of the tweet with the given id and time after those of the
+        template, and the given hashtags.
+        """
+        tweet_id = self.orig_id + add_id
+        return self.fmt % {
+            'id': tweet_id,
+            'id_str': '"%d"' % tweet_id,
+            'created_at': '"%s"' % time.strftime(TIME_FMT, time.gmtime(self.orig_time + add_time)),
+            # keep timestamp_ms consistent with created_at.
+            'timestamp_ms': '"%d"' % (self.orig_ms + add_time * 1000),
+            'hashtags': json.dumps([{'text': i, 'indices': [1, 2]} for i in myhashtags]),
+        }
+
+
+def zipf_weights(vocabulary, exponent):
+    """
+    The cumulative weights of the hashtags, the k-th most popular hashtag
+    being picked with a probability proportional to 1/k^exponent.
+    """
+    return list(itertools.accumulate(1.0 / (k ** exponent) for k in range(1, vocabulary + 1)))
+
+
+def stream(args):
+    """
+    Generate the lines of a bulk run.
+    """
+    rand = random.Random(args.seed)
+    template = Template()
+    cum_weights = zipf_weights(args.vocabulary, args.zipf)
+    total = cum_weights[-1]
+    for i in range(args.count):
+        offset = int(i / args.rate)
+        if args.jitter and rand.random() < args.late:
+            offset -= rand.randint(1, args.jitter)
+        roll = rand.random()
+        if roll < args.limits:
+            yield json.dumps({'limit': {'track': i, 'timestamp_ms': str(template.orig_ms + offset * 1000)}})
+            continue
+        ntags = rand.randint(args.min_tags, args.max_tags)
+        line = template.tweet(i, offset, ['tag%d' % bisect.bisect(cum_weights, rand.random() * total)
+                                          for _ in range(ntags)])
+        if roll < args.limits + args.malformed:
+            # cut the line short, as a broken connection would.
+            line = line[:rand.randrange(1, len(line))]
+        yield line
+
+
+def bulk(args):
+    """
+    Write the tweets of a bulk run to stdout, pacing them to --rate per
+    second of wall clock time if --realtime is given.
+    """
+    start = time.monotonic()
+    for i, line in enumerate(stream(args)):
+        if args.realtime:
+            delay = start + i / args.rate - time.monotonic()
+            if delay > 0:
+                sys.stdout.flush()
+                time.sleep(delay)
+        sys.stdout.write(line + '\n')
+
+
+def single(add_time, myhashtags):
+    print(Template().tweet(0, add_time, myhashtags))
+
+
 def main():
-    j = json.loads(JSONSTR)
-    orig_time = int(time.mktime(time.strptime(j['created_at'], TIME_FMT)))
-    add_time = int(sys.argv[1])
-    j['created_at'] = time.strftime(TIME_FMT, time.localtime(orig_time + add_time))
-    htags = []
-    myhashtags = sys.argv[2:]
-    for i in myhashtags:
-        tag = {'text':i, 'indices':[1,2]}
-        htags.append(tag)
-    j['entities']['hashtags'] = htags
-    print(json.dumps(j))
+    pcmd = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    pcmd.add_argument('time', type=int, nargs='?', default=0,
+                      help='seconds after the template time (single tweet)')
+    pcmd.add_argument('hashtags', nargs='*', help='hashtags of the tweet (single tweet)')
+    pcmd.add_argument('--count', type=int, help='generate this many tweets instead of a single one')
+    pcmd.add_argument('--rate', type=float, default=10.0, help='tweets per second of created_at')
+    pcmd.add_argument('--realtime', action='store_true', help='also write the tweets at --rate per second')
+    pcmd.add_argument('--vocabulary', type=int, default=1000, help='the number of distinct hashtags')
+    pcmd.add_argument('--zipf', type=float, default=1.1, help='the exponent of hashtag popularity')
+    pcmd.add_argument('--min-tags', type=int, default=0, help='the fewest hashtags in a tweet')
+    pcmd.add_argument('--max-tags', type=int, default=5, help='the most hashtags in a tweet')
+    pcmd.add_argument('--jitter', type=int, default=0, help='the most seconds a late tweet is behind')
+    pcmd.add_argument('--late', type=float, default=0.1, help='the fraction of tweets that are late')
+    pcmd.add_argument('--limits', type=float, default=0.0, help='the fraction of limit messages')
+    pcmd.add_argument('--malformed', type=float, default=0.0, help='the fraction of truncated lines')
+    pcmd.add_argument('--seed', type=int, default=0, help='the seed of the random generator')
+    args = pcmd.parse_args()
+    if args.count is None:
+        single(args.time, args.hashtags)
+    else:
+        bulk(args)
 
 if __name__ == "__main__":
     main()
@@ -2,6 +2,7 @@
 import sys
 from heapdict import heapdict
 import itertools
+from tweet import binread, mmapread
 
 #heapq
 
@@ -43,6 +44,8 @@ class Processor:
             del self.edges[min_edge]
 
     def avg(self):
+        # cleanit.py keeps tweets with fewer than two hashtags.
+        if not self.edges: return 0.0
         nodes = set()
         for l_r in self.edges.keys():
             nodes.update(l_r.split(' '))
@@ -63,7 +66,14 @@ binary = False if (len(sys.argv) > 1 and sys.argv[1] == '-a') else True
 
 current = Processor()
 if binary:
-    pass
+    # A pre-cleaned file of records may be given instead of the pipe.
+    if len(sys.argv) > 1:
+        records = mmapread(sys.argv[1])
+    else:
+        records = binread(sys.stdin.buffer)
+    for (created, nodes) in records:
+        current.process(created, nodes)
+        print(current.avg())
 else:
     for (created, nodes) in textread():
         current.process(created, nodes)
@@ -62,6 +62,8 @@ class Processor
   end
 
   def avg()
+    # cleanit.py keeps tweets with fewer than two hashtags.
+    return 0.0 if @edges.empty?
     nodes = Set.new
     @edges.keys.each do |l_r|
       nodes.merge(l_r.split(' '))
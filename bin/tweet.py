@@ -0,0 +1,95 @@
+"""
+The binary record passed from cleanit.py to online-graph.py. The layout is
+the same as the Tweet record in tweet.rb, so either end of the pipe can be
+the ruby or the python implementation:
+
+    uint64be created_at, uint8 len, int64be nodes[len]
+
+Records are written and read in large blocks rather than one at a time.
+"""
+import mmap
+import struct
+
+HEADER = struct.Struct('>QB')
+BLOCK_SIZE = 1 << 20
+NODES = {}
+
+
+def nodes_struct(length):
+    """
+    The struct for the given number of nodes. These are cached since
+    there are only a handful of different lengths.
+    """
+    nodes = NODES.get(length, None)
+    if nodes is None:
+        nodes = NODES[length] = struct.Struct('>%dq' % length)
+    return nodes
+
+
+def to_tweet(ctime, nodes):
+    """
+    Pack a single record.
+    """
+    return HEADER.pack(ctime, len(nodes)) + nodes_struct(len(nodes)).pack(*nodes)
+
+
+class TweetWriter:
+    """
+    Buffer records, and write them out a block at a time.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.buf = bytearray()
+
+    def write(self, ctime, nodes):
+        self.buf += to_tweet(ctime, nodes)
+        if len(self.buf) >= BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.stream.write(self.buf)
+        self.stream.flush()
+        self.buf = bytearray()
+
+
+def unpack_tweets(buf, offset=0):
+    """
+    Unpack the complete records in buf starting at offset. The offset of
+    the first incomplete record is returned when the generator finishes.
+    """
+    end = len(buf)
+    while offset + HEADER.size <= end:
+        ctime, length = HEADER.unpack_from(buf, offset)
+        nodes = nodes_struct(length)
+        if offset + HEADER.size + nodes.size > end:
+            break
+        yield ctime, list(nodes.unpack_from(buf, offset + HEADER.size))
+        offset += HEADER.size + nodes.size
+    return offset
+
+
+def binread(stream):
+    """
+    Read records from a binary stream a block at a time. A record that
+    straddles two blocks is carried over to the next one.
+    """
+    rest = b''
+    while True:
+        block = stream.read(BLOCK_SIZE)
+        if not block:
+            break
+        buf = rest + block
+        offset = yield from unpack_tweets(buf)
+        rest = buf[offset:]
+    if rest:
+        raise ValueError('truncated record at the end of the stream')
+
+
+def mmapread(path):
+    """
+    Read records from a file of pre-cleaned records by memory mapping it.
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        offset = yield from unpack_tweets(buf)
+        if offset != len(buf):
+            raise ValueError('truncated record at the end of %s' % path)
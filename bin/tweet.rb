@@ -1,6 +1,6 @@
 class Tweet < BinData::Record
   uint64be :created_at
-  int8  :len, :value => lambda { nodes.length }
+  uint8 :len, :value => lambda { nodes.length }
   array :nodes, :type => :int64be, :initial_length => :len
 end
 
@@ -1,50 +1,289 @@
 #!/usr/bin/env python
+"""
+Capture the live Twitter stream to files.
 
-# Import the necessary methods from tweepy library
-from tweepy.streaming import StreamListener
-from tweepy import OAuthHandler
-from tweepy import Stream
-from datetime import datetime
-from pprint import pprint
+    python data-gen/get-tweets.py --rotate-hourly --gzip
+
+The tweets are buffered in memory, and written out by a background thread
+whenever a megabyte has accumulated or a second has passed, so that the
+stream callback never waits on the disk. If the disk falls behind, tweets
+are dropped and counted once the buffer holds --max-buffer bytes. Files
+can be rotated by size or by the hour, and compressed as they are written.
+
+    python data-gen/get-tweets.py --replay tweets.txt --output copy.txt
+
+replays the lines of a file as a fake stream instead, which needs neither
+tweepy nor credentials.
+"""
+import argparse
+import gzip
 import json
+import logging
 import os
+import threading
+import time
+
+try:
+    # tweepy is only needed to capture the live stream.
+    from tweepy.streaming import StreamListener
+    from tweepy import OAuthHandler
+    from tweepy import Stream
+except ImportError:
+    StreamListener = object
+    OAuthHandler = Stream = None
 
-# loads Twitter credentials from .twitter file that is in the same directory as this script
-file_dir = os.path.dirname(os.path.realpath(__file__)) 
-with open(file_dir + '/.twitter') as twitter_file:  
-    twitter_cred = json.load(twitter_file)
+file_dir = os.path.dirname(os.path.realpath(__file__))
+
+# The buffered bytes that wake up the writer, and the longest time
+# data waits in the buffer.
+FLUSH_BYTES = 1 << 20
+FLUSH_SECONDS = 1.0
+# The buffered bytes beyond which tweets are dropped rather than buffered.
+MAX_BUFFER = 64 << 20
+# Compressing harder than this costs much more time for little gain.
+GZIP_LEVEL = 6
+logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+LOG = logging.getLogger('get-tweets')
+
+
+def load_credentials(path):
+    """
+    Load the Twitter credentials from a file in the format of .twitter-example.
+    """
+    with open(path) as twitter_file:
+        return json.load(twitter_file)
 
-# authentication from the credentials file above
-access_token = twitter_cred["access_token"]
-access_token_secret = twitter_cred["access_token_secret"]
-consumer_key = twitter_cred["consumer_key"]
-consumer_secret = twitter_cred["consumer_secret"]
 
-class StdOutListener(StreamListener):
-    """ A listener handles tweets that are the received from the stream.
-    This is a basic listener that just prints received tweets to stdout.
+class CaptureWriter:
+    """
+    Buffer the data of the stream, and write it out on a background thread.
+    write() only appends to the buffer, while the thread swaps the buffer
+    out and writes it whenever FLUSH_BYTES have accumulated or every
+    FLUSH_SECONDS. A file is only rotated between two flushes, so a tweet
+    is never split across files. Sizes count the uncompressed bytes.
+    The buffer is bounded: while it is full, write() drops the data and
+    counts it, since holding back the stream callback would get the
+    connection closed by Twitter.
     """
-    def __init__(self, filename):
-        self.filename = filename
+    def __init__(self, path, flush_bytes=FLUSH_BYTES, flush_seconds=FLUSH_SECONDS,
+                 rotate_bytes=0, rotate_hourly=False, compress=False, clock=time.time,
+                 max_buffer=MAX_BUFFER):
+        """
+        :param path: The output file. With rotation, the hour (UTC) and a
+        sequence number are added to its name, e.g. tweets-2016032823-0001.txt
+        :param flush_bytes: The buffered bytes that trigger a write
+        :param flush_seconds: The longest time data stays in the buffer
+        :param rotate_bytes: Start a new file before one grows past this
+        size (0 for no limit)
+        :param rotate_hourly: Start a new file every hour
+        :param compress: Write gzip files, adding .gz to their names
+        :param clock: The time source of the hourly rotation
+        :param max_buffer: The buffered bytes beyond which data is dropped
+        """
+        self.path = path
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_seconds
+        self.rotate_bytes = rotate_bytes
+        self.rotate_hourly = rotate_hourly
+        self.compress = compress
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Held while writing, so that flushes from other threads keep the order.
+        self.flushing = threading.Lock()
+        self.wake = threading.Event()
+        self.buffer = []
+        self.buffered = 0
+        self.max_buffer = max_buffer
+        # The writes dropped since the start, and since the buffer filled up.
+        self.dropped = 0
+        self.dropping = 0
+        self.closed = False
+        self.error = None
+        # The current file, the hour it belongs to, and its size.
+        self.out = None
+        self.out_hour = None
+        self.out_bytes = 0
+        self.sequence = 0
+        self.files = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        """
+        Buffer the data, waking the writer if enough has accumulated, or
+        drop it if the buffer is full.
+        """
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            if self.buffered + len(data) > self.max_buffer:
+                if not self.dropping:
+                    LOG.warning('the writer is behind, dropping tweets')
+                self.dropped += 1
+                self.dropping += 1
+                self.wake.set()
+                return
+            if self.dropping:
+                LOG.warning('dropped %d tweets while the writer was behind', self.dropping)
+                self.dropping = 0
+            self.buffer.append(data)
+            self.buffered += len(data)
+            if self.buffered >= self.flush_bytes:
+                self.wake.set()
+
+    def run(self):
+        """
+        The loop of the writer thread.
+        """
+        try:
+            while not self.closed:
+                self.wake.wait(self.flush_seconds)
+                self.wake.clear()
+                self.flush()
+        except OSError as error:
+            # Reported by the next write, since the stream is the one
+            # that can stop.
+            self.error = error
+
+    def flush(self):
+        """
+        Write out whatever is in the buffer.
+        """
+        with self.flushing:
+            with self.lock:
+                chunk, self.buffer, self.buffered = self.buffer, [], 0
+            if not chunk:
+                return
+            data = ''.join(chunk).encode('utf-8')
+            self.rotate(len(data))
+            self.out.write(data)
+            self.out.flush()
+            self.out_bytes += len(data)
+
+    def file_name(self, hour):
+        """
+        The name of the file of the given hour and the current sequence number.
+        """
+        root, ext = os.path.splitext(self.path)
+        parts = [root]
+        if self.rotate_hourly:
+            parts.append(time.strftime('%Y%m%d%H', time.gmtime(hour * 3600)))
+        if self.rotate_bytes:
+            parts.append('%04d' % self.sequence)
+        return '-'.join(parts) + ext + ('.gz' if self.compress else '')
+
+    def rotate(self, size):
+        """
+        Open the file that the given number of bytes should go to, if it
+        is not the current one.
+        """
+        hour = int(self.clock() // 3600) if self.rotate_hourly else None
+        if self.out is not None:
+            full = self.rotate_bytes and self.out_bytes and self.out_bytes + size > self.rotate_bytes
+            if hour == self.out_hour and not full:
+                return
+            self.out.close()
+            self.sequence = self.sequence + 1 if hour == self.out_hour else 0
+        path = self.file_name(hour)
+        # A file rotated by size is never appended to, e.g. after a restart.
+        while self.rotate_bytes and os.path.exists(path):
+            self.sequence += 1
+            path = self.file_name(hour)
+        self.out = gzip.open(path, 'ab', compresslevel=GZIP_LEVEL) if self.compress else open(path, 'ab')
+        self.out_hour = hour
+        self.out_bytes = 0
+        self.files.append(path)
+
+    def close(self):
+        """
+        Stop the writer thread, and write out the rest of the buffer.
+        """
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        if self.dropped:
+            LOG.warning('dropped %d tweets in all while the writer was behind', self.dropped)
+
+
+class CaptureListener(StreamListener):
+    """
+    A listener handing the tweets received from the stream to a CaptureWriter.
+    """
+    def __init__(self, writer):
+        super().__init__()
+        self.writer = writer
 
     # this is the event handler for new data
     def on_data(self, data):
-        if not os.path.isfile(self.filename):    # check if file doesn't exist
-            f = open(self.filename, 'w')
-            f.close()
-        with open(self.filename, 'a') as f:     
-            f.write(data)
-        f.closed
-        
-    # this is the event handler for errors    
+        self.writer.write(data)
+        return True
+
+    # this is the event handler for errors
     def on_error(self, status):
-        print(status)
+        LOG.error('stream error: %s', status)
 
-if __name__ == '__main__':
-    listener = StdOutListener(file_dir + "/new-tweets.txt")
-    auth = OAuthHandler(consumer_key, consumer_secret)
-    auth.set_access_token(access_token, access_token_secret)
 
-    print("Use CTRL + C to exit at any time.\n")
-    stream = Stream(auth, listener)
-    stream.filter(locations=[-180,-90,180,90]) # this is the entire world, any tweet with geo-location enabled
+def replay_stream(path, listener, rate=0.0):
+    """
+    A fake stream, handing the lines of a file to the listener.
+    :param path: The file of tweets
+    :param listener: The listener
+    :param rate: The lines per second, or as fast as possible if 0
+    """
+    start = time.monotonic()
+    with open(path, encoding='utf-8') as tweets:
+        for count, line in enumerate(tweets):
+            if rate:
+                delay = start + count / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            listener.on_data(line)
+
+
+def main():
+    pcmd = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    pcmd.add_argument('--output', default=os.path.join(file_dir, 'new-tweets.txt'),
+                      help='the file to write the tweets to')
+    pcmd.add_argument('--flush-bytes', type=int, default=FLUSH_BYTES,
+                      help='write out the buffer once it holds this many bytes')
+    pcmd.add_argument('--flush-seconds', type=float, default=FLUSH_SECONDS,
+                      help='write out the buffer at least this often')
+    pcmd.add_argument('--max-buffer', type=int, default=MAX_BUFFER,
+                      help='drop tweets while the buffer holds this many bytes')
+    pcmd.add_argument('--rotate-bytes', type=int, default=0,
+                      help='start a new file before one grows past this many bytes')
+    pcmd.add_argument('--rotate-hourly', action='store_true', help='start a new file every hour')
+    pcmd.add_argument('--gzip', action='store_true', help='compress the files as they are written')
+    pcmd.add_argument('--replay', metavar='PATH', help='replay the lines of PATH instead of the live stream')
+    pcmd.add_argument('--rate', type=float, default=0.0, help='the lines per second of --replay')
+    args = pcmd.parse_args()
+    if args.replay is None and Stream is None:
+        pcmd.error('capturing the live stream needs tweepy')
+
+    writer = CaptureWriter(args.output, args.flush_bytes, args.flush_seconds,
+                           args.rotate_bytes, args.rotate_hourly, args.gzip, max_buffer=args.max_buffer)
+    listener = CaptureListener(writer)
+    try:
+        if args.replay is not None:
+            replay_stream(args.replay, listener, args.rate)
+            return
+        # loads Twitter credentials from .twitter file that is in the same directory as this script
+        twitter_cred = load_credentials(os.path.join(file_dir, '.twitter'))
+        auth = OAuthHandler(twitter_cred["consumer_key"], twitter_cred["consumer_secret"])
+        auth.set_access_token(twitter_cred["access_token"], twitter_cred["access_token_secret"])
+
+        print("Use CTRL + C to exit at any time.\n")
+        stream = Stream(auth, listener)
+        stream.filter(locations=[-180, -90, 180, 90])  # this is the entire world, any tweet with geo-location enabled
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+
+
+if __name__ == '__main__':
+    main()
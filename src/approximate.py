@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+This module estimates the rolling average vertex degree in bounded memory,
+for windows too large to hold every edge.
+"""
+import hashlib
+import heapq
+import itertools
+import math
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+# The default number of index bits of the sketches, i.e. 4096 registers.
+PRECISION = 12
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+
+def mix(value: int) -> int:
+    """
+    Spread the bits of an integer over 64 bits (the splitmix64 finalizer),
+    since the sketches need every bit of the hash to be random.
+    """
+    value &= HASH_MASK
+    value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & HASH_MASK
+    value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & HASH_MASK
+    return value ^ (value >> 31)
+
+
+def tag_hash(tag: str) -> int:
+    """
+    A 64 bit hash of a hashtag. We do not use hash() since it is randomized
+    for each process, which would make the estimates vary between runs.
+    """
+    return int.from_bytes(hashlib.blake2b(tag.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class SlidingHyperLogLog:
+    """
+    A HyperLogLog sketch counting the distinct items seen after the last
+    cutoff passed to expire. Instead of the largest rank seen, each register keeps
+    the ranks that may still become its largest one as time passes: the
+    (time, rank) pairs not dominated by a pair both later and of higher or
+    equal rank. Along a register, the times increase and the ranks strictly
+    decrease, so it holds at most 64 - precision + 1 pairs, and its value
+    is the rank of its oldest live pair. The registers holding pairs are
+    kept in a heap by the time they are due to expire, at most that of
+    their oldest pair, and the heap never holds more than two entries per
+    register, so the memory of the sketch does not depend on the window.
+    """
+    def __init__(self, precision: int = PRECISION) -> None:
+        """
+        Initialize the SlidingHyperLogLog
+        :param precision: The number of index bits, 4 to 16
+        """
+        if not 4 <= precision <= 16:
+            raise ValueError('precision must be between 4 and 16: %d' % precision)
+        self.precision = precision
+        self.registers = 1 << precision
+        self.times = [array('q') for _ in range(self.registers)]  # type: List[array]
+        self.ranks = [array('B') for _ in range(self.registers)]  # type: List[array]
+        # A heap of (due time, register) entries, and the due time of each
+        # register holding pairs (-1 for the others).
+        self.heap = []  # type: List[Tuple[int, int]]
+        self.due = array('q', [-1]) * self.registers
+        # The value of each register, and the sum of 2^-value over the
+        # registers scaled by 2^HASH_BITS, so that it stays exact.
+        self.value = array('B', bytes(self.registers))
+        self.scaled_sum = self.registers << HASH_BITS
+        self.zeros = self.registers
+        self.alpha = 0.7213 / (1 + 1.079 / self.registers)
+
+    def set_value(self, register: int, rank: int) -> None:
+        """
+        Change the value of a register, keeping the sums up to date.
+        """
+        old = self.value[register]
+        if old == rank:
+            return
+        self.scaled_sum += (1 << (HASH_BITS - rank)) - (1 << (HASH_BITS - old))
+        self.zeros += (not rank) - (not old)
+        self.value[register] = rank
+
+    def add(self, ctime: int, hashed: int) -> None:
+        """
+        Count an item seen at the given time.
+        :param ctime: The time the item was seen, after the last cutoff
+        :param hashed: A 64 bit hash of the item (see mix)
+        """
+        register = hashed & (self.registers - 1)
+        rank = HASH_BITS - self.precision - (hashed >> self.precision).bit_length() + 1
+        times, ranks = self.times[register], self.ranks[register]
+        index = bisect_left(times, ctime)
+        if index < len(times) and ranks[index] >= rank:
+            return
+        if index < len(times) and times[index] == ctime:
+            del times[index]
+            del ranks[index]
+        start = index
+        while start and ranks[start - 1] <= rank:
+            start -= 1
+        del times[start:index]
+        del ranks[start:index]
+        times.insert(start, ctime)
+        ranks.insert(start, rank)
+        if not start:
+            self.set_value(register, rank)
+            due = self.due[register]
+            if due < 0 or due > ctime:
+                self.schedule(register, ctime)
+
+    def schedule(self, register: int, ctime: int) -> None:
+        """
+        Make sure that a register is expired no later than the given time,
+        by pushing a new entry. The entries left behind by an earlier due
+        time only cost a visit, and are dropped when the heap grows to
+        twice the registers.
+        """
+        self.due[register] = ctime
+        heapq.heappush(self.heap, (ctime, register))
+        if len(self.heap) > 2 * self.registers:
+            self.heap = [(due, register) for register, due in enumerate(self.due) if due >= 0]
+            heapq.heapify(self.heap)
+
+    def expire(self, cutoff: int) -> None:
+        """
+        Drop the pairs of every second up to the cutoff.
+        :param cutoff: The latest expired second
+        """
+        heap, due = self.heap, self.due
+        while heap and heap[0][0] <= cutoff:
+            register = heap[0][1]
+            times, ranks = self.times[register], self.ranks[register]
+            index = bisect_left(times, cutoff + 1)
+            if index:
+                del times[:index]
+                del ranks[:index]
+                self.set_value(register, ranks[0] if ranks else 0)
+            if times:
+                due[register] = times[0]
+                heapq.heapreplace(heap, (times[0], register))
+            else:
+                due[register] = -1
+                heapq.heappop(heap)
+
+    def count(self) -> float:
+        """
+        Estimate the number of distinct live items. Small counts use
+        linear counting on the empty registers, as HyperLogLog does.
+        """
+        estimate = self.alpha * self.registers * self.registers * (1 << HASH_BITS) / self.scaled_sum
+        if self.zeros and estimate <= 2.5 * self.registers:
+            return self.registers * math.log(self.registers / self.zeros)
+        return estimate
+
+
+class ApproximateTweetGraph:
+    """
+    Estimate the rolling average vertex degree with two SlidingHyperLogLog
+    sketches, one counting the distinct live edges and one the distinct
+    live hashtags. Memory is fixed by the precision p: each sketch holds at
+    most 2^p * (65 - p) pairs and a heap of 2^(p+1) entries, whatever the
+    window and the rate of tweets.
+    Each count has a relative standard error of about 1.04 / sqrt(2^p),
+    and the average of about 1.5 / sqrt(2^p), i.e. 2.3% for the default
+    precision of 12. Small counts are estimated much more closely.
+    """
+    def __init__(self, curtime: int, window: int, precision: int = PRECISION) -> None:
+        """
+        Initialize the ApproximateTweetGraph
+        :param curtime: The starting time
+        :param window: The sliding window
+        :param precision: The number of index bits of the sketches
+        """
+        self.latest = curtime
+        self.window = window
+        self.edges = SlidingHyperLogLog(precision)
+        self.nodes = SlidingHyperLogLog(precision)
+
+    def in_window(self, ctime: int) -> bool:
+        """
+        Is the passed in time within the window?
+        """
+        return False if (self.latest - ctime) >= self.window else True
+
+    def update_hashtags(self, ctime: int, hashtags: List[str]) -> None:
+        """
+        Process the given set of hashtags for the given time.
+        :param ctime: The creation time of the tweet
+        :param hashtags: The unique hashtags associated with this tweet.
+        """
+        if not self.in_window(ctime):
+            return
+        if ctime > self.latest:
+            self.latest = ctime
+        self.collect_garbage()
+        # As with TweetGraph, a hashtag is a node only if it has an edge.
+        if len(hashtags) < 2:
+            return
+        hashes = sorted(tag_hash(tag) for tag in hashtags)
+        for hashed in hashes:
+            self.nodes.add(ctime, hashed)
+        # The hash of an edge combines those of its hashtags in order.
+        for left, right in itertools.combinations(hashes, 2):
+            self.edges.add(ctime, mix(left * 0x9e3779b97f4a7c15 + right))
+
+    def collect_garbage(self) -> None:
+        """
+        Expire everything that fell out of the window.
+        """
+        cutoff = self.latest - self.window
+        self.edges.expire(cutoff)
+        self.nodes.expire(cutoff)
+
+    @property
+    def node_count(self) -> float:
+        """
+        The estimated number of live hashtags.
+        """
+        return self.nodes.count()
+
+    @property
+    def avg_vdegree(self) -> float:
+        """
+        The estimated average vertex degree.
+        """
+        edges = self.edges.count()
+        if edges < 0.5:
+            return 0
+        return (2.0 * edges) / max(self.nodes.count(), 2.0)
+
+    def counters(self) -> Dict[str, float]:
+        """
+        The metrics kept by the graph (see average_degree.METRICS).
+        """
+        return {'edges': self.edges.count(), 'nodes': self.node_count,
+                'latest': self.latest, 'average': self.avg_vdegree}
+
+    def averages(self, records: Iterable[Tuple[int, List[str]]]) -> Iterator[float]:
+        """
+        Process a stream of records, yielding the estimated average vertex
+        degree after each one.
+        :param records: (ctime, hashtags) records, as given by trim_tweet
+        :return: An iterator over the average vertex degrees
+        """
+        for ctime, htags in records:
+            self.update_hashtags(ctime, htags)
+            yield self.avg_vdegree
+
+    def process_batch(self, records: Iterable[Tuple[int, List[str]]]) -> List[float]:
+        """
+        Process a batch of records, and return the estimated average vertex
+        degree after each one.
+        """
+        return list(self.averages(records))
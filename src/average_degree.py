@@ -3,26 +3,249 @@
 This module computes the rolling average vertex degree of a twitter
 tweet hashtag graph.
 """
+import bz2
+import calendar
+import codecs
+import collections
+import datetime
+import functools
+import glob
+import gzip
+import heapq
 import itertools
 import json
+import re
 import sys
 import time
 import argparse
 import logging
-from typing import Dict, Tuple, List, Any, Optional, cast, Iterable
+import lzma
+import multiprocessing
+import os
+import pickle
+import queue
+import signal
+import threading
+from array import array
+from typing import Dict, FrozenSet, Tuple, List, Set, Any, Optional, cast, Callable, Iterable, Iterator
 
-from heapdict import heapdict
 
 TIME_FMT = "%a %b %d %H:%M:%S +0000 %Y"
+# The number of distinct created_at strings remembered by parse_created_at.
+# Consecutive tweets mostly share the same second, so this need not be large.
+TIME_CACHE_SIZE = 1024
+WEEKDAYS = frozenset(('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'))
+MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+          'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+# The number of lines handed to a parse worker at a time.
+CHUNK_SIZE = 1000
+# The number of averages written to the output at a time.
+OUTPUT_BLOCK = 1000
+# The number of bytes read from an input file at a time.
+READ_BLOCK = 1 << 20
+# The number of blocks decompressed ahead by the background reader.
+PREFETCH_BLOCKS = 8
+# Input files are opened according to their extension.
+OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open, '.lzma': lzma.open}  # type: Dict[str, Callable[..., Any]]
+# The suffixes of sizes given on the command line.
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+# Bumped whenever the layout of TweetGraph.snapshot() changes.
+SNAPSHOT_VERSION = 1
+# The metrics reported by Metrics.sample, with their prometheus type and help.
+METRICS = [
+    ('lines', 'counter', 'Lines read'),
+    ('invalid', 'counter', 'Lines that were not valid tweets'),
+    ('parse_seconds', 'counter', 'Time spent decoding lines'),
+    ('timestamp_seconds', 'counter', 'Time spent converting creation times'),
+    ('queue_depth', 'gauge', 'Lines parsed or being parsed, but not yet applied'),
+    ('edges_added', 'counter', 'Edges added to the graph'),
+    ('edges_refreshed', 'counter', 'Edges seen again with a later time'),
+    ('edges_evicted', 'counter', 'Edges evicted from the graph'),
+    ('gc_runs', 'counter', 'Garbage collections'),
+    ('gc_seconds', 'counter', 'Time spent in garbage collection'),
+    ('gc_pause_max_seconds', 'gauge', 'The longest garbage collection since the last sample'),
+    ('memory_bytes', 'gauge', 'Approximate bytes held by the graph'),
+    ('memory_sheds', 'counter', 'Times the graph went over its memory budget'),
+    ('edges_shed', 'counter', 'Live edges evicted early to stay within the memory budget'),
+    ('edges', 'gauge', 'Live edges'),
+    ('nodes', 'gauge', 'Live hashtags'),
+    ('latest', 'gauge', 'The latest creation time seen'),
+    ('average', 'gauge', 'The average vertex degree'),
+]
+# The options of main() that each option or mode cannot be combined with,
+# with the error. They are checked in order, so that a mode taking over the
+# run reports its own error. An option is given when it differs from its
+# default. 'windows' stands for several windows, 'stats' for --stats or
+# --metrics, and 'cleaned' for --offline reading cleaned records.
+CONFLICTS = [
+    ('max_memory', ('replay', 'shards', 'approximate', 'offline', 'query'),
+     '--max-memory needs a single graph of edges'),
+    ('lookup', ('replay', 'shards', 'approximate', 'offline'), '--lookup needs the edges of the graph'),
+    ('query', ('window', 'snapshot', 'restore', 'sample', 'replay', 'shards', 'approximate', 'offline', 'lookup',
+               'stats'), '--query takes the window of each query, and only supports the plain output'),
+    ('offline', ('snapshot', 'restore', 'sample', 'replay', 'shards', 'approximate', 'stats'),
+     '--offline only supports the plain output'),
+    ('replay', ('windows', 'snapshot', 'restore', 'sample', 'input', 'shards', 'approximate', 'stats'),
+     '--replay only supports a single window and the plain output'),
+    ('shards', ('windows', 'snapshot', 'restore', 'sample'),
+     'shards support neither several windows, snapshots, nor sampled output'),
+    ('approximate', ('windows', 'snapshot', 'restore'),
+     'the approximation supports neither several windows nor snapshots'),
+    ('windows', ('snapshot', 'restore'), 'snapshots are not supported with several windows'),
+    ('cleaned', ('input', 'workers', 'timestamp_ms', 'extract'),
+     '--offline CLEANED reads the times and hashtags from the records rather than tweets'),
+    ('engine', ('windows', 'offline', 'shards', 'approximate'), '--engine only selects a graph of a single window'),
+]  # type: List[Tuple[str, Tuple[str, ...], str]]
+
+# Used by extract_tweet to pick the fields out of a raw line. The streaming
+# API writes created_at as the first field of a tweet and timestamp_ms as
+# the last, so a line ending in timestamp_ms has not been truncated.
+CREATED_AT_RE = re.compile(r'\s*\{\s*"created_at"\s*:\s*"([^"\\]*)"')
+HASHTAGS_RE = re.compile(r'"hashtags"\s*:\s*\[')
+TWEET_END_RE = re.compile(r'"timestamp_ms"\s*:\s*"(\d+)"\s*\}\s*$')
+TWEET_END_SPAN = 64
+KEY_RE = re.compile(r'"[^"\\]*"\s*:\s*')
+NESTED_TWEETS = ('"retweeted_status"', '"quoted_status"')
+DECODER = json.JSONDecoder()
 logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s', stream=sys.stderr)
 LOG = logging.getLogger(__name__)
 
+# An edge is stored as a single integer key packing the ids of its two
+# hashtags, the smaller id in the high bits.
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+
+# The approximate bytes of the objects held by each entry of the
+# structures of a graph, beside the tables of the containers themselves
+# (see TweetGraph.memory). An edge key is an int of its own, and so is the
+# time of each tweet; counting one time per edge errs high, since the
+# edges of a tweet share it. An entry of the heap is a tuple, sharing its
+# key with the edges unless the edge was refreshed since. A hashtag has its id, and its string, taken to be of a typical
+# length.
+INT_BYTES = sys.getsizeof(1 << 40)
+TAG_BYTES = INT_BYTES + sys.getsizeof('#' * 12)
+EDGE_BYTES = 2 * INT_BYTES
+HEAP_ENTRY_BYTES = sys.getsizeof((0, 0))
+# The heap is rebuilt without the entries left behind by refreshed edges
+# once it holds more than this many entries per live edge, plus the slack.
+QUEUE_STALE_FACTOR = 2
+QUEUE_SLACK = 1024
+# With a memory budget, it is checked each time this many edges were
+# added or refreshed, and the oldest edges are shed down to this part of it.
+MEMORY_CHECK_EDGES = 10000
+SHED_TARGET = 0.9
+
+
+class DegreeIndex:
+    """
+    The ids of the live hashtags bucketed by their degree. A degree only
+    changes by one at a time, so moving an id to the neighboring bucket,
+    and keeping track of the highest degree, are both O(1). An id is added
+    to its new bucket before it leaves the old one, so that the highest
+    degree moves by at most one step.
+    """
+    def __init__(self, degree: array) -> None:
+        """
+        Initialize the DegreeIndex
+        :param degree: The degree of each hashtag id, 0 for free ids
+        """
+        self.buckets: Dict[int, Set[int]] = {}
+        self.max_degree = 0
+        for tag_id, count in enumerate(degree):
+            if count:
+                self.add(tag_id, count)
+
+    def add(self, tag_id: int, count: int) -> None:
+        """
+        Put the id in the bucket of the given degree.
+        """
+        bucket = self.buckets.get(count, None)
+        if bucket is None:
+            bucket = self.buckets[count] = set()
+        bucket.add(tag_id)
+        if count > self.max_degree:
+            self.max_degree = count
+
+    def discard(self, tag_id: int, count: int) -> None:
+        """
+        Take the id out of the bucket of the given degree.
+        """
+        bucket = self.buckets[count]
+        bucket.discard(tag_id)
+        if not bucket:
+            del self.buckets[count]
+            while self.max_degree and self.max_degree not in self.buckets:
+                self.max_degree -= 1
+
+    def increment(self, tag_id: int, count: int) -> None:
+        """
+        Move the id up to its new degree.
+        """
+        self.add(tag_id, count)
+        if count > 1:
+            self.discard(tag_id, count - 1)
+
+    def decrement(self, tag_id: int, count: int) -> None:
+        """
+        Move the id down to its new degree, dropping it at zero.
+        """
+        if count:
+            self.add(tag_id, count)
+        self.discard(tag_id, count + 1)
+
+
+class EdgeHeap:
+    """
+    The eviction queue of TweetGraph: a binary heap of (time, key) entries
+    kept by heapq. An entry is never updated in place. A refreshed edge is
+    pushed again, and the entry left behind no longer matches the time of
+    the edge, so it is skipped when it is popped (as the wheel does with
+    its buckets). The graph rebuilds the heap once too many entries are
+    stale (see QUEUE_STALE_FACTOR).
+    """
+    def __init__(self, entries: Iterable[Tuple[int, int]] = ()) -> None:
+        """
+        Initialize the EdgeHeap
+        :param entries: (time, key) entries. Sorted, they already form a heap.
+        """
+        self.entries = sorted(entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __sizeof__(self) -> int:
+        return object.__sizeof__(self) + sys.getsizeof(self.entries) + len(self.entries) * HEAP_ENTRY_BYTES
+
+    def push(self, ctime: int, key: int) -> None:
+        """
+        Add an entry.
+        """
+        heapq.heappush(self.entries, (ctime, key))
+
+    def oldest(self) -> int:
+        """
+        The earliest time in the heap, which must not be empty.
+        """
+        return self.entries[0][0]
+
+    def pop(self) -> Tuple[int, int]:
+        """
+        Remove and return the entry with the earliest time.
+        """
+        return heapq.heappop(self.entries)
+
 
 class TweetGraph:
     """
     Process the tweet, and keeps track of the time. This implementation uses
-    a priority queue (heap) containing a tuple (edge,created time) as the
+    a priority queue (heap) of (created time, edge) entries as the
     backbone.
+
+    Hashtags are interned to dense integer ids, which are released (and
+    later reused) once the hashtag is no longer part of any edge. An edge
+    is keyed by the two ids packed into one integer, so that we do not
+    hold a tuple and two references to strings per edge.
     """
     def __init__(self, curtime: int, window: int) -> None:
         """
@@ -31,9 +254,38 @@ class TweetGraph:
         :param window: The sliding window
         """
         self.latest = curtime
-        self.edges = {}  # type: Dict[Tuple[str, str], int]
-        self.queue = heapdict()
+        self.edges = {}  # type: Dict[int, int]
+        # The intern table. tags[i] is the hashtag with id i, or None if
+        # the id is free. A hashtag is a live node exactly when it has an
+        # id, which lets us compute the average degree without looking at
+        # the edges.
+        self.tag_ids = {}  # type: Dict[str, int]
+        self.tags = []  # type: List[Optional[str]]
+        self.free_ids = []  # type: List[int]
+        # The number of live edges incident on each hashtag id.
+        self.degree = array('L')
+        self.queue = EdgeHeap()
         self.window = window
+        # Built on the first top_hashtags query, and kept up to date after.
+        self.degree_index = None  # type: Optional[DegreeIndex]
+        # The live neighbors of each hashtag id with the time of their
+        # edge. Built on the first neighbors query, and kept up to date after.
+        self.adjacency = None  # type: Optional[Dict[int, Dict[int, int]]]
+        # Counters for the metrics. The evicted edges are the added ones
+        # that are no longer live, so they need not be counted.
+        self.added = 0
+        self.refreshed = 0
+        self.gc_runs = 0
+        self.gc_ns = 0
+        self.gc_max_ns = 0
+        # The gc is only timed once a metrics sink is attached (see
+        # StatsReporter), sparing two clock reads per tweet otherwise.
+        self.timed = False
+        # The memory budget in bytes (0 for none), and its counters.
+        self.max_memory = 0
+        self.next_check = 0
+        self.sheds = 0
+        self.shed = 0
 
     def in_window(self, ctime: int) -> bool:
         """
@@ -44,6 +296,68 @@ class TweetGraph:
         """
         return False if (self.latest - ctime) >= self.window else True
 
+    def intern(self, tag: str) -> int:
+        """
+        Get the id of the given hashtag, allocating one if necessary.
+        :param tag: The hashtag
+        :return: The id of the hashtag
+        """
+        tag_id = self.tag_ids.get(tag, None)
+        if tag_id is None:
+            if self.free_ids:
+                tag_id = self.free_ids.pop()
+                self.tags[tag_id] = tag
+            else:
+                tag_id = len(self.tags)
+                self.tags.append(tag)
+                self.degree.append(0)
+            self.tag_ids[tag] = tag_id
+        return tag_id
+
+    def release(self, tag_id: int) -> None:
+        """
+        Free the id of a hashtag that is no longer part of any edge.
+        :param tag_id: The id of the hashtag
+        """
+        del self.tag_ids[cast(str, self.tags[tag_id])]
+        self.tags[tag_id] = None
+        self.free_ids.append(tag_id)
+
+    def edge_key(self, left: str, right: str) -> int:
+        """
+        Get the packed key for the edge between two hash tags.
+        :param left: A hashtag
+        :param right: Another hashtag
+        :return: The packed key of the edge
+        """
+        left_id, right_id = self.intern(left), self.intern(right)
+        if left_id > right_id:
+            left_id, right_id = right_id, left_id
+        return (left_id << ID_BITS) | right_id
+
+    def edge_tags(self, key: int) -> Tuple[str, str]:
+        """
+        Get the hashtags of the edge with the given packed key.
+        :param key: The packed key of the edge
+        :return: A tuple containing the two hashtags in sorted order
+        """
+        left, right = self.tags[key >> ID_BITS], self.tags[key & ID_MASK]
+        return cast(Tuple[str, str], tuple(sorted((left, right))))
+
+    def edge_times(self) -> Dict[Tuple[str, str], int]:
+        """
+        The live edges with their last seen time, keyed by hashtags.
+        This is meant for inspection, and is O(edges).
+        """
+        return {self.edge_tags(key): ctime for key, ctime in self.edges.items()}
+
+    def degrees(self) -> Dict[str, int]:
+        """
+        The degree of each live hashtag.
+        This is meant for inspection, and is O(nodes).
+        """
+        return {tag: self.degree[tag_id] for tag, tag_id in self.tag_ids.items()}
+
     def add_edge(self, ctime: int, edge: Tuple[str, str]) -> None:
         """
         Add or update the given edge with the given time to
@@ -51,10 +365,69 @@ class TweetGraph:
         :param ctime: The creation time of the tweet
         :param edge: A tuple containing two hash tags
         """
-        old_ctime = self.edges.get(edge, None)
-        if (not old_ctime) or (ctime > old_ctime):
-            self.queue[edge] = ctime
-            self.edges[edge] = ctime
+        self.add_key(ctime, self.edge_key(*edge))
+
+    def add_key(self, ctime: int, key: int) -> None:
+        """
+        Add or update the edge with the given packed key.
+        :param ctime: The creation time of the tweet
+        :param key: The packed key of the edge
+        """
+        old_ctime = self.edges.get(key, None)
+        if old_ctime is None:
+            self.degree[key >> ID_BITS] += 1
+            self.degree[key & ID_MASK] += 1
+            self.added += 1
+            if self.degree_index is not None:
+                self.degree_index.increment(key >> ID_BITS, self.degree[key >> ID_BITS])
+                self.degree_index.increment(key & ID_MASK, self.degree[key & ID_MASK])
+        elif ctime <= old_ctime:
+            return
+        else:
+            self.refreshed += 1
+        if self.adjacency is not None:
+            self.link(ctime, key)
+        self.queue.push(ctime, key)
+        self.edges[key] = ctime
+        if old_ctime is not None and len(self.queue) > QUEUE_STALE_FACTOR * len(self.edges) + QUEUE_SLACK:
+            self.rebuild_queue()
+
+    def link(self, ctime: int, key: int) -> None:
+        """
+        Record the edge with the given packed key in the adjacency index.
+        """
+        adjacency = cast(Dict[int, Dict[int, int]], self.adjacency)
+        left, right = key >> ID_BITS, key & ID_MASK
+        adjacency.setdefault(left, {})[right] = ctime
+        adjacency.setdefault(right, {})[left] = ctime
+
+    def unlink(self, key: int) -> None:
+        """
+        Drop the edge with the given packed key from the adjacency index.
+        """
+        adjacency = cast(Dict[int, Dict[int, int]], self.adjacency)
+        left, right = key >> ID_BITS, key & ID_MASK
+        for tag_id, other in ((left, right), (right, left)):
+            neighbors = adjacency[tag_id]
+            del neighbors[other]
+            if not neighbors:
+                del adjacency[tag_id]
+
+    def remove_key(self, key: int) -> None:
+        """
+        Remove the edge with the given packed key from our database
+        of edges, and release any hashtag that is no longer part of an edge.
+        :param key: The packed key of the edge
+        """
+        del self.edges[key]
+        if self.adjacency is not None:
+            self.unlink(key)
+        for tag_id in (key >> ID_BITS, key & ID_MASK):
+            self.degree[tag_id] -= 1
+            if self.degree_index is not None:
+                self.degree_index.decrement(tag_id, self.degree[tag_id])
+            if not self.degree[tag_id]:
+                self.release(tag_id)
 
     def update_hashtags(self, ctime: int, hashtags: List[str]) -> None:
         """
@@ -69,13 +442,110 @@ class TweetGraph:
 
         # Ensure that we perform gc _before_ checking if the
         # prerequisite number of hashtags are present.
-        self.collect_garbage()
+        self.gc_runs += 1
+        if self.timed:
+            start = time.perf_counter_ns()
+            self.collect_garbage()
+            pause = time.perf_counter_ns() - start
+            self.gc_ns += pause
+            if pause > self.gc_max_ns:
+                self.gc_max_ns = pause
+        else:
+            self.collect_garbage()
+
+        # We only intern hashtags that will be part of an edge, since an
+        # id is released only when the degree of its hashtag drops to zero.
+        if len(hashtags) < 2:
+            return
+        ids = sorted(self.intern(tag) for tag in hashtags)
+        for left, right in cast(Iterable, itertools.combinations(ids, 2)):
+            self.add_key(ctime, (left << ID_BITS) | right)
+        if self.max_memory and self.added + self.refreshed >= self.next_check:
+            self.enforce_budget()
+
+    def memory(self) -> Dict[str, int]:
+        """
+        The approximate bytes held by each structure of the graph: the
+        tables of its containers as allocated, which grow by powers of two
+        and do not shrink as entries are deleted (see compact), and the
+        objects of their entries (see TAG_BYTES and EDGE_BYTES).
+        """
+        tables = sum(map(sys.getsizeof, (self.tag_ids, self.tags, self.free_ids, self.degree)))
+        usage = {
+            'edges': sys.getsizeof(self.edges) + len(self.edges) * EDGE_BYTES,
+            'queue': self.queue_bytes(),
+            'tags': tables + len(self.tag_ids) * TAG_BYTES,
+        }
+        indexes = 0
+        if self.degree_index is not None:
+            buckets = self.degree_index.buckets
+            indexes += sys.getsizeof(buckets) + sum(map(sys.getsizeof, buckets.values()))
+        if self.adjacency is not None:
+            indexes += sys.getsizeof(self.adjacency) + sum(map(sys.getsizeof, self.adjacency.values()))
+        usage['indexes'] = indexes
+        return usage
+
+    def queue_bytes(self) -> int:
+        """
+        The approximate bytes held by the eviction queue (see memory),
+        including the stale entries left behind by refreshed edges, whose
+        keys are ints of their own.
+        """
+        return sys.getsizeof(self.queue) + max(0, len(self.queue) - len(self.edges)) * INT_BYTES
 
-        # very nicely, we do not need to check for hashtags being
-        # atleast two because itertools.combinations() will not
-        # produce an item in that case.
-        for edge in cast(Iterable, itertools.combinations(hashtags, 2)):
-            self.add_edge(ctime, edge)
+    def memory_bytes(self) -> int:
+        """
+        The approximate bytes held by the graph.
+        """
+        return sum(self.memory().values())
+
+    def enforce_budget(self) -> None:
+        """
+        Check the memory budget, and if the graph went over it, shed its
+        oldest edges down to SHED_TARGET of the budget. This shrinks the
+        window early rather than letting a burst of hashtags grow the
+        process without bound. The edges shed are counted as evicted.
+        """
+        self.next_check = self.added + self.refreshed + MEMORY_CHECK_EDGES
+        usage = self.memory_bytes()
+        if usage <= self.max_memory:
+            return
+        self.sheds += 1
+        target = self.max_memory * SHED_TARGET
+        while self.edges and usage > target:
+            # Shed the share of the edges that the excess is of the usage,
+            # and check again once the tables hold only what is left.
+            self.shed_oldest(max(1, int(len(self.edges) * (usage - target) / usage)))
+            self.compact()
+            usage = self.memory_bytes()
+
+    def compact(self) -> None:
+        """
+        Rebuild the tables that lost entries, since they do not shrink by
+        themselves, so that the memory of the edges shed is freed.
+        """
+        self.edges = dict(self.edges)
+        self.tag_ids = dict(self.tag_ids)
+        if self.adjacency is not None:
+            self.adjacency = {tag_id: dict(neighbors) for tag_id, neighbors in self.adjacency.items()}
+        self.compact_queue()
+
+    def compact_queue(self) -> None:
+        """
+        Rebuild the heap without its stale entries (see compact).
+        """
+        self.rebuild_queue()
+
+    def shed_oldest(self, count: int) -> None:
+        """
+        Evict the given number of the oldest live edges.
+        """
+        shed = self.shed + count
+        while self.shed < shed and self.queue:
+            ctime, key = self.queue.pop()
+            if self.edges.get(key, None) == ctime:
+                self.remove_key(key)
+                self.shed += 1
 
     def gc_complete(self) -> bool:
         """
@@ -83,30 +553,101 @@ class TweetGraph:
         """
         if len(self.queue) == 0:
             return True
-        _, ctime = self.queue.peekitem()
-        return self.in_window(ctime)
+        return self.in_window(self.queue.oldest())
 
     def collect_garbage(self) -> None:
         """
-        Perform garbage collection.
+        Perform garbage collection. An entry whose time is no longer that
+        of its edge was left behind by a refresh, and is simply dropped.
         """
-        LOG.info('start gc edges: %d queue: %d', len(self.edges.keys()), len(self.queue))
         while not self.gc_complete():
-            min_edge, _ = self.queue.popitem()
-            del self.edges[min_edge]
-            LOG.info('- %s', min_edge)
-        LOG.info('finished gc edges: %d queue: %d', len(self.edges.keys()), len(self.queue))
+            ctime, key = self.queue.pop()
+            if self.edges.get(key, None) == ctime:
+                self.remove_key(key)
+
+    @property
+    def node_count(self) -> int:
+        """
+        The number of hashtags that are part of at least one live edge.
+        """
+        return len(self.tag_ids)
 
     @property
     def avg_vdegree(self) -> float:
         """
         Compute the average degree of a vertex using the formula 2*edges/nodes.
+        Both counts are maintained incrementally, so this is O(1).
         """
         if not self.edges:
             return 0
-        # Our edge.keys are tuples of hashtags. We flatten them.
-        nodes = set(itertools.chain.from_iterable(self.edges.keys()))
-        return (2.0 * len(self.edges)) / len(nodes)
+        return (2.0 * len(self.edges)) / len(self.tag_ids)
+
+    def hashtag_degree(self, tag: str) -> int:
+        """
+        The degree of the given hashtag, 0 if it is not part of any edge.
+        """
+        tag_id = self.tag_ids.get(tag, None)
+        return 0 if tag_id is None else self.degree[tag_id]
+
+    def neighbors(self, tag: str) -> Dict[str, int]:
+        """
+        The live neighbors of the given hashtag with the last time their
+        edge was seen. The first call builds the adjacency index from the
+        edges, which the graph keeps up to date from then on, so that later
+        calls are O(degree).
+        :param tag: The hashtag
+        :return: The time of the edge to each neighbor, empty if the
+        hashtag is not part of any edge.
+        """
+        if self.adjacency is None:
+            self.adjacency = {}
+            for key, ctime in self.edges.items():
+                self.link(ctime, key)
+        tag_id = self.tag_ids.get(tag, None)
+        if tag_id is None:
+            return {}
+        return {cast(str, self.tags[other]): ctime for other, ctime in self.adjacency[tag_id].items()}
+
+    def top_hashtags(self, k: int) -> List[Tuple[str, int]]:
+        """
+        The k hashtags with the highest degree, ties broken by hashtag.
+        The first call builds a DegreeIndex, which the graph keeps up to
+        date from then on, so that later calls only look at the buckets
+        of the highest degrees.
+        :param k: The number of hashtags
+        :return: (hashtag, degree) pairs, highest degree first
+        """
+        if self.degree_index is None:
+            self.degree_index = DegreeIndex(self.degree)
+        top = []  # type: List[Tuple[str, int]]
+        for count in range(self.degree_index.max_degree, 0, -1):
+            if len(top) >= k:
+                break
+            bucket = self.degree_index.buckets.get(count, None)
+            if bucket:
+                tags = heapq.nsmallest(k - len(top), (cast(str, self.tags[tag_id]) for tag_id in bucket))
+                top.extend((tag, count) for tag in tags)
+        return top
+
+    def counters(self) -> Dict[str, float]:
+        """
+        The metrics kept by the graph (see METRICS).
+        """
+        return {
+            'edges_added': self.added,
+            'edges_refreshed': self.refreshed,
+            'edges_evicted': self.added - len(self.edges),
+            'gc_runs': self.gc_runs,
+            'gc_seconds': self.gc_ns / 1e9,
+            'gc_pause_max_seconds': self.gc_max_ns / 1e9,
+            'memory_bytes': self.memory_bytes(),
+            'memory_sheds': self.sheds,
+            'edges_shed': self.shed,
+            'edges': len(self.edges),
+            'nodes': self.node_count,
+            'latest': self.latest,
+            'average': self.avg_vdegree,
+        }
 
     def process_tweet(self, tweet: Dict[str, Any]) -> float:
         """
@@ -120,6 +661,72 @@ class TweetGraph:
         # appearance irrespective of whether it can be ignored or not.
         return self.avg_vdegree
 
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Capture the state of the graph as a few flat arrays. The eviction
+        queue is not captured since it is rebuilt from the edges, which
+        also lets a snapshot be restored into any engine.
+        :return: The state of the graph, which shares nothing with it.
+        """
+        return {
+            'version': SNAPSHOT_VERSION,
+            'window': self.window,
+            'latest': self.latest,
+            'tags': list(self.tags),
+            'free_ids': array('L', self.free_ids),
+            'degree': array('L', self.degree),
+            'keys': array('Q', self.edges.keys()),
+            'times': array('q', self.edges.values()),
+        }
+
+    @classmethod
+    def restore(cls, state: Dict[str, Any]) -> 'TweetGraph':
+        """
+        Create a graph from a snapshot. The graph shares nothing with the
+        snapshot, which may be restored again.
+        :param state: The state captured by snapshot()
+        :return: The restored graph
+        """
+        if state.get('version', None) != SNAPSHOT_VERSION:
+            raise ValueError('unsupported snapshot version: %s' % state.get('version', None))
+        graph = cls(state['latest'], state['window'])
+        graph.tags = list(state['tags'])
+        graph.tag_ids = {tag: tag_id for tag_id, tag in enumerate(graph.tags) if tag is not None}
+        graph.free_ids = list(state['free_ids'])
+        graph.degree = array('L', state['degree'])
+        for key, ctime in zip(state['keys'], state['times']):
+            graph.edges[key] = ctime
+        graph.added = len(graph.edges)
+        graph.rebuild_queue()
+        return graph
+
+    def rebuild_queue(self) -> None:
+        """
+        Rebuild the eviction queue from the edges, with an entry per edge.
+        """
+        self.queue = EdgeHeap((ctime, key) for key, ctime in self.edges.items())
+
+    def averages(self, records: Iterable[Tuple[int, List[str]]]) -> Iterator[float]:
+        """
+        Process a stream of records, yielding the current average vertex
+        degree after each one.
+        :param records: (ctime, hashtags) records, as given by trim_tweet
+        :return: An iterator over the average vertex degrees
+        """
+        update_hashtags = self.update_hashtags
+        for ctime, htags in records:
+            update_hashtags(ctime, htags)
+            yield (2.0 * len(self.edges)) / len(self.tag_ids) if self.edges else 0
+
+    def process_batch(self, records: Iterable[Tuple[int, List[str]]]) -> List[float]:
+        """
+        Process a batch of records, and return the average vertex degree
+        after each one.
+        :param records: (ctime, hashtags) records, as given by trim_tweet
+        :return: The average vertex degrees
+        """
+        return list(self.averages(records))
+
     @staticmethod
     def trim_tweet(my_hash: Dict[str, Any]) -> Tuple[int, List[str]]:
         """
@@ -137,24 +744,770 @@ class TweetGraph:
         return my_hash['ctime'], hashtags
 
 
-def get_tweet(line: str) -> Optional[Dict[str, Any]]:
+class WheelTweetGraph(TweetGraph):
+    """
+    A TweetGraph that uses a timing wheel instead of a heap. Since the
+    creation times are integer seconds, and only the last `window` seconds
+    are live, we keep a ring of `window` buckets, one for each live second.
+    Insertion and eviction are amortized O(1). A refreshed edge is simply
+    appended to the bucket of its new time; the entry left behind in the
+    old bucket no longer matches `self.edges`, and is skipped on eviction.
+    """
+    def __init__(self, curtime: int, window: int) -> None:
+        """
+        Initialize the WheelTweetGraph
+        :param curtime: The starting time
+        :param window: The sliding window
+        """
+        super().__init__(curtime, window)
+        # Each bucket is an array of packed edge keys.
+        self.buckets = [array('Q') for _ in range(window)]  # type: List[array]
+        # The oldest second whose bucket has not been swept yet.
+        self.frontier = curtime - window + 1
+
+    def add_key(self, ctime: int, key: int) -> None:
+        """
+        Add or update the edge with the given packed key.
+        :param ctime: The creation time of the tweet
+        :param key: The packed key of the edge
+        """
+        old_ctime = self.edges.get(key, None)
+        if old_ctime is None:
+            self.degree[key >> ID_BITS] += 1
+            self.degree[key & ID_MASK] += 1
+            self.added += 1
+            if self.degree_index is not None:
+                self.degree_index.increment(key >> ID_BITS, self.degree[key >> ID_BITS])
+                self.degree_index.increment(key & ID_MASK, self.degree[key & ID_MASK])
+        elif ctime <= old_ctime:
+            return
+        else:
+            self.refreshed += 1
+        if self.adjacency is not None:
+            self.link(ctime, key)
+        self.buckets[ctime % self.window].append(key)
+        self.edges[key] = ctime
+
+    def rebuild_queue(self) -> None:
+        """
+        Rebuild the eviction queue from the edges.
+        """
+        for key, ctime in self.edges.items():
+            self.buckets[ctime % self.window].append(key)
+
+    def queue_bytes(self) -> int:
+        """
+        The approximate bytes held by the wheel. Its buckets hold packed
+        keys, including the stale ones left behind by refreshed edges.
+        This is O(window), but it is only needed when checking the memory
+        budget.
+        """
+        return sys.getsizeof(self.buckets) + sum(map(sys.getsizeof, self.buckets))
+
+    def compact_queue(self) -> None:
+        """
+        Nothing to rebuild: a bucket frees its entries when it is emptied.
+        """
+
+    def shed_oldest(self, count: int) -> None:
+        """
+        Evict at least the given number of the oldest live edges, sweeping
+        whole seconds from the frontier on. The frontier itself does not
+        move, so that a bucket that was swept early still takes the late
+        tweets of its second.
+        """
+        shed = self.shed + count
+        for second in range(self.frontier, self.latest + 1):
+            if self.shed >= shed or not self.edges:
+                break
+            self.shed_second(second)
+
+    def shed_second(self, second: int) -> None:
+        """
+        Evict the live edges of the given second, and empty its bucket.
+        """
+        bucket = self.buckets[second % self.window]
+        for key in bucket:
+            if self.edges.get(key, None) == second:
+                self.remove_key(key)
+                self.shed += 1
+        del bucket[:]
+
+    def gc_complete(self) -> bool:
+        """
+        Check if the gc is complete.
+        """
+        return self.latest - self.window < self.frontier
+
+    def collect_garbage(self) -> None:
+        """
+        Perform garbage collection by sweeping the buckets of every second
+        that fell out of the window since the last sweep.
+        """
+        cutoff = self.latest - self.window
+        if cutoff < self.frontier:
+            return
+        if cutoff - self.frontier >= self.window:
+            # Every live second has expired, which empties the whole graph.
+            self.buckets = [array('Q') for _ in range(self.window)]
+            self.edges.clear()
+            self.tag_ids.clear()
+            self.tags.clear()
+            self.free_ids.clear()
+            self.degree = array('L')
+            if self.degree_index is not None:
+                self.degree_index = DegreeIndex(self.degree)
+            if self.adjacency is not None:
+                self.adjacency = {}
+        else:
+            for second in range(self.frontier, cutoff + 1):
+                bucket = self.buckets[second % self.window]
+                for key in bucket:
+                    if self.edges.get(key, None) == second:
+                        self.remove_key(key)
+                del bucket[:]
+        self.frontier = cutoff + 1
+
+
+class WindowView:
+    """
+    The part of a MultiWindowTweetGraph that is live in one of its smaller
+    windows. It does not hold edges of its own. Instead, it counts the
+    shared edges whose time falls within its window, and keeps a timing
+    wheel of them (as WheelTweetGraph does) to know when they leave it.
+    """
+    def __init__(self, curtime: int, window: int) -> None:
+        """
+        Initialize the WindowView
+        :param curtime: The starting time
+        :param window: The sliding window
+        """
+        self.window = window
+        self.buckets = [array('Q') for _ in range(window)]  # type: List[array]
+        self.frontier = curtime - window + 1
+        self.edge_count = 0
+        # The number of edges live in this window incident on each hashtag id.
+        self.degree = {}  # type: Dict[int, int]
+
+    def add_key(self, latest: int, ctime: int, old_ctime: Optional[int], key: int) -> None:
+        """
+        Account for an edge that was added or refreshed in the shared store.
+        :param latest: The latest time seen by the graph
+        :param ctime: The new time of the edge
+        :param old_ctime: The previous time of the edge if it existed
+        :param key: The packed key of the edge
+        """
+        cutoff = latest - self.window
+        if ctime <= cutoff:
+            return
+        # The edge is counted already if its previous time is still live.
+        if old_ctime is None or old_ctime <= cutoff:
+            self.edge_count += 1
+            for tag_id in (key >> ID_BITS, key & ID_MASK):
+                self.degree[tag_id] = self.degree.get(tag_id, 0) + 1
+        self.buckets[ctime % self.window].append(key)
+
+    def remove_key(self, key: int) -> None:
+        """
+        Stop counting an edge that left this window.
+        :param key: The packed key of the edge
+        """
+        self.edge_count -= 1
+        for tag_id in (key >> ID_BITS, key & ID_MASK):
+            count = self.degree[tag_id] - 1
+            if count:
+                self.degree[tag_id] = count
+            else:
+                del self.degree[tag_id]
+
+    def collect_garbage(self, latest: int, edges: Dict[int, int]) -> None:
+        """
+        Sweep the buckets of every second that fell out of the window.
+        This has to happen before the edges leave the shared store.
+        :param latest: The latest time seen by the graph
+        :param edges: The shared edges with their times
+        """
+        cutoff = latest - self.window
+        if cutoff < self.frontier:
+            return
+        if cutoff - self.frontier >= self.window:
+            self.buckets = [array('Q') for _ in range(self.window)]
+            self.edge_count = 0
+            self.degree.clear()
+        else:
+            for second in range(self.frontier, cutoff + 1):
+                bucket = self.buckets[second % self.window]
+                for key in bucket:
+                    if edges.get(key, None) == second:
+                        self.remove_key(key)
+                del bucket[:]
+        self.frontier = cutoff + 1
+
+    @property
+    def avg_vdegree(self) -> float:
+        """
+        The average vertex degree within this window.
+        """
+        if not self.edge_count:
+            return 0
+        return (2.0 * self.edge_count) / len(self.degree)
+
+
+class MultiWindowTweetGraph(WheelTweetGraph):
+    """
+    Compute the rolling average for several windows in a single pass.
+    The edges are stored once, with the latest time they were seen, and
+    evicted on the largest window. An edge is live in a smaller window
+    exactly when its time is within that window: a tweet that only the
+    larger windows accept is too old to make an edge live in the smaller
+    ones, and stays so since `latest` never decreases. Each smaller window
+    is tracked by a WindowView with its own eviction frontier and counts.
+    """
+    def __init__(self, curtime: int, windows: List[int]) -> None:
+        """
+        Initialize the MultiWindowTweetGraph
+        :param curtime: The starting time
+        :param windows: The sliding windows
+        """
+        super().__init__(curtime, max(windows))
+        self.windows = list(windows)
+        self.views = [WindowView(curtime, window) for window in sorted(set(windows)) if window != self.window]
+
+    def add_key(self, ctime: int, key: int) -> None:
+        """
+        Add or update the edge with the given packed key.
+        :param ctime: The creation time of the tweet
+        :param key: The packed key of the edge
+        """
+        old_ctime = self.edges.get(key, None)
+        if old_ctime is not None and ctime <= old_ctime:
+            return
+        for view in self.views:
+            view.add_key(self.latest, ctime, old_ctime, key)
+        super().add_key(ctime, key)
+
+    def collect_garbage(self) -> None:
+        """
+        Perform garbage collection on every window, the largest last.
+        """
+        for view in self.views:
+            view.collect_garbage(self.latest, self.edges)
+        super().collect_garbage()
+
+    def shed_second(self, second: int) -> None:
+        """
+        Evict the live edges of the given second from every window. Every
+        edge of that second goes, so the buckets of the views are emptied
+        too, and later tweets of that second are counted anew.
+        """
+        for view in self.views:
+            if second > self.latest - view.window:
+                bucket = view.buckets[second % view.window]
+                for key in bucket:
+                    if self.edges.get(key, None) == second:
+                        view.remove_key(key)
+                del bucket[:]
+        super().shed_second(second)
+
+    def memory(self) -> Dict[str, int]:
+        """
+        The approximate bytes held by each structure of the graph, with
+        the wheels and the degrees of the smaller windows.
+        """
+        usage = super().memory()
+        usage['views'] = 0
+        for view in self.views:
+            usage['views'] += sys.getsizeof(view.buckets) + sum(map(sys.getsizeof, view.buckets))
+            usage['views'] += sys.getsizeof(view.degree)
+        return usage
+
+    def compact(self) -> None:
+        """
+        Rebuild the dicts that lost entries, also those of the views.
+        """
+        super().compact()
+        for view in self.views:
+            view.degree = dict(view.degree)
+
+    @property
+    def window_averages(self) -> Tuple[float, ...]:
+        """
+        The average vertex degree of each window, in the order given.
+        """
+        by_window = {view.window: view.avg_vdegree for view in self.views}
+        by_window[self.window] = self.avg_vdegree
+        return tuple(by_window[window] for window in self.windows)
+
+    def averages(self, records: Iterable[Tuple[int, List[str]]]) -> Iterator[Tuple[float, ...]]:  # type: ignore
+        """
+        Process a stream of records, yielding the average vertex degree
+        of each window after each one.
+        :param records: (ctime, hashtags) records, as given by trim_tweet
+        :return: An iterator over tuples of average vertex degrees
+        """
+        for ctime, htags in records:
+            self.update_hashtags(ctime, htags)
+            yield self.window_averages
+
+
+ENGINES = {
+    'heap': TweetGraph,
+    'wheel': WheelTweetGraph,
+}
+
+
+@functools.lru_cache(maxsize=TIME_CACHE_SIZE)
+def parse_created_at(created_at: str) -> int:
+    """
+    Convert the created_at string of a tweet to seconds since the epoch.
+    The layout of TIME_FMT is fixed (e.g. `Thu Nov 05 05:05:39 +0000 2015`)
+    and always in UTC, so we slice out the fields and compute the time
+    directly. Anything that does not fit the layout exactly is left to
+    `time.strptime`, which decides whether it is valid.
+    :param created_at: The creation time in TIME_FMT
+    :return: The creation time in seconds since the epoch
+    :raises ValueError: If the creation time is not in TIME_FMT
+    """
+    if len(created_at) == 30 and created_at[:3] in WEEKDAYS and created_at[4:7] in MONTHS:
+        separators = created_at[3] + created_at[7] + created_at[10] + created_at[13] + created_at[16] + created_at[19:26]
+        digits = created_at[8:10] + created_at[11:13] + created_at[14:16] + created_at[17:19] + created_at[26:30]
+        if separators == '   :: +0000 ' and digits.isdigit():
+            hour, minute, second = int(created_at[11:13]), int(created_at[14:16]), int(created_at[17:19])
+            if hour < 24 and minute < 60 and second < 62:
+                # date() validates the day of the month for us.
+                day = datetime.date(int(created_at[26:30]), MONTHS[created_at[4:7]], int(created_at[8:10]))
+                return (day.toordinal() - EPOCH_ORDINAL) * 86400 + hour * 3600 + minute * 60 + second
+    return calendar.timegm(time.strptime(created_at, TIME_FMT))
+
+
+def extract_tweet(line: str, fields: Iterable[str] = ()) -> Optional[Dict[str, Any]]:
+    """
+    Pick created_at, timestamp_ms, and entities.hashtags out of the raw
+    line without decoding the rest of the tweet. This only succeeds when
+    the line unambiguously holds a tweet with these fields at the top
+    level: it starts with created_at and ends with timestamp_ms (as the
+    streaming API writes them), it does not embed another tweet, and
+    `"hashtags"` occurs at most once. A `"` inside a json string is always
+    escaped, but a string ending in `\\"hashtags"` can still match the
+    pattern; since a tweet always has entities.hashtags, such a line holds
+    the key twice and is left to the decoder.
+    :param line: The json line to be parsed.
+    :param fields: Dotted paths of other fields to pick, such as
+    place.country_code. The last key of each must occur at most once in
+    the line, so `lang`, which user objects also have, usually means
+    decoding the tweet in full.
+    :return: A dict with the same shape as the decoded tweet restricted
+    to these fields, or None if the line has to be decoded in full.
+    """
+    created_at = CREATED_AT_RE.match(line)
+    if not created_at:
+        return None
+    end = TWEET_END_RE.search(line, max(created_at.end(), len(line) - TWEET_END_SPAN))
+    if not end:
+        return None
+    if any(nested in line for nested in NESTED_TWEETS):
+        return None
+    j = {'created_at': created_at.group(1)}  # type: Dict[str, Any]
+    # str.find is much faster than scanning with a regex, so we only use
+    # the regex to check the match.
+    start = line.find('"hashtags"', created_at.end())
+    if start >= 0:
+        hashtags = HASHTAGS_RE.match(line, start)
+        if not hashtags or line.find('"hashtags"', hashtags.end()) >= 0:
+            return None
+        j['entities'] = {'hashtags': DECODER.raw_decode(line, hashtags.end() - 1)[0]}
+    j['timestamp_ms'] = end.group(1)
+    for field in fields:
+        path = field.split('.')
+        key = '"%s"' % path[-1]
+        start = line.find(key, created_at.end())
+        if start < 0:
+            continue
+        value = KEY_RE.match(line, start)
+        if not value or line.find(key, value.end()) >= 0:
+            return None
+        node = j
+        for part in path[:-1]:
+            node = node.setdefault(part, {})
+        node[path[-1]] = DECODER.raw_decode(line, value.end())[0]
+    return j
+
+
+def tweet_fields(tweet: Dict[str, Any], fields: Iterable[str]) -> Tuple[Any, ...]:
+    """
+    The values of the given dotted paths in a tweet, None where missing.
+    """
+    values = []
+    for field in fields:
+        value = tweet  # type: Any
+        for part in field.split('.'):
+            value = value.get(part, None) if isinstance(value, dict) else None
+        values.append(value)
+    return tuple(values)
+
+
+def save_snapshot(state: Dict[str, Any], path: str) -> None:
+    """
+    Write a snapshot to the given path. The file is replaced atomically,
+    so that a crash while writing leaves the previous snapshot intact.
+    :param state: The state captured by TweetGraph.snapshot()
+    :param path: The snapshot file
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as snapshot_file:
+        pickle.dump(state, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def load_snapshot(path: str) -> Dict[str, Any]:
+    """
+    Read a snapshot written by save_snapshot.
+    :param path: The snapshot file
+    :return: The state to be passed to TweetGraph.restore()
+    """
+    with open(path, 'rb') as snapshot_file:
+        return pickle.load(snapshot_file)
+
+
+class Snapshotter:
+    """
+    Save snapshots of a graph while it processes a stream of records,
+    every `interval` seconds and whenever request() is called (e.g. from
+    a signal handler). The state is captured between two records, and
+    written out on a background thread so that ingestion is not stalled
+    by the disk.
+    """
+    def __init__(self, graph: TweetGraph, path: str, interval: float) -> None:
+        """
+        Initialize the Snapshotter
+        :param graph: The graph to be saved
+        :param path: The snapshot file
+        :param interval: The seconds between two snapshots
+        """
+        self.graph = graph
+        self.path = path
+        self.interval = interval
+        self.due = time.monotonic() + interval
+        self.requested = False
+        self.writer = None  # type: Optional[threading.Thread]
+
+    def request(self, *_: Any) -> None:
+        """
+        Ask for a snapshot after the current record.
+        """
+        self.requested = True
+
+    def save(self) -> None:
+        """
+        Capture the graph now, and write it out in the background once
+        the previous snapshot has been written.
+        """
+        state = self.graph.snapshot()
+        if self.writer:
+            self.writer.join()
+        self.writer = threading.Thread(target=save_snapshot, args=(state, self.path))
+        self.writer.start()
+        self.requested = False
+        self.due = time.monotonic() + self.interval
+
+    def records(self, records: Iterable[Tuple[int, List[str]]]) -> Iterator[Tuple[int, List[str]]]:
+        """
+        Pass the records through, saving a snapshot when one is due.
+        The graph has processed a record by the time the next is asked for.
+        :param records: (ctime, hashtags) records
+        :return: The same records
+        """
+        for record in records:
+            yield record
+            if self.requested or time.monotonic() >= self.due:
+                self.save()
+
+    def close(self) -> None:
+        """
+        Save the final state, and wait for it to be written.
+        """
+        self.save()
+        cast(threading.Thread, self.writer).join()
+
+
+class Lookup:
+    """
+    Answer degree and neighbor queries about some hashtags while a graph
+    processes a stream of records, whenever request() is called (e.g. from
+    a signal handler) and at the end. Each answer is a json line.
+    """
+    def __init__(self, graph: TweetGraph, tags: List[str], out: Any) -> None:
+        """
+        Initialize the Lookup
+        :param graph: The graph to be queried
+        :param tags: The hashtags to look up
+        :param out: The file the answers are written to
+        """
+        self.graph = graph
+        self.tags = tags
+        self.out = out
+        self.requested = False
+
+    def request(self, *_: Any) -> None:
+        """
+        Ask for the answers after the current record.
+        """
+        self.requested = True
+
+    def answer(self) -> None:
+        """
+        Write the answers now.
+        """
+        for tag in self.tags:
+            self.out.write(json.dumps({'tag': tag, 'latest': self.graph.latest,
+                                       'degree': self.graph.hashtag_degree(tag),
+                                       'neighbors': self.graph.neighbors(tag)}, sort_keys=True) + '\n')
+        self.out.flush()
+        self.requested = False
+
+    def records(self, records: Iterable[Tuple[int, List[str]]]) -> Iterator[Tuple[int, List[str]]]:
+        """
+        Pass the records through, answering when asked to.
+        """
+        for record in records:
+            yield record
+            if self.requested:
+                self.answer()
+        self.answer()
+
+
+def parse_query(spec: List[str]) -> Tuple[str, int, Dict[str, FrozenSet[str]]]:
+    """
+    Parse a query given as PATH WINDOW [FIELD=VALUE[,VALUE...]...].
+    :return: The output path, the window, and the accepted values of
+    each field
+    """
+    if len(spec) < 2:
+        raise ValueError('a query needs a path and a window: %s' % ' '.join(spec))
+    conditions = {}  # type: Dict[str, FrozenSet[str]]
+    for condition in spec[2:]:
+        field, sep, values = condition.partition('=')
+        if not field or not sep:
+            raise ValueError('a condition is FIELD=VALUE[,VALUE...]: %s' % condition)
+        conditions[field] = frozenset(values.split(','))
+    window = int(spec[1])
+    if window < 1:
+        raise ValueError('the window must be a positive number of seconds: %s' % spec[1])
+    return spec[0], window, conditions
+
+
+class Query:
+    """
+    A graph fed only with the tweets matching all of its conditions, each
+    of which accepts some values of a field. The `hashtags` condition
+    accepts the tweets having any of its hashtags. The fields are looked
+    up by their position in the values of the records (see parse_records),
+    so that the records are parsed once for all the queries.
+    """
+    def __init__(self, graph: TweetGraph, conditions: Dict[str, FrozenSet[str]],
+                 fields: List[str], out: Any) -> None:
+        """
+        Initialize the Query
+        :param graph: The graph of the matching tweets
+        :param conditions: The accepted values of each field
+        :param fields: The fields of the values of the records
+        :param out: The file the averages are written to
+        """
+        self.graph = graph
+        self.tags = conditions.get('hashtags', None)
+        self.checks = [(fields.index(field), field, accepted) for field, accepted in sorted(conditions.items())
+                       if field != 'hashtags']
+        self.out = out
+
+    def matches(self, hashtags: List[str], values: Tuple[Any, ...]) -> bool:
+        """
+        Does a tweet with these hashtags and field values match the query?
+        A string is compared as it is, and any other value as json, e.g.
+        `true`, `42` or `null` (also for a missing field).
+        :raises ValueError: If a field is an object or an array
+        """
+        if self.tags is not None and self.tags.isdisjoint(hashtags):
+            return False
+        for index, field, accepted in self.checks:
+            value = values[index]
+            if not isinstance(value, str):
+                if isinstance(value, (dict, list)):
+                    raise ValueError('the field %s is not a string, number, boolean or null' % field)
+                value = json.dumps(value)
+            if value not in accepted:
+                return False
+        return True
+
+
+def fan_out(queries: List[Query], records: Iterable[Tuple[int, List[str], Tuple[Any, ...]]],
+            fmt: Callable[[float], str] = '{:0.2f}\n'.format) -> None:
+    """
+    Feed each record to the graphs of the queries it matches, and write
+    the average of each of these graphs to the output of its query. The
+    output of a query is thus that of a run on the matching tweets alone.
+    :param queries: The queries
+    :param records: (ctime, hashtags, values) records, as given by
+    parse_records with the fields of the queries
+    :param fmt: The format of the averages
+    """
+    for ctime, htags, values in records:
+        for query in queries:
+            if query.matches(htags, values):
+                query.graph.update_hashtags(ctime, htags)
+                query.out.write(fmt(query.graph.avg_vdegree))
+
+
+class Metrics:
+    """
+    The counters of the parsing stage. They are kept apart from the graph
+    since the lines may be parsed in other processes, whose metrics are
+    merged as their chunks come back. Times are in nanoseconds.
+    """
+    def __init__(self) -> None:
+        self.lines = 0
+        self.invalid = 0
+        self.parse_ns = 0
+        self.timestamp_ns = 0
+        self.queue_depth = 0
+
+    def merge(self, other: 'Metrics') -> None:
+        """
+        Add the counters of another Metrics to these.
+        """
+        self.lines += other.lines
+        self.invalid += other.invalid
+        self.parse_ns += other.parse_ns
+        self.timestamp_ns += other.timestamp_ns
+
+    def sample(self, graph: Any) -> Dict[str, float]:
+        """
+        Take the current value of every metric, and start measuring the
+        longest gc pause anew.
+        :param graph: The graph, which keeps the counters of its own
+        :return: The values of the metrics in METRICS present for the graph
+        """
+        values = {
+            'lines': self.lines,
+            'invalid': self.invalid,
+            'parse_seconds': self.parse_ns / 1e9,
+            'timestamp_seconds': self.timestamp_ns / 1e9,
+            'queue_depth': self.queue_depth,
+        }  # type: Dict[str, float]
+        values.update(graph.counters())
+        if hasattr(graph, 'gc_max_ns'):
+            graph.gc_max_ns = 0
+        return values
+
+
+def format_stats(values: Dict[str, float]) -> str:
+    """
+    Format sampled metrics as a single line of name=value pairs.
+    """
+    return 'stats ' + ' '.join('%s=%s' % (name, round(values[name], 6)) for name, _, _ in METRICS if name in values) + '\n'
+
+
+def format_prometheus(values: Dict[str, float]) -> str:
+    """
+    Format sampled metrics in the prometheus text exposition format.
+    """
+    lines = []
+    for name, kind, help_text in METRICS:
+        if name in values:
+            metric = 'tweetgraph_%s%s' % (name, '_total' if kind == 'counter' else '')
+            lines.append('# HELP %s %s\n# TYPE %s %s\n%s %s\n' % (metric, help_text, metric, kind, metric, values[name]))
+    return ''.join(lines)
+
+
+class StatsReporter:
+    """
+    Report the metrics while a graph processes a stream of records, every
+    `interval` seconds and once more at the end: as a line on the stats
+    file, and by replacing the prometheus text file at `path` if given
+    (e.g. for the textfile collector of the node exporter).
+    """
+    def __init__(self, graph: Any, metrics: Metrics, interval: float,
+                 stats_file: Any = None, path: Optional[str] = None) -> None:
+        """
+        Initialize the StatsReporter
+        :param graph: The graph processing the records
+        :param metrics: The metrics of the parsing stage
+        :param interval: The seconds between two reports
+        :param stats_file: The file the stats line is written to, if any
+        :param path: The prometheus text file, if any
+        """
+        self.graph = graph
+        if hasattr(graph, 'timed'):
+            graph.timed = True
+        self.metrics = metrics
+        self.interval = interval
+        self.stats_file = stats_file
+        self.path = path
+        self.due = time.monotonic() + interval
+
+    def report(self) -> None:
+        """
+        Report the metrics now.
+        """
+        values = self.metrics.sample(self.graph)
+        if self.stats_file:
+            self.stats_file.write(format_stats(values))
+            self.stats_file.flush()
+        if self.path:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as metrics_file:
+                metrics_file.write(format_prometheus(values))
+            os.replace(tmp, self.path)
+        self.due = time.monotonic() + self.interval
+
+    def records(self, records: Iterable[Any]) -> Iterator[Any]:
+        """
+        Pass the records through, reporting when a report is due.
+        """
+        for record in records:
+            yield record
+            if time.monotonic() >= self.due:
+                self.report()
+        self.report()
+
+
+def get_tweet(line: str, use_timestamp_ms: bool = False, extract: bool = False,
+              metrics: Optional[Metrics] = None, fields: Iterable[str] = ()) -> Optional[Dict[str, Any]]:
     """
     Parse the line into json, and check that it is a valid tweet
     and not a limit message.
     :param line: The json line to be parsed.
+    :param use_timestamp_ms: Take the creation time from the `timestamp_ms`
+    field when it is present rather than parsing `created_at`.
+    :param extract: Try extracting only the fields we need from the line
+    (see extract_tweet) before decoding all of it.
+    :param metrics: The metrics timing the decoding and the creation time.
+    :param fields: Other fields that extract has to pick (see extract_tweet)
     :return: If this is a valid tweet, the dict containing creation
     time and hashtags. None otherwise.
     """
+    start = time.perf_counter_ns() if metrics else 0
     try:
-        j = json.loads(line)
+        j = extract_tweet(line, fields) if extract else None
+        if j is None:
+            j = json.loads(line)
+        if metrics:
+            parsed = time.perf_counter_ns()
+            metrics.parse_ns += parsed - start
+            start = parsed
         created_at = j.get('created_at', None)
         if not created_at:
             return None
 
         # We validate the creation time here. If the creation time
         # is in invalid format, it is an invalid tweet.
-        ctime = int(time.mktime(time.strptime(created_at, TIME_FMT)))
+        timestamp_ms = j.get('timestamp_ms', None) if use_timestamp_ms else None
+        if timestamp_ms is not None:
+            ctime = int(timestamp_ms) // 1000
+        else:
+            ctime = parse_created_at(created_at)
         j['ctime'] = ctime
+        if metrics:
+            metrics.timestamp_ns += time.perf_counter_ns() - start
         return j
     except ValueError:
         # We do not expect any records to be malformed. However, if there
@@ -165,20 +1518,520 @@ def get_tweet(line: str) -> Optional[Dict[str, Any]]:
         return None
 
 
-def main():
+def parse_records(lines: Iterable[str], use_timestamp_ms: bool = False, extract: bool = False,
+                  metrics: Optional[Metrics] = None, fields: Tuple[str, ...] = ()) -> List[Tuple[Any, ...]]:
+    """
+    Parse the lines into (ctime, hashtags) records, dropping any line
+    that is not a valid tweet.
+    :param lines: The json lines to be parsed.
+    :param use_timestamp_ms: See get_tweet
+    :param extract: See get_tweet
+    :param metrics: See get_tweet. The lines are also counted.
+    :param fields: Dotted paths of tweet fields. If any are given, the
+    records are (ctime, hashtags, values), with the values of the fields
+    as given by tweet_fields.
+    :return: The records of the valid tweets in the order of the lines.
     """
-    The entry point. We require a single parameter: the window length.
-    We also accept tweets in stdin, and write to stdout.
+    records = []  # type: List[Tuple[Any, ...]]
+    count = 0
+    for count, line in enumerate(lines, 1):
+        tweet = get_tweet(line, use_timestamp_ms, extract, metrics, fields)
+        if tweet:
+            record = TweetGraph.trim_tweet(tweet)  # type: Tuple[Any, ...]
+            if fields:
+                record += (tweet_fields(tweet, fields),)
+            records.append(record)
+    if metrics:
+        metrics.lines += count
+        metrics.invalid += count - len(records)
+    return records
+
+
+def parse_chunk(lines: List[str], use_timestamp_ms: bool = False, extract: bool = False,
+                fields: Tuple[str, ...] = ()) -> Tuple[List[Tuple[Any, ...]], Metrics]:
+    """
+    Parse a chunk of lines in a worker, measuring the parse.
+    :return: The records of the chunk (see parse_records), and the metrics.
+    """
+    metrics = Metrics()
+    return parse_records(lines, use_timestamp_ms, extract, metrics, fields), metrics
+
+
+def read_records(lines: Iterable[str], workers: int = 1, use_timestamp_ms: bool = False, extract: bool = False,
+                 metrics: Optional[Metrics] = None, fields: Tuple[str, ...] = ()) -> Iterator[Tuple[Any, ...]]:
+    """
+    Parse the lines into (ctime, hashtags) records. With more than one
+    worker, chunks of lines are parsed by a pool of processes, and the
+    records are produced in the original order. Only a few chunks per
+    worker are in flight at any time, so the input is still streamed.
+    Without workers, each record is produced as soon as its line is read.
+    :param lines: The json lines to be parsed.
+    :param workers: The number of parse processes
+    :param use_timestamp_ms: See get_tweet
+    :param extract: See get_tweet
+    :param metrics: The metrics of the parse, merged from the workers.
+    :param fields: See parse_records
+    :return: An iterator over the records of the valid tweets.
+    """
+    if workers <= 1:
+        # Line by line, so that a live stream is not held back by a chunk.
+        for line in lines:
+            tweet = get_tweet(line, use_timestamp_ms, extract, metrics, fields)
+            if metrics:
+                metrics.lines += 1
+                metrics.invalid += not tweet
+            if not tweet:
+                continue
+            if fields:
+                yield TweetGraph.trim_tweet(tweet) + (tweet_fields(tweet, fields),)
+            else:
+                yield TweetGraph.trim_tweet(tweet)
+        return
+    lines = iter(lines)
+    chunks = iter(lambda: list(itertools.islice(lines, CHUNK_SIZE)), [])
+    parse = functools.partial(parse_chunk, use_timestamp_ms=use_timestamp_ms, extract=extract, fields=fields)
+    metrics = metrics or Metrics()
+    with multiprocessing.Pool(workers) as pool:
+        pending = collections.deque()  # type: collections.deque
+        for chunk in chunks:
+            pending.append(pool.apply_async(parse, (chunk,)))
+            if len(pending) > 2 * workers:
+                records, chunk_metrics = pending.popleft().get()
+                metrics.merge(chunk_metrics)
+                metrics.queue_depth = len(pending) * CHUNK_SIZE
+                yield from records
+        while pending:
+            records, chunk_metrics = pending.popleft().get()
+            metrics.merge(chunk_metrics)
+            metrics.queue_depth = len(pending) * CHUNK_SIZE
+            yield from records
+
+
+def open_input(path: str) -> Any:
+    """
+    Open an input file for reading bytes, decompressing it on the fly
+    according to its extension (see OPENERS).
+    """
+    return OPENERS.get(os.path.splitext(path)[1], open)(path, 'rb')
+
+
+def read_blocks(path: str, block: int = READ_BLOCK) -> Iterator[List[str]]:
+    """
+    Read the lines of an input file `block` bytes at a time. A line that
+    straddles two blocks is carried over to the next one.
+    :param path: The input file
+    :param block: The number of (decompressed) bytes read at a time
+    :return: An iterator over the lists of lines in each block
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    rest = ''
+    with open_input(path) as input_file:
+        while True:
+            data = input_file.read(block)
+            if not data:
+                break
+            lines = (rest + decoder.decode(data)).split('\n')
+            rest = lines.pop()
+            yield lines
+    rest += decoder.decode(b'', final=True)
+    if rest:
+        yield [rest]
+
+
+def first_time(path: str) -> Optional[int]:
+    """
+    The creation time of the first valid tweet of an input file, if any.
+    """
+    for lines in read_blocks(path, 1 << 16):
+        for line in lines:
+            tweet = get_tweet(line)
+            if tweet:
+                return tweet['ctime']
+    return None
+
+
+def expand_inputs(patterns: Iterable[str]) -> List[str]:
+    """
+    Expand the glob patterns into input files, ordered by the creation
+    time of their first tweet, so that rotated files are read in the
+    order they were written whatever their names.
+    :param patterns: Paths or glob patterns
+    :return: The input files
+    :raises ValueError: If a pattern matches no file
+    """
+    paths = []  # type: List[str]
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise ValueError('no input matches %s' % pattern)
+        paths.extend(path for path in matches if path not in paths)
+    times = {path: first_time(path) for path in paths}
+    # Files without tweets go last.
+    return sorted(paths, key=lambda path: (times[path] is None, times[path] or 0))
+
+
+def prefetch(blocks: Iterator[List[str]], depth: int = PREFETCH_BLOCKS) -> Iterator[List[str]]:
+    """
+    Read the blocks on a background thread, up to `depth` blocks ahead.
+    The decompressors release the GIL, so this overlaps decompression
+    with the processing of the tweets.
+    """
+    ahead = queue.Queue(depth)  # type: queue.Queue
+    done = object()
+
+    def reader() -> None:
+        try:
+            for lines in blocks:
+                ahead.put(lines)
+            ahead.put(done)
+        except BaseException as error:  # pylint: disable=broad-except
+            ahead.put(error)
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        lines = ahead.get()
+        if lines is done:
+            return
+        if isinstance(lines, BaseException):
+            raise lines
+        yield lines
+
+
+def read_inputs(paths: Iterable[str], background: bool = False) -> Iterator[str]:
+    """
+    Read the lines of the input files, one file after the other.
+    :param paths: The input files, in the order they are to be read
+    :param background: Decompress ahead on a background thread
+    :return: An iterator over the lines
+    """
+    blocks = (lines for path in paths for lines in read_blocks(path))
+    for lines in prefetch(blocks) if background else blocks:
+        yield from lines
+
+
+def parse_size(text: str) -> int:
+    """
+    Parse a number of bytes, optionally with a K, M or G (binary) suffix.
+    """
+    scale = 1
+    if text[-1:].upper() in SIZE_SUFFIXES:
+        scale = SIZE_SUFFIXES[text[-1].upper()]
+        text = text[:-1]
+    size = int(float(text) * scale)
+    if size < 0:
+        raise ValueError('negative size: %s' % text)
+    return size
+
+
+def format_columns(averages: Tuple[float, ...]) -> str:
+    """
+    Format the averages of several windows as a line of columns.
+    """
+    return ' '.join('{:0.2f}'.format(average) for average in averages) + '\n'
+
+
+def sample_averages(graph: Any, records: Iterable[Tuple[int, List[str]]], mode: str, every: int = 1,
+                    fmt: Callable[[Any], str] = '{:0.2f}\n'.format) -> Iterator[Tuple[int, Any]]:
+    """
+    Process the records, yielding the average only at the points chosen
+    by the mode, labelled with where it was taken. The average is only
+    computed when it may be yielded.
+        changes  after each tweet that changes the formatted average,
+                 labelled with the index of the tweet (counting from 1)
+        second   at the end of each event time second, that is when a
+                 later tweet arrives and after the last one, labelled
+                 with the second
+        every    after every `every` tweets and after the last one,
+                 labelled with the index of the tweet
+    :param graph: The graph, with update_hashtags and either avg_vdegree
+    or window_averages
+    :param records: (ctime, hashtags) records, as given by trim_tweet
+    :param mode: changes, second or every
+    :param every: The number of tweets between two averages (every)
+    :param fmt: Format an average as a line, used to detect changes
+    :return: An iterator over (label, average) pairs
+    """
+    def average() -> Any:
+        return graph.window_averages if isinstance(graph, MultiWindowTweetGraph) else graph.avg_vdegree
+    update_hashtags = graph.update_hashtags
+    index = 0
+    if mode == 'changes':
+        last = fmt(average())
+        for index, (ctime, htags) in enumerate(records, 1):
+            update_hashtags(ctime, htags)
+            value = average()
+            line = fmt(value)
+            if line != last:
+                last = line
+                yield index, value
+    elif mode == 'second':
+        for index, (ctime, htags) in enumerate(records, 1):
+            # A tweet advances latest exactly when it is later, which
+            # closes the current second.
+            if ctime > graph.latest and index > 1:
+                yield graph.latest, average()
+            update_hashtags(ctime, htags)
+        if index:
+            yield graph.latest, average()
+    elif mode == 'every':
+        for index, (ctime, htags) in enumerate(records, 1):
+            update_hashtags(ctime, htags)
+            if not index % every:
+                yield index, average()
+        if index % every:
+            yield index, average()
+    else:
+        raise ValueError('unknown mode: %s' % mode)
+
+
+def write_averages(averages: Iterable[Any], out: Any, block: int = OUTPUT_BLOCK,
+                   fmt: Callable[[Any], str] = '{:0.2f}\n'.format) -> None:
+    """
+    Format the averages, and write them out `block` lines at a time.
+    :param averages: The average vertex degrees
+    :param out: The file to write to
+    :param block: The number of lines in a write
+    :param fmt: Format an average as a line
+    """
+    averages = iter(averages)
+    for chunk in iter(lambda: list(itertools.islice(averages, block)), []):
+        out.write(''.join(map(fmt, chunk)))
+        out.flush()
+
+
+def parse_args() -> Tuple[argparse.ArgumentParser, argparse.Namespace]:
+    """
+    Parse the command line of main().
+    :return: The parser, to report errors with, and the arguments
     """
     pcmd = argparse.ArgumentParser()
-    pcmd.add_argument('window', type=int, help='window for rolling average')
+    pcmd.add_argument('window', type=int, nargs='*', help='window for rolling average')
+    pcmd.add_argument('--engine', choices=sorted(ENGINES), default='heap',
+                      help='the data structure used to evict old edges')
+    pcmd.add_argument('--input', nargs='+', metavar='PATH',
+                      help='read the given files or globs (optionally .gz, .bz2 or .xz) instead of stdin')
+    pcmd.add_argument('--prefetch', action='store_true',
+                      help='decompress the input files ahead on a background thread')
+    pcmd.add_argument('--replay', metavar='PATH',
+                      help='process the plain file at PATH in segments on --workers processes')
+    pcmd.add_argument('--segments', type=int, default=0,
+                      help='the number of segments of --replay (4 per worker by default)')
+    pcmd.add_argument('--timestamp-ms', action='store_true',
+                      help='use the timestamp_ms field of tweets when present')
+    pcmd.add_argument('--extract', action='store_true',
+                      help='extract only the needed fields instead of decoding whole tweets')
+    pcmd.add_argument('--workers', type=int, default=1,
+                      help='the number of processes parsing tweets')
+    pcmd.add_argument('--shards', type=int, default=0,
+                      help='split the graph across this many processes by hashtag')
+    pcmd.add_argument('--approximate', type=int, nargs='?', const=12, default=0, metavar='PRECISION',
+                      help='estimate the average in fixed memory with sketches of 2^PRECISION registers')
+    pcmd.add_argument('--offline', nargs='?', const='', metavar='CLEANED',
+                      help='compute the whole series at once with numpy, from the input or from the '
+                           'records of bin/cleanit.py in CLEANED')
+    pcmd.add_argument('--output-block', type=int, default=OUTPUT_BLOCK,
+                      help='the number of averages written at a time (1 for live streams)')
+    sampling = pcmd.add_mutually_exclusive_group()
+    sampling.add_argument('--changes', dest='sample', action='store_const', const='changes',
+                          help='write the tweet index and average only when the average changes')
+    sampling.add_argument('--per-second', dest='sample', action='store_const', const='second',
+                          help='write the second and the average at the end of each second of event time')
+    sampling.add_argument('--every', type=int, metavar='N',
+                          help='write the tweet index and average after every N tweets')
+    pcmd.add_argument('--snapshot', metavar='PATH',
+                      help='save snapshots of the graph to PATH periodically, on SIGUSR1, and on exit')
+    pcmd.add_argument('--snapshot-every', type=float, default=10, metavar='SECONDS',
+                      help='the interval between periodic snapshots')
+    pcmd.add_argument('--restore', metavar='PATH',
+                      help='start from the graph saved in the snapshot at PATH')
+    pcmd.add_argument('--max-memory', type=parse_size, default=0, metavar='SIZE',
+                      help='shed the oldest edges when the graph holds more than about SIZE bytes (e.g. 512M)')
+    pcmd.add_argument('--query', action='append', nargs='+', metavar='ARG',
+                      help='PATH WINDOW [FIELD=VALUE[,VALUE...]...]: feed a graph with the tweets whose '
+                           'fields (e.g. lang or place.country_code) have one of the values, or that have one of '
+                           'the hashtags= hashtags, writing its averages to PATH (- for stdout)')
+    pcmd.add_argument('--lookup', action='append', metavar='TAG',
+                      help='write the degree and neighbors of TAG to stderr on SIGUSR2 and on exit (repeatable)')
+    pcmd.add_argument('--stats', action='store_true',
+                      help='write a line of metrics to stderr periodically and on exit')
+    pcmd.add_argument('--metrics', metavar='PATH',
+                      help='write the metrics to PATH in the prometheus text format periodically and on exit')
+    pcmd.add_argument('--stats-every', type=float, default=10, metavar='SECONDS',
+                      help='the interval between two reports of the metrics')
     args = pcmd.parse_args()
-    tweetgraph = TweetGraph(0, args.window)
-    for line in sys.stdin:
-        tweet = get_tweet(line)
-        # Do not print rolling average in case this is not a valid tweet
-        if tweet:
-            print('{:0.2f}'.format(tweetgraph.process_tweet(tweet)))
+    if not args.window and not args.query:
+        pcmd.error('the following arguments are required: window')
+    if any(window < 1 for window in args.window):
+        pcmd.error('the window must be a positive number of seconds')
+    if args.every is not None:
+        if args.every < 1:
+            pcmd.error('--every needs a positive number of tweets')
+        args.sample = 'every'
+    check_conflicts(pcmd, args)
+    return pcmd, args
+
+
+def check_conflicts(pcmd: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """
+    Report the first pair of options given that cannot be combined (see
+    CONFLICTS).
+    """
+    given = {name for name, value in vars(args).items() if value and value != pcmd.get_default(name)}
+    if args.offline is not None:
+        given.add('offline')
+    if args.offline:
+        given.add('cleaned')
+    if len(args.window) > 1:
+        given.add('windows')
+    if args.metrics:
+        given.add('stats')
+    for option, others, message in CONFLICTS:
+        if option in given and given.intersection(others):
+            pcmd.error(message)
+
+
+def write_output(graph: Any, records: Iterator[Any], args: argparse.Namespace, metrics: Optional[Metrics],
+                 fmt: Callable[[Any], str]) -> None:
+    """
+    Write the averages of the graph over the records to stdout, sampled
+    as the arguments ask, and report the metrics if any.
+    """
+    if metrics is not None:
+        reporter = StatsReporter(graph, metrics, args.stats_every, sys.stderr if args.stats else None, args.metrics)
+        records = reporter.records(records)
+    if not args.sample:
+        write_averages(graph.averages(records), sys.stdout, args.output_block, fmt)
+        return
+    samples = sample_averages(graph, records, args.sample, args.every or 1, fmt)
+    write_averages(samples, sys.stdout, args.output_block, lambda sample: '%d %s' % (sample[0], fmt(sample[1])))
+
+
+def run_queries(pcmd: argparse.ArgumentParser, args: argparse.Namespace, lines: Iterable[str],
+                fmt: Callable[[Any], str]) -> None:
+    """
+    Feed the graph of each --query with its tweets, writing its averages
+    to its own output.
+    """
+    try:
+        specs = [parse_query(spec) for spec in args.query]
+    except ValueError as error:
+        pcmd.error(str(error))
+    fields = sorted({field for _, _, conditions in specs for field in conditions} - {'hashtags'})
+    outputs = []  # type: List[Any]
+    try:
+        for path, _, _ in specs:
+            outputs.append(sys.stdout if path == '-' else open(path, 'w'))
+        queries = [Query(ENGINES[args.engine](0, window), conditions, fields, out)
+                   for (_, window, conditions), out in zip(specs, outputs)]
+        fan_out(queries, read_records(lines, args.workers, args.timestamp_ms, args.extract,
+                                      fields=tuple(fields)), fmt)
+    except ValueError as error:
+        pcmd.error(str(error))
+    finally:
+        for out in outputs:
+            if out is not sys.stdout:
+                out.close()
+
+
+def run_offline(args: argparse.Namespace, lines: Iterable[str], fmt: Callable[[Any], str]) -> None:
+    """
+    Compute the whole series of averages at once with numpy.
+    """
+    # Imported here since numpy is only needed by the offline engine.
+    from offline import load_cleaned, load_records, offline_averages
+    if args.offline:
+        tweets = load_cleaned(args.offline)
+    else:
+        tweets = load_records(read_records(lines, args.workers, args.timestamp_ms, args.extract))
+    write_averages(offline_averages(tweets, args.window), sys.stdout, args.output_block,
+                   format_columns if len(args.window) > 1 else fmt)
+
+
+def run_replay(args: argparse.Namespace) -> None:
+    """
+    Process the --replay file in segments on several processes.
+    """
+    # Imported here since the replay is built on this module.
+    from replay import replay
+    for text in replay(args.replay, args.window[0], args.workers, args.engine, args.segments,
+                       args.timestamp_ms, args.extract):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+
+def run_graph(pcmd: argparse.ArgumentParser, args: argparse.Namespace, lines: Iterable[str],
+              metrics: Optional[Metrics], fmt: Callable[[Any], str]) -> None:
+    """
+    Feed a single graph in this process: of several windows, restored from
+    a snapshot, or of the given engine.
+    """
+    if len(args.window) > 1:
+        # Several windows always share a timing wheel.
+        tweetgraph = MultiWindowTweetGraph(0, args.window)  # type: TweetGraph
+        fmt = format_columns
+    elif args.restore:
+        tweetgraph = ENGINES[args.engine].restore(load_snapshot(args.restore))
+        if tweetgraph.window != args.window[0]:
+            pcmd.error('the snapshot has a window of %d' % tweetgraph.window)
+    else:
+        tweetgraph = ENGINES[args.engine](0, args.window[0])
+    tweetgraph.max_memory = args.max_memory
+    # Invalid tweets are dropped by read_records, so that we do not
+    # print the rolling average for them.
+    records = read_records(lines, args.workers, args.timestamp_ms, args.extract, metrics)
+    snapshotter = None
+    if args.snapshot:
+        snapshotter = Snapshotter(tweetgraph, args.snapshot, args.snapshot_every)
+        signal.signal(signal.SIGUSR1, snapshotter.request)
+        records = snapshotter.records(records)
+    if args.lookup:
+        lookup = Lookup(tweetgraph, args.lookup, sys.stderr)
+        signal.signal(signal.SIGUSR2, lookup.request)
+        records = lookup.records(records)
+    write_output(tweetgraph, records, args, metrics, fmt)
+    if snapshotter:
+        snapshotter.close()
+
+
+def main():
+    """
+    The entry point. We take one or more window lengths, and write an
+    average per tweet to stdout, in a column for each window. The tweets
+    are read from stdin, or from the --input files. Instead of windows,
+    each --query names its own window, filter and output file. The output
+    can be sampled (--changes, --per-second, --every), and the averages
+    computed by another mode: --offline, --replay, --shards or
+    --approximate (see parse_args and CONFLICTS).
+    """
+    pcmd, args = parse_args()
+    fmt = '{:0.2f}\n'.format
+    metrics = Metrics() if args.stats or args.metrics else None
+    lines = sys.stdin  # type: Iterable[str]
+    if args.input:
+        try:
+            lines = read_inputs(expand_inputs(args.input), args.prefetch)
+        except (OSError, EOFError, ValueError) as error:
+            pcmd.error(str(error))
+    if args.query:
+        run_queries(pcmd, args, lines, fmt)
+    elif args.offline is not None:
+        run_offline(args, lines, fmt)
+    elif args.replay:
+        run_replay(args)
+    elif args.shards:
+        # Imported here since the shards are built on this module.
+        from sharded import ShardedTweetGraph
+        with ShardedTweetGraph(0, args.window[0], args.shards) as sharded:
+            write_output(sharded, read_records(lines, args.workers, args.timestamp_ms, args.extract, metrics),
+                         args, metrics, fmt)
+    elif args.approximate:
+        # Imported here since the sketches are built on this module.
+        from approximate import ApproximateTweetGraph
+        approximate = ApproximateTweetGraph(0, args.window[0], args.approximate)
+        write_output(approximate, read_records(lines, args.workers, args.timestamp_ms, args.extract, metrics),
+                     args, metrics, fmt)
+    else:
+        run_graph(pcmd, args, lines, metrics, fmt)
+
 
 if __name__ == "__main__":
     main()
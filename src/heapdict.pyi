@@ -1,19 +0,0 @@
-# Stubs for heapdict (Python 3.5)
-#
-# NOTE: This dynamically typed stub was automatically generated by stubgen.
-
-from typing import Any
-import collections
-
-class heapdict(collections.MutableMapping):
-    heap = ... # type: Any
-    d = ... # type: Any
-    def __init__(self, *args, **kw): ...
-    def clear(self): ...
-    def __setitem__(self, key, value): ...
-    def __delitem__(self, key): ...
-    def __getitem__(self, key): ...
-    def __iter__(self): ...
-    def popitem(self): ...
-    def __len__(self): ...
-    def peekitem(self): ...
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+This module computes the whole series of rolling averages of an archived
+file at once with NumPy, instead of updating a graph tweet by tweet.
+"""
+import struct
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+# The header of a record written by bin/cleanit.py (see bin/tweet.py):
+# uint64be created_at, uint8 len, followed by int64be nodes[len].
+CLEANED_HEADER = struct.Struct('>QB')
+CLEANED_NODE = 8
+
+# The tweets as arrays: the creation time of each tweet, the offsets of
+# its hashtags in the tags array, and the dense hashtag ids.
+Tweets = Tuple[Any, Any, Any]
+
+
+def load_records(records: Iterable[Tuple[int, List[str]]]) -> Tweets:
+    """
+    Load parsed records into arrays, interning their hashtags.
+    :param records: (ctime, hashtags) records, as given by trim_tweet
+    :return: The (ctimes, offsets, tags) arrays
+    """
+    ids: Dict[str, int] = {}
+    ctimes = []  # type: List[int]
+    lengths = []  # type: List[int]
+    tags = []  # type: List[int]
+    for ctime, htags in records:
+        ctimes.append(ctime)
+        lengths.append(len(htags))
+        tags.extend(ids.setdefault(tag, len(ids)) for tag in htags)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return np.array(ctimes, dtype=np.int64), offsets, np.array(tags, dtype=np.int64)
+
+
+def load_cleaned(path: str) -> Tweets:
+    """
+    Load a file of the binary records written by bin/cleanit.py. Only the
+    headers are walked one at a time; the hashtags are gathered at once,
+    and the 64 bit hashes of cleanit.py are mapped to dense ids.
+    :param path: The file of records
+    :return: The (ctimes, offsets, tags) arrays
+    """
+    with open(path, 'rb') as cleaned:
+        buf = cleaned.read()
+    ctimes = []  # type: List[int]
+    lengths = []  # type: List[int]
+    starts = []  # type: List[int]
+    offset = 0
+    while offset + CLEANED_HEADER.size <= len(buf):
+        ctime, length = CLEANED_HEADER.unpack_from(buf, offset)
+        offset += CLEANED_HEADER.size
+        if offset + length * CLEANED_NODE > len(buf):
+            break
+        ctimes.append(ctime)
+        lengths.append(length)
+        starts.append(offset)
+        offset += length * CLEANED_NODE
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    # The nodes of each record are contiguous, so dropping the headers
+    # leaves them all in order: mark where the nodes of each record start
+    # and end, and keep the bytes in between.
+    first = np.array(starts, dtype=np.int64)
+    bounds = np.zeros(len(buf) + 1, dtype=np.int8)
+    bounds[first] = 1
+    bounds[first + np.diff(offsets) * CLEANED_NODE] -= 1
+    inside = np.cumsum(bounds[:-1], dtype=np.int8).view(bool)
+    nodes = np.frombuffer(buf, dtype=np.uint8)[inside].view('>i8')
+    _, tags = np.unique(nodes, return_inverse=True)
+    return np.array(ctimes, dtype=np.int64), offsets, tags.astype(np.int64)
+
+
+def edge_occurrences(tweets: Tweets, accepted: Any) -> Tuple[Any, Any, Any]:
+    """
+    The edges added by the accepted tweets. The tweets are grouped by
+    their number of hashtags, so that the pairs of each group are taken
+    with a single index of a (tweets, hashtags) matrix.
+    :param tweets: The (ctimes, offsets, tags) arrays
+    :param accepted: A boolean mask of the tweets within the window
+    :return: The (steps, lefts, rights) arrays: the index of the tweet
+    and the smaller and larger hashtag ids of each edge
+    """
+    _, offsets, tags = tweets
+    lengths = np.diff(offsets)
+    steps, lefts, rights = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for length in np.unique(lengths[accepted]):
+        if length < 2:
+            continue
+        rows = np.flatnonzero(accepted & (lengths == length))
+        matrix = tags[offsets[rows][:, None] + np.arange(length)]
+        first, second = np.triu_indices(length, 1)
+        steps.append(np.repeat(rows, len(first)))
+        lefts.append(np.minimum(matrix[:, first], matrix[:, second]).ravel())
+        rights.append(np.maximum(matrix[:, first], matrix[:, second]).ravel())
+    return np.concatenate(steps), np.concatenate(lefts), np.concatenate(rights)
+
+
+def coverage(groups: Any, starts: Any, ends: Any, count: int) -> Any:
+    """
+    Count, at every step, the groups covered by at least one of their
+    [start, end) intervals. The intervals of each group are sorted by
+    start, and merged where they overlap: an interval starts a new run
+    unless it starts before the largest end seen so far in its group.
+    :param groups: The group of each interval
+    :param starts: The first step of each interval
+    :param ends: The step after the last one of each interval
+    :param count: The number of steps
+    :return: The number of covered groups at each step
+    """
+    if not len(groups):
+        return np.zeros(count, dtype=np.int64)
+    order = np.lexsort((starts, groups))
+    groups, starts, ends = groups[order], starts[order], ends[order]
+    first = np.ones(len(groups), dtype=bool)
+    first[1:] = groups[1:] != groups[:-1]
+    # A running maximum of the ends that restarts with each group, by
+    # lifting every group above the ends of the earlier ones.
+    lift = np.cumsum(first) * (count + 1)
+    reach = np.maximum.accumulate(ends + lift) - lift
+    run = first.copy()
+    run[1:] |= starts[1:] > reach[:-1]
+    last = np.ones(len(groups), dtype=bool)
+    last[:-1] = run[1:]
+    changes = np.bincount(starts[run], minlength=count + 1)
+    changes -= np.bincount(reach[last], minlength=count + 1)
+    return np.cumsum(changes)[:count]
+
+
+def average_degrees(tweets: Tweets, window: int, curtime: int = 0) -> Any:
+    """
+    Compute the rolling average vertex degree after each tweet, as
+    TweetGraph.averages would.
+
+    The latest time after each tweet is the running maximum of the
+    creation times, since a dropped tweet is older than the latest time.
+    A tweet is dropped when it is not within the window of the latest
+    time before it. An edge added at step s with time t stays live until
+    the latest time reaches t + window, a step found by a binary search
+    of the latest times; later tweets only extend that with intervals of
+    their own. The edges live at a step are those with an interval
+    covering it, and the hashtags those with an edge live then.
+    :param tweets: The (ctimes, offsets, tags) arrays
+    :param window: The sliding window
+    :param curtime: The starting time
+    :return: The average vertex degree after each tweet
+    """
+    ctimes = tweets[0]
+    count = len(ctimes)
+    latest = np.maximum.accumulate(np.concatenate(([curtime], ctimes)))
+    accepted = ctimes > latest[:-1] - window
+    latest = latest[1:]
+    steps, lefts, rights = edge_occurrences(tweets, accepted)
+    ends = np.searchsorted(latest, ctimes[steps] + window, side='left')
+    edges = coverage(lefts * (int(rights.max(initial=0)) + 1) + rights, steps, ends, count)
+    nodes = coverage(np.concatenate((lefts, rights)), np.concatenate((steps, steps)),
+                     np.concatenate((ends, ends)), count)
+    return np.where(edges > 0, 2.0 * edges / np.maximum(nodes, 1), 0.0)
+
+
+def offline_averages(tweets: Tweets, windows: List[int]) -> Iterable[Any]:
+    """
+    The averages of one or more windows, as the output of main expects:
+    floats for a single window, and tuples of floats for several.
+    """
+    series = [average_degrees(tweets, window).tolist() for window in windows]
+    if len(series) == 1:
+        return series[0]
+    return zip(*series)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+This module replays an archived file of tweets in parallel, by splitting
+it into segments that are processed by separate processes, and stitching
+their averages together into the output of a sequential run.
+"""
+import multiprocessing
+import os
+from multiprocessing.pool import AsyncResult
+from typing import Iterator, List, Tuple
+
+from average_degree import ENGINES, TweetGraph, get_tweet
+
+# The number of segments given to each worker, so that a slow segment
+# does not hold the others back.
+SEGMENTS_PER_WORKER = 4
+# The number of kept records above which scan_segment drops the old ones.
+TAIL_PRUNE = 10000
+
+
+def split_file(path: str, segments: int) -> List[Tuple[int, int]]:
+    """
+    Split a file into byte ranges of about the same size, at line ends.
+    :param path: The input file
+    :param segments: The number of ranges wanted
+    :return: (start, end) of each range, fewer if the file is small
+    """
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as input_file:
+        for segment in range(1, segments):
+            input_file.seek(segment * size // segments)
+            input_file.readline()
+            offset = input_file.tell()
+            if offsets[-1] < offset < size:
+                offsets.append(offset)
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
+
+
+def read_segment(path: str, start: int, end: int, use_timestamp_ms: bool = False,
+                 extract: bool = False) -> Iterator[Tuple[int, List[str]]]:
+    """
+    Parse the records of the lines in the given byte range.
+    """
+    with open(path, 'rb') as input_file:
+        input_file.seek(start)
+        while input_file.tell() < end:
+            tweet = get_tweet(input_file.readline().decode('utf-8', 'replace'), use_timestamp_ms, extract)
+            if tweet:
+                yield TweetGraph.trim_tweet(tweet)
+
+
+def scan_segment(path: str, start: int, end: int, window: int, use_timestamp_ms: bool = False,
+                 extract: bool = False) -> Tuple[int, List[Tuple[int, List[str]]]]:
+    """
+    Find the latest creation time of a segment, and the records that may
+    still be live after it: those within the window of that time.
+    :return: The latest time (0 if none), and those records in order.
+    """
+    latest = 0
+    tail = []  # type: List[Tuple[int, List[str]]]
+    pruned = 0
+    for record in read_segment(path, start, end, use_timestamp_ms, extract):
+        latest = max(latest, record[0])
+        if latest - record[0] < window:
+            tail.append(record)
+        if len(tail) > pruned + TAIL_PRUNE:
+            tail = [kept for kept in tail if latest - kept[0] < window]
+            pruned = len(tail)
+    return latest, [kept for kept in tail if latest - kept[0] < window]
+
+
+def replay_segment(path: str, start: int, end: int, window: int, engine: str,
+                   warmup: List[Tuple[int, List[str]]], use_timestamp_ms: bool = False,
+                   extract: bool = False) -> str:
+    """
+    Process a segment on a graph warmed up with the records still live at
+    its start, and return its output.
+    """
+    graph = ENGINES[engine](0, window)
+    for ctime, htags in warmup:
+        graph.update_hashtags(ctime, htags)
+    averages = graph.averages(read_segment(path, start, end, use_timestamp_ms, extract))
+    return ''.join(map('{:0.2f}\n'.format, averages))
+
+
+def replay(path: str, window: int, workers: int, engine: str = 'heap', segments: int = 0,
+           use_timestamp_ms: bool = False, extract: bool = False) -> Iterator[str]:
+    """
+    Compute the averages of a file as a sequential run would, processing
+    its segments in parallel.
+
+    Before a segment, the sequential run has seen the latest time L of
+    all the earlier records: a record that is dropped is older than the
+    latest time when it arrives, so it does not change it either. Every
+    earlier record newer than L - window was accepted, since the latest
+    time was at most L when it arrived, and these records make up the
+    graph at the start of the segment, older edges having been evicted
+    when L was reached. A segment is thus warmed up with those records,
+    taken from the tails found by a first pass over all the segments.
+    :param path: The input file, which must be seekable
+    :param window: The sliding window
+    :param workers: The number of processes
+    :param engine: The engine of the graphs (see ENGINES)
+    :param segments: The number of segments, SEGMENTS_PER_WORKER per
+    worker by default
+    :param use_timestamp_ms: See get_tweet
+    :param extract: See get_tweet
+    :return: An iterator over the output of each segment, in order
+    """
+    ranges = split_file(path, segments or workers * SEGMENTS_PER_WORKER)
+    with multiprocessing.Pool(workers) as pool:
+        scans = pool.starmap(scan_segment, [(path, start, end, window, use_timestamp_ms, extract)
+                                            for start, end in ranges])
+        tasks: List[AsyncResult] = []
+        latest = 0
+        for (start, end), (segment_latest, _) in zip(ranges, scans):
+            cutoff = latest - window
+            warmup = [record for tail_latest, tail in scans[:len(tasks)] if tail_latest > cutoff
+                      for record in tail if record[0] > cutoff]
+            tasks.append(pool.apply_async(replay_segment, (path, start, end, window, engine, warmup,
+                                                           use_timestamp_ms, extract)))
+            latest = max(latest, segment_latest)
+        for task in tasks:
+            yield task.get()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+This module keeps a TweetGraph warm in a long running process. Producers
+send newline delimited tweets to an ingest socket, and the current average
+and statistics are answered on a separate query socket.
+"""
+import argparse
+import asyncio
+import json
+import sys
+from typing import Any, Dict, List, Optional, Set, Tuple, cast
+
+from average_degree import ENGINES, LOG, Metrics, TweetGraph, format_prometheus, get_tweet, parse_size
+
+# The number of parsed tweets waiting for the update loop before the
+# producers are pushed back on.
+QUEUE_SIZE = 10000
+# The number of tweets applied before the update loop lets queries through.
+UPDATE_BATCH = 100
+# The longest line accepted on either socket.
+LINE_LIMIT = 1 << 20
+
+
+class GraphServer:
+    """
+    Apply tweets from many producers to a single TweetGraph. Each ingest
+    connection parses its lines and puts the records on a bounded queue,
+    which a single update loop drains into the graph. When the queue is
+    full, the connections stop reading, and the producers are held back by
+    their sockets. Queries only read counts maintained by the graph, so
+    they are answered between two batches of updates. Lines are parsed on
+    the event loop too, so a query waits for the line being parsed, but
+    not for the rest of a producer's tweets.
+    """
+    def __init__(self, graph: TweetGraph, queue_size: int = QUEUE_SIZE,
+                 use_timestamp_ms: bool = False, extract: bool = False) -> None:
+        """
+        Initialize the GraphServer
+        :param graph: The graph to be updated
+        :param queue_size: The number of records waiting for the update loop
+        :param use_timestamp_ms: See get_tweet
+        :param extract: See get_tweet
+        """
+        self.graph = graph
+        # The metrics are always served, so the gc is timed.
+        self.graph.timed = True
+        self.queue = asyncio.Queue(queue_size)  # type: asyncio.Queue
+        self.use_timestamp_ms = use_timestamp_ms
+        self.extract = extract
+        self.metrics = Metrics()
+        self.processed = 0
+        self.invalid = 0
+        self.producers = 0
+        self.servers = []  # type: List[Any]
+        self.connections: Set[asyncio.Task] = set()
+
+    async def handle_ingest(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Read tweets from a producer, one per line. A line longer than
+        LINE_LIMIT is counted as invalid and closes the connection.
+        """
+        self.producers += 1
+        # A handler always runs in a task of its own.
+        task = cast(asyncio.Task, asyncio.current_task())
+        self.connections.add(task)
+        try:
+            async for line in reader:
+                tweet = get_tweet(line.decode('utf-8', 'replace'), self.use_timestamp_ms, self.extract, self.metrics)
+                self.metrics.lines += 1
+                if tweet:
+                    await self.queue.put(TweetGraph.trim_tweet(tweet))
+                else:
+                    self.invalid += 1
+                    self.metrics.invalid += 1
+        except ValueError:
+            # The stream reader raises ValueError for a line over its limit,
+            # and can not resynchronize on the next line.
+            LOG.warning('closing a producer that sent a line over %d bytes', LINE_LIMIT)
+            self.invalid += 1
+            self.metrics.invalid += 1
+        except asyncio.CancelledError:
+            # The server is stopping, see serve.
+            pass
+        finally:
+            self.producers -= 1
+            self.connections.discard(task)
+            writer.close()
+
+    async def update_loop(self) -> None:
+        """
+        Apply the queued records to the graph, in the order they arrived.
+        """
+        while True:
+            ctime, htags = await self.queue.get()
+            self.graph.update_hashtags(ctime, htags)
+            self.processed += 1
+            for _ in range(UPDATE_BATCH - 1):
+                if self.queue.empty():
+                    break
+                ctime, htags = self.queue.get_nowait()
+                self.graph.update_hashtags(ctime, htags)
+                self.processed += 1
+            await asyncio.sleep(0)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        The current state of the graph and of the server.
+        """
+        return {
+            'average': round(self.graph.avg_vdegree, 2),
+            'edges': len(self.graph.edges),
+            'nodes': self.graph.node_count,
+            'latest': self.graph.latest,
+            'window': self.graph.window,
+            'processed': self.processed,
+            'invalid': self.invalid,
+            'queued': self.queue.qsize(),
+            'producers': self.producers,
+        }
+
+    def answer(self, query: str) -> str:
+        """
+        Answer a single query.
+        :param query: `avg`, `stats`, `metrics`, `top K` for the K hashtags
+        with the highest degree, `degree TAG` for the degree of a hashtag, or
+        `neighbors TAG` for its neighbors with the last time of their edge
+        :return: The answer, without the newline. The metrics span several
+        lines in the prometheus text format, and end with a `# EOF` line.
+        """
+        command, _, argument = query.partition(' ')
+        if command == 'top' and argument.isdigit():
+            return json.dumps(self.graph.top_hashtags(int(argument)))
+        if command == 'degree' and argument:
+            return str(self.graph.hashtag_degree(argument))
+        if command == 'neighbors' and argument:
+            return json.dumps(self.graph.neighbors(argument), sort_keys=True)
+        if query == 'avg':
+            return '{:0.2f}'.format(self.graph.avg_vdegree)
+        if query == 'stats':
+            return json.dumps(self.stats(), sort_keys=True)
+        if query == 'metrics':
+            self.metrics.queue_depth = self.queue.qsize()
+            return format_prometheus(self.metrics.sample(self.graph)) + '# EOF'
+        return 'error: unknown query %r' % query
+
+    async def handle_query(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Answer queries from a client, one per line. A line longer than
+        LINE_LIMIT closes the connection.
+        """
+        task = cast(asyncio.Task, asyncio.current_task())
+        self.connections.add(task)
+        try:
+            async for line in reader:
+                writer.write((self.answer(line.decode('utf-8', 'replace').strip()) + '\n').encode('utf-8'))
+                await writer.drain()
+        except ValueError:
+            LOG.warning('closing a client that sent a line over %d bytes', LINE_LIMIT)
+        except (asyncio.CancelledError, ConnectionError):
+            # The server is stopping (see serve), or the client went away.
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def start(self, ingest: str, query: str) -> None:
+        """
+        Start listening on both sockets.
+        :param ingest: The address of the ingest socket (see listen)
+        :param query: The address of the query socket (see listen)
+        """
+        self.servers = [await listen(self.handle_ingest, ingest),
+                        await listen(self.handle_query, query)]
+
+    def addresses(self) -> List[Any]:
+        """
+        The addresses the ingest and query sockets are bound to.
+        """
+        return [server.sockets[0].getsockname() for server in self.servers]
+
+    async def serve(self, ingest: str, query: str) -> None:
+        """
+        Serve until cancelled. The connections still open are then
+        cancelled, and closed by their handlers.
+        """
+        await self.start(ingest, query)
+        LOG.warning('ingest on %s, queries on %s', *self.addresses())
+        try:
+            await self.update_loop()
+        finally:
+            for server in self.servers:
+                server.close()
+            connections = list(self.connections)
+            for connection in connections:
+                connection.cancel()
+            await asyncio.gather(*connections, return_exceptions=True)
+            for server in self.servers:
+                await server.wait_closed()
+
+
+def parse_address(address: str) -> Tuple[Optional[str], Any]:
+    """
+    Split an address into a host and a port, or a unix socket path.
+    :param address: `host:port`, or a path containing a `/`
+    :return: (host, port) for TCP, or (None, path) for a unix socket
+    """
+    if '/' in address:
+        return None, address
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+async def listen(handler: Any, address: str) -> Any:
+    """
+    Start a server calling handler for each connection to the address.
+    """
+    host, port = parse_address(address)
+    if host is None:
+        return await asyncio.start_unix_server(handler, port, limit=LINE_LIMIT)
+    return await asyncio.start_server(handler, host, port, limit=LINE_LIMIT)
+
+
+def main():
+    """
+    The entry point. We require the window length, and serve until
+    interrupted.
+    """
+    pcmd = argparse.ArgumentParser()
+    pcmd.add_argument('window', type=int, help='window for rolling average')
+    pcmd.add_argument('--ingest', default='127.0.0.1:9000',
+                      help='host:port or unix socket path accepting tweets')
+    pcmd.add_argument('--query', default='127.0.0.1:9001',
+                      help='host:port or unix socket path answering avg, stats, metrics, top, degree and neighbors')
+    pcmd.add_argument('--engine', choices=sorted(ENGINES), default='heap',
+                      help='the data structure used to evict old edges')
+    pcmd.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                      help='the number of tweets waiting for the update loop')
+    pcmd.add_argument('--timestamp-ms', action='store_true',
+                      help='use the timestamp_ms field of tweets when present')
+    pcmd.add_argument('--extract', action='store_true',
+                      help='extract only the needed fields instead of decoding whole tweets')
+    pcmd.add_argument('--max-memory', type=parse_size, default=0, metavar='SIZE',
+                      help='shed the oldest edges when the graph holds more than about SIZE bytes (e.g. 512M)')
+    args = pcmd.parse_args()
+
+    async def run() -> None:
+        graph = ENGINES[args.engine](0, args.window)
+        graph.max_memory = args.max_memory
+        server = GraphServer(graph, args.queue_size, args.timestamp_ms, args.extract)
+        await server.serve(args.ingest, args.query)
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
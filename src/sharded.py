@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+This module spreads the rolling average vertex degree computation over
+several processes, each of which owns the hashtags with a given hash.
+"""
+import itertools
+import multiprocessing
+import zlib
+from array import array
+from typing import Dict, List, Tuple, Iterable, Iterator, Optional, Any, cast
+
+from average_degree import WheelTweetGraph
+
+# The number of records routed to the shards at a time.
+BATCH_SIZE = 1000
+# The number of hashtags whose shard the coordinator remembers, beyond
+# which it forgets them all and starts over.
+OWNER_CACHE = 1 << 16
+
+
+def owner(tag: str, shards: int) -> int:
+    """
+    The shard that owns the given hashtag. We do not use hash() since it
+    is randomized for each process.
+    :param tag: The hashtag
+    :param shards: The number of shards
+    :return: The index of the shard
+    """
+    return zlib.crc32(tag.encode('utf-8')) % shards
+
+
+class ShardTweetGraph(WheelTweetGraph):
+    """
+    The part of the graph kept by a single shard. It holds every edge
+    incident on a hashtag it owns, so an edge between hashtags owned by
+    two shards is held by both, and evicted by both at the same time. The
+    shard counts the hashtags it owns, and the edges whose smaller hashtag
+    it owns, which makes both counts disjoint across the shards.
+    A shard only sees the records carrying its edges, so it cannot tell
+    after which record of the batch an edge expired. It reports each
+    eviction with the time at which the edge expired instead, and leaves
+    it to the coordinator to place it among the records.
+    """
+    def __init__(self, curtime: int, window: int, shard: int, shards: int) -> None:
+        """
+        Initialize the ShardTweetGraph
+        :param curtime: The starting time
+        :param window: The sliding window
+        :param shard: The index of this shard
+        :param shards: The number of shards
+        """
+        super().__init__(curtime, window)
+        self.shard = shard
+        self.shards = shards
+        self.owned_nodes = 0
+        self.owned_edges = 0
+        # The time at which the edge being removed expired.
+        self.expiry = 0
+        # (expiry, edges, nodes) triples, in the order of expiry.
+        self.evictions = array('q')
+
+    def owns(self, tag_id: int) -> bool:
+        """
+        Does this shard own the hashtag with the given id?
+        """
+        return owner(cast(str, self.tags[tag_id]), self.shards) == self.shard
+
+    def owns_edge(self, key: int) -> bool:
+        """
+        Does this shard own the edge with the given packed key?
+        """
+        return owner(min(self.edge_tags(key)), self.shards) == self.shard
+
+    def evict(self, edges: int, nodes: int) -> None:
+        """
+        Report owned edges and nodes that left at the current expiry.
+        """
+        evictions = self.evictions
+        if evictions and evictions[-3] == self.expiry:
+            evictions[-2] += edges
+            evictions[-1] += nodes
+        else:
+            evictions.extend((self.expiry, edges, nodes))
+
+    def intern(self, tag: str) -> int:
+        """
+        Get the id of the given hashtag, allocating one if necessary.
+        :param tag: The hashtag
+        :return: The id of the hashtag
+        """
+        if tag in self.tag_ids:
+            return self.tag_ids[tag]
+        tag_id = super().intern(tag)
+        if self.owns(tag_id):
+            self.owned_nodes += 1
+        return tag_id
+
+    def release(self, tag_id: int) -> None:
+        """
+        Free the id of a hashtag that is no longer part of any edge.
+        :param tag_id: The id of the hashtag
+        """
+        if self.owns(tag_id):
+            self.owned_nodes -= 1
+            self.evict(0, 1)
+        super().release(tag_id)
+
+    def add_key(self, ctime: int, key: int) -> None:
+        """
+        Add or update the edge with the given packed key.
+        :param ctime: The creation time of the tweet
+        :param key: The packed key of the edge
+        """
+        if key not in self.edges and self.owns_edge(key):
+            self.owned_edges += 1
+        super().add_key(ctime, key)
+
+    def remove_key(self, key: int) -> None:
+        """
+        Remove the edge with the given packed key.
+        :param key: The packed key of the edge
+        """
+        self.expiry = self.edges[key] + self.window
+        if self.owns_edge(key):
+            self.owned_edges -= 1
+            self.evict(1, 0)
+        super().remove_key(key)
+
+    def collect_garbage(self) -> None:
+        """
+        Perform garbage collection. Unlike the wheel, this sweeps the
+        buckets even after a long gap, since every eviction is reported.
+        """
+        cutoff = self.latest - self.window
+        if cutoff < self.frontier:
+            return
+        for second in range(self.frontier, min(cutoff, self.frontier + self.window - 1) + 1):
+            bucket = self.buckets[second % self.window]
+            for key in bucket:
+                if self.edges.get(key, None) == second:
+                    self.remove_key(key)
+            del bucket[:]
+        self.frontier = cutoff + 1
+
+    def process(self, batch: Tuple[int, List[Tuple[int, int, int, List[Tuple[str, str]]]]]) -> Tuple[array, array]:
+        """
+        Apply a batch of routed records.
+        :param batch: The watermark, which is the latest time after the
+        batch, and (index, latest, ctime, edges) for each record carrying
+        edges this shard has to hold, where index is its place in the batch.
+        :return: (index, edges, nodes) triples of the owned edges and nodes
+        added by each record, and (expiry, edges, nodes) triples of those
+        evicted during the batch.
+        """
+        watermark, records = batch
+        additions = array('q')
+        for index, latest, ctime, edges in records:
+            self.latest = latest
+            self.collect_garbage()
+            owned_edges, owned_nodes = self.owned_edges, self.owned_nodes
+            for edge in edges:
+                self.add_edge(ctime, edge)
+            additions.extend((index, self.owned_edges - owned_edges, self.owned_nodes - owned_nodes))
+        self.latest = watermark
+        self.collect_garbage()
+        evictions, self.evictions = self.evictions, array('q')
+        return additions, evictions
+
+
+def shard_worker(conn: Any, window: int, shard: int, shards: int) -> None:
+    """
+    The loop of a shard process. It applies the batches received on the
+    connection until it receives None.
+    """
+    graph = ShardTweetGraph(0, window, shard, shards)
+    while True:
+        batch = conn.recv()
+        if batch is None:
+            break
+        conn.send(graph.process(batch))
+    conn.close()
+
+
+class ShardedTweetGraph:
+    """
+    Compute the rolling average with the graph split across processes.
+    The coordinator decides which records are within the window, advances
+    `latest`, and routes every edge to the shards owning its hashtags.
+    Each batch carries `latest` after its last record as a watermark, up
+    to which the shards evict. The shards report what each record added
+    and when each eviction happened, and the coordinator sums these into
+    the counts of the whole graph. Records are routed in batches, and the
+    next batch is routed while the shards are busy.
+    """
+    def __init__(self, curtime: int, window: int, shards: int, batch: int = BATCH_SIZE) -> None:
+        """
+        Initialize the ShardedTweetGraph, starting the shard processes.
+        :param curtime: The starting time
+        :param window: The sliding window
+        :param shards: The number of shard processes
+        :param batch: The number of records routed at a time
+        """
+        self.latest = curtime
+        self.window = window
+        self.shards = shards
+        self.batch = batch
+        self.avg_vdegree = 0.0
+        self.edge_count = 0
+        self.node_count = 0
+        self.owners = {}  # type: Dict[str, int]
+        self.conns = []  # type: List[Any]
+        self.procs = []  # type: List[multiprocessing.Process]
+        for shard in range(shards):
+            parent, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=shard_worker, args=(child, window, shard, shards), daemon=True)
+            proc.start()
+            child.close()
+            self.conns.append(parent)
+            self.procs.append(proc)
+
+    def in_window(self, ctime: int) -> bool:
+        """
+        Is the passed in time within the window?
+        """
+        return False if (self.latest - ctime) >= self.window else True
+
+    def owner(self, tag: str) -> int:
+        """
+        The shard that owns the given hashtag, remembered for the hashtags
+        seen recently.
+        """
+        shard = self.owners.get(tag, None)
+        if shard is None:
+            if len(self.owners) >= OWNER_CACHE:
+                self.owners.clear()
+            shard = self.owners[tag] = owner(tag, self.shards)
+        return shard
+
+    def route(self, records: List[Tuple[int, List[str]]]) -> Tuple[List[Any], List[Optional[int]]]:
+        """
+        Split a batch of records between the shards. A shard is only sent
+        the records carrying edges it holds.
+        :param records: (ctime, hashtags) records, as given by trim_tweet
+        :return: The batch of each shard, and `latest` after each record,
+        or None for those that were not accepted.
+        """
+        routed = [[] for _ in range(self.shards)]  # type: List[List[Any]]
+        latests = []  # type: List[Optional[int]]
+        for index, (ctime, hashtags) in enumerate(records):
+            if not self.in_window(ctime):
+                latests.append(None)
+                continue
+            if ctime > self.latest:
+                self.latest = ctime
+            latests.append(self.latest)
+            if len(hashtags) < 2:
+                continue
+            edges = {}  # type: Dict[int, List[Tuple[str, str]]]
+            owners = [self.owner(tag) for tag in hashtags]
+            for (left, right), edge in zip(itertools.combinations(owners, 2), itertools.combinations(hashtags, 2)):
+                edges.setdefault(left, []).append(edge)
+                if right != left:
+                    edges.setdefault(right, []).append(edge)
+            for shard, shard_edges in edges.items():
+                routed[shard].append((index, self.latest, ctime, shard_edges))
+        return [(self.latest, shard_records) for shard_records in routed], latests
+
+    def collect(self, latests: List[Optional[int]]) -> Iterator[float]:
+        """
+        Gather the counts of the shards for a routed batch. An eviction
+        is counted from the first record whose `latest` reaches its expiry.
+        :param latests: `latest` after each record of the batch, or None
+        for those that were not accepted
+        :return: An iterator over the average after each record
+        """
+        additions = [0] * (2 * len(latests))
+        evictions = []  # type: List[Tuple[int, int, int]]
+        for conn in self.conns:
+            added, evicted = conn.recv()
+            for pos in range(0, len(added), 3):
+                index = 2 * added[pos]
+                additions[index] += added[pos + 1]
+                additions[index + 1] += added[pos + 2]
+            evictions.extend(zip(evicted[::3], evicted[1::3], evicted[2::3]))
+        evictions.sort()
+        pos = 0
+        for index, latest in enumerate(latests):
+            if latest is not None:
+                while pos < len(evictions) and evictions[pos][0] <= latest:
+                    self.edge_count -= evictions[pos][1]
+                    self.node_count -= evictions[pos][2]
+                    pos += 1
+                self.edge_count += additions[2 * index]
+                self.node_count += additions[2 * index + 1]
+                self.avg_vdegree = (2.0 * self.edge_count) / self.node_count if self.edge_count else 0
+            yield self.avg_vdegree
+
+    def averages(self, records: Iterable[Tuple[int, List[str]]]) -> Iterator[float]:
+        """
+        Process a stream of records, yielding the current average vertex
+        degree after each one.
+        :param records: (ctime, hashtags) records, as given by trim_tweet
+        :return: An iterator over the average vertex degrees
+        """
+        records = iter(records)
+        pending = None  # type: Optional[List[Optional[int]]]
+        for chunk in iter(lambda: list(itertools.islice(records, self.batch)), []):
+            batches, latests = self.route(chunk)
+            if pending is not None:
+                yield from self.collect(pending)
+            for conn, batch in zip(self.conns, batches):
+                conn.send(batch)
+            pending = latests
+        if pending is not None:
+            yield from self.collect(pending)
+
+    def process_batch(self, records: Iterable[Tuple[int, List[str]]]) -> List[float]:
+        """
+        Process a batch of records, and return the average vertex degree
+        after each one.
+        """
+        return list(self.averages(records))
+
+    def counters(self) -> Dict[str, float]:
+        """
+        The metrics known to the coordinator (see average_degree.METRICS).
+        """
+        return {'edges': self.edge_count, 'nodes': self.node_count,
+                'latest': self.latest, 'average': self.avg_vdegree}
+
+    def close(self) -> None:
+        """
+        Stop the shard processes.
+        """
+        for conn in self.conns:
+            conn.send(None)
+            conn.close()
+        for proc in self.procs:
+            proc.join()
+
+    def __enter__(self) -> 'ShardedTweetGraph':
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
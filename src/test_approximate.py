@@ -0,0 +1,99 @@
+import approximate
+import average_degree
+import random
+import unittest
+
+from io import StringIO
+from unittest.mock import patch
+
+
+class TestSlidingHyperLogLog(unittest.TestCase):
+    def setUp(self):
+        self.sketch = approximate.SlidingHyperLogLog(precision=10)
+
+    def test_precision(self):
+        """Should reject precisions outside of 4 to 16"""
+        with self.assertRaises(ValueError):
+            approximate.SlidingHyperLogLog(precision=3)
+
+    def test_count_small(self):
+        """Should count a few distinct items closely, ignoring repeats"""
+        for item in list(range(20)) * 3:
+            self.sketch.add(1000, approximate.mix(item))
+        self.assertAlmostEqual(self.sketch.count(), 20, delta=0.5)
+
+    def test_dominated(self):
+        """Should keep only the pairs that may become the largest rank"""
+        hashed = approximate.mix(7)
+        register = hashed & (self.sketch.registers - 1)
+        self.sketch.add(1000, hashed)
+        self.sketch.add(1001, hashed)
+        self.sketch.add(999, hashed)
+        self.assertEqual(list(self.sketch.times[register]), [1001])
+
+    def test_expire(self):
+        """Should forget the items of expired seconds, and all after a long gap"""
+        for item in range(10):
+            self.sketch.add(1000 + item % 2, approximate.mix(item))
+        self.sketch.expire(1000)
+        self.assertAlmostEqual(self.sketch.count(), 5, delta=0.5)
+        self.sketch.expire(5000)
+        self.assertEqual(self.sketch.count(), 0)
+        self.assertEqual(self.sketch.zeros, self.sketch.registers)
+
+    def test_expire_random(self):
+        """Should keep the largest live rank of each register, with late items and a bounded heap"""
+        rand = random.Random(2)
+        sketch = approximate.SlidingHyperLogLog(precision=4)
+        seen = []
+        latest = 0
+        for _ in range(3000):
+            latest += rand.choice((0, 0, 1, 3, 40))
+            ctime = latest - rand.choice((0, 0, 5, 30))
+            hashed = approximate.mix(rand.randrange(1 << 30))
+            seen.append((ctime, hashed))
+            sketch.add(ctime, hashed)
+            cutoff = latest - 60
+            sketch.expire(cutoff)
+            self.assertLessEqual(len(sketch.heap), 2 * sketch.registers)
+            if rand.random() < 0.05:
+                expected = [0] * sketch.registers
+                for time, item in seen:
+                    if time > cutoff:
+                        register = item & (sketch.registers - 1)
+                        rank = approximate.HASH_BITS - 4 - (item >> 4).bit_length() + 1
+                        expected[register] = max(expected[register], rank)
+                self.assertEqual(list(sketch.value), expected)
+
+
+class TestApproximateTweetGraph(unittest.TestCase):
+    def test_small(self):
+        """Should match the exact averages on a small graph"""
+        graph = approximate.ApproximateTweetGraph(0, 60)
+        averages = graph.process_batch([(100, ['A', 'B', 'C']), (101, ['C', 'D']),
+                                        (10, ['E', 'F']), (150, ['A']), (200, ['X', 'Y'])])
+        self.assertEqual(['%0.2f' % average for average in averages], ['2.00', '2.00', '2.00', '2.00', '1.00'])
+
+    def test_error_bound(self):
+        """Should stay within a few standard errors of the exact average"""
+        rand = random.Random(1)
+        records = [(second // 2, sorted({'t%d' % rand.randrange(3000) for _ in range(4)}))
+                   for second in range(6000)]
+        exact = average_degree.TweetGraph(0, 600).process_batch(records)
+        estimate = approximate.ApproximateTweetGraph(0, 600).process_batch(records)
+        errors = [abs(e - a) / e for e, a in zip(exact, estimate)]
+        self.assertLess(sum(errors) / len(errors), 0.03)
+        self.assertLess(max(errors), 0.1)
+
+    def test_main_approximate(self):
+        """Should estimate the average from the command line"""
+        line = '{"created_at":"Thu Nov 05 05:06:39 +0000 2015", "entities":{"hashtags":[{"text":"A"}, {"text":"B"}]}}'
+        with patch('sys.argv', ['', '60', '--approximate']), \
+             patch('sys.stdin', StringIO(line)), \
+             patch('sys.stdout', new=StringIO()) as fakeOutput:
+            average_degree.main()
+            self.assertEqual(fakeOutput.getvalue().strip(), '1.00')
+
+
+if __name__ == '__main__':
+    unittest.main()
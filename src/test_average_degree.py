@@ -1,4 +1,12 @@
 import average_degree
+import bz2
+import gc
+import gzip
+import lzma
+import os
+import random
+import tempfile
+import tracemalloc
 import unittest
 import json
 
@@ -21,11 +29,84 @@ class TestFunctions(unittest.TestCase):
     def test_get_tweet(self):
         """Should correctly recognize the created_at"""
         tweet1 = average_degree.get_tweet(self.json_1)
-        self.assertEqual(tweet1['ctime'], 1446728739)
+        self.assertEqual(tweet1['ctime'], 1446699939)
 
         tweet2 = average_degree.get_tweet(self.json_2)
         self.assertEqual(tweet2['ctime'] - tweet1['ctime'],  60)
 
+    def test_get_tweet_timestamp_ms(self):
+        """Should prefer timestamp_ms to created_at only when asked"""
+        line = '{"created_at":"Thu Nov 05 05:05:39 +0000 2015", "timestamp_ms":"1446699999277"}'
+        self.assertEqual(average_degree.get_tweet(line)['ctime'], 1446699939)
+        self.assertEqual(average_degree.get_tweet(line, True)['ctime'], 1446699999)
+        self.assertEqual(average_degree.get_tweet(self.json_1, True)['ctime'], 1446699939)
+
+    def test_parse_created_at(self):
+        """Should agree with strptime on the fixed layout"""
+        self.assertEqual(average_degree.parse_created_at('Mon Mar 28 23:23:12 +0000 2016'), 1459207392)
+        self.assertEqual(average_degree.parse_created_at('Mon Feb 29 00:00:00 +0000 2016'), 1456704000)
+        # strptime accepts a padded day, which does not fit the fixed layout.
+        self.assertEqual(average_degree.parse_created_at('Thu Nov  5 05:05:39 +0000 2015'), 1446699939)
+
+    def test_parse_created_at_invalid(self):
+        """Should reject creation times that strptime rejects"""
+        for created_at in ['Thu Nov 05', 'Thu Nov 31 05:05:39 +0000 2015',
+                           'Thu Nov 05 24:05:39 +0000 2015', 'Thu Nov 05 05:05:39 +0100 2015']:
+            with self.assertRaises(ValueError):
+                average_degree.parse_created_at(created_at)
+
+    def test_extract_tweet(self):
+        """Should extract the fields of a tweet that starts with created_at"""
+        line = ('{"created_at":"Thu Nov 05 05:06:39 +0000 2015","text":"#A \\"hashtags\\": #B",'
+                '"user":{"created_at":"Mon Mar 08 00:04:07 +0000 2010"},'
+                '"entities":{"hashtags":[{"text":"A","indices":[0,2]},{"text":"B","indices":[3,5]}]},'
+                '"timestamp_ms":"1446699999277"}\n')
+        j = average_degree.extract_tweet(line)
+        self.assertEqual(j, {'created_at': 'Thu Nov 05 05:06:39 +0000 2015',
+                             'entities': {'hashtags': json.loads(line)['entities']['hashtags']},
+                             'timestamp_ms': '1446699999277'})
+        self.assertEqual(average_degree.get_tweet(line, extract=True)['ctime'], 1446699999)
+
+    def test_extract_tweet_undecided(self):
+        """Should leave ambiguous lines to the json decoder"""
+        lines = [self.json_limit,
+                 '{"created_at":"Thu Nov 05 05:06:39 +0000 2015", "entities":{"hashtags":[]},'
+                 ' "retweeted_status":{"entities":{"hashtags":[{"text":"A"}]}}}',
+                 '{"created_at":"Thu Nov 05 05:06:39 +0000 2015", "entities":{"hashtags":[]},'
+                 ' "extended_tweet":{"entities":{"hashtags":[{"text":"A"}]}}}',
+                 '{"created_at":"Thu Nov \\"05\\" 05:06:39 +0000 2015"}',
+                 '{"created_at":"Thu Nov 05 05:06:39 +0000 2015", "entities":{"hasht',
+                 '{"created_at":"Thu Nov 05 05:06:39 +0000 2015", "entities":{"hashtags":[]},'
+                 ' "timestamp_ms":"1446699999277"',
+                 '{"created_at":"Thu Nov 05 05:06:39 +0000 2015", "entities":{"hashtags":[]}}']
+        for line in lines:
+            self.assertIsNone(average_degree.extract_tweet(line))
+        self.assertEqual(average_degree.get_tweet(self.json_3, extract=True)['ctime'], 1446699999)
+
+    def test_extract_tweet_truncated(self):
+        """Should reject a truncated line that happens to end in a brace"""
+        line = ('{"created_at":"Thu Nov 05 05:06:39 +0000 2015","entities":{"hashtags":'
+                '[{"text":"A","indices":[0,2]},{"text":"B","indices":[3,5]}],"urls":[{"indices": [89, 112]}')
+        self.assertIsNone(average_degree.extract_tweet(line))
+        with patch('sys.stdout', new=StringIO()):
+            self.assertEqual(average_degree.get_tweet(line, extract=True),
+                             average_degree.get_tweet(line))
+
+    def test_extract_tweet_fields(self):
+        """Should pick other fields only where their key occurs once"""
+        line = ('{"created_at":"Thu Nov 05 05:06:39 +0000 2015","user":{"lang":"fr"},"lang":"en",'
+                '"place":{"country_code":"US","name":"\\"country_code\\""},"entities":{"hashtags":[]},'
+                '"timestamp_ms":"1446699999277"}')
+        j = average_degree.extract_tweet(line, ['place.country_code'])
+        self.assertEqual(j['place'], {'country_code': 'US'})
+        self.assertIsNone(average_degree.extract_tweet(line, ['lang']))
+        self.assertEqual(average_degree.extract_tweet(self.json_3, ['place.country_code']),
+                         average_degree.extract_tweet(self.json_3))
+        for extract in (False, True):
+            records = average_degree.parse_records([line, self.json_3], extract=extract,
+                                                   fields=('lang', 'place.country_code'))
+            self.assertEqual([record[2] for record in records], [('en', 'US'), (None, None)])
+
     def test_get_tweet_invalid_time(self):
         """Should correctly identify invalid time format"""
         with patch('sys.stdout', new=StringIO()) as fakeOutput:
@@ -46,6 +127,259 @@ class TestFunctions(unittest.TestCase):
             average_degree.main()
             self.assertEqual(fakeOutput.getvalue().strip(), '1.00')
 
+    def test_read_records(self):
+        """Should parse the valid tweets in order, with or without workers"""
+        lines = [self.json_3, self.json_limit, self.json_1, self.json_invalid_time] * 3
+        expected = [(1446699999, ['ABCD', 'EFGH']), (1446699939, [])] * 3
+        self.assertEqual(list(average_degree.read_records(lines)), expected)
+        with patch('average_degree.CHUNK_SIZE', 2):
+            self.assertEqual(list(average_degree.read_records(lines, workers=2)), expected)
+
+    def test_read_records_streamed(self):
+        """Should produce a record before the rest of the input is read"""
+        read = []
+
+        def stream():
+            for line in [self.json_3, self.json_1]:
+                read.append(line)
+                yield line
+
+        records = average_degree.read_records(stream())
+        self.assertEqual(next(records), (1446699999, ['ABCD', 'EFGH']))
+        self.assertEqual(read, [self.json_3])
+
+    def test_read_records_metrics(self):
+        """Should count and time the parse, with or without workers"""
+        lines = [self.json_3, self.json_limit, self.json_1, self.json_invalid_time] * 3
+        for workers in (1, 2):
+            metrics = average_degree.Metrics()
+            with patch('average_degree.CHUNK_SIZE', 2):
+                list(average_degree.read_records(lines, workers, metrics=metrics))
+            self.assertEqual((metrics.lines, metrics.invalid), (12, 6))
+            self.assertGreater(metrics.parse_ns, 0)
+            self.assertGreater(metrics.timestamp_ns, 0)
+
+    def test_gc_timing(self):
+        """Should only time the gc once a metrics sink is attached"""
+        graph = average_degree.TweetGraph(0, 60)
+        graph.update_hashtags(100, ['A', 'B', 'C'])
+        self.assertEqual((graph.gc_runs, graph.gc_ns), (1, 0))
+        average_degree.StatsReporter(graph, average_degree.Metrics(), 10)
+        graph.update_hashtags(200, ['A', 'B', 'C'])
+        self.assertEqual(graph.gc_runs, 2)
+        self.assertGreater(graph.gc_ns, 0)
+
+    def test_format_metrics(self):
+        """Should format the sampled metrics as a line and as prometheus text"""
+        graph = average_degree.TweetGraph(0, 60)
+        graph.update_hashtags(100, ['A', 'B', 'C'])
+        values = average_degree.Metrics().sample(graph)
+        self.assertEqual(graph.gc_max_ns, 0)
+        line = average_degree.format_stats(values)
+        self.assertTrue(line.startswith('stats lines=0 '))
+        self.assertIn(' edges_added=3 ', line)
+        text = average_degree.format_prometheus(values)
+        self.assertIn('# TYPE tweetgraph_edges_added_total counter\ntweetgraph_edges_added_total 3\n', text)
+        self.assertIn('tweetgraph_average 2.0\n', text)
+
+    def test_main_stats(self):
+        """Should report the metrics on stderr and in a prometheus file"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'metrics.prom')
+            with patch('sys.argv', ['', '60', '--stats', '--metrics', path]), \
+                 patch('sys.stdin', StringIO(self.json_3 + '\n' + self.json_limit)), \
+                 patch('sys.stdout', new=StringIO()) as fakeOutput, \
+                 patch('sys.stderr', new=StringIO()) as fakeError:
+                average_degree.main()
+                self.assertEqual(fakeOutput.getvalue().strip(), '1.00')
+                self.assertIn('lines=2 invalid=1 ', fakeError.getvalue())
+            with open(path) as metrics_file:
+                self.assertIn('tweetgraph_edges 1\n', metrics_file.read())
+
+    def write_inputs(self, tmp):
+        """Write the tweets to compressed files, named against their order"""
+        paths = []
+        for name, opener, line in [('c.gz', gzip.open, self.json_1), ('b.bz2', bz2.open, self.json_3),
+                                   ('a.xz', lzma.open, self.json_limit)]:
+            paths.append(os.path.join(tmp, name))
+            with opener(paths[-1], 'wt') as input_file:
+                input_file.write(line + '\n' + line)
+        return paths
+
+    def test_read_inputs(self):
+        """Should read compressed files in the order of their first tweet"""
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = self.write_inputs(tmp)
+            ordered = average_degree.expand_inputs([os.path.join(tmp, '*.gz'), os.path.join(tmp, '*')])
+            self.assertEqual(ordered, paths)
+            expected = [self.json_1] * 2 + [self.json_3] * 2 + [self.json_limit] * 2
+            self.assertEqual(list(average_degree.read_inputs(ordered)), expected)
+            self.assertEqual(list(average_degree.read_inputs(ordered, background=True)), expected)
+            with self.assertRaises(ValueError):
+                average_degree.expand_inputs([os.path.join(tmp, '*.txt')])
+
+    def test_read_blocks(self):
+        """Should carry a line over to the next block, and keep the last line"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'tweets.txt')
+            with open(path, 'w') as input_file:
+                input_file.write('\u00e9ab\ncd\nef')
+            self.assertEqual(list(average_degree.read_blocks(path, 2)), [[], [], ['\u00e9ab'], ['cd'], [], ['ef']])
+
+    def test_main_input(self):
+        """Should read the input files instead of stdin"""
+        with tempfile.TemporaryDirectory() as tmp:
+            self.write_inputs(tmp)
+            with patch('sys.argv', ['', '60', '--input', os.path.join(tmp, '*'), '--prefetch']), \
+                 patch('sys.stdout', new=StringIO()) as fakeOutput:
+                average_degree.main()
+                self.assertEqual(fakeOutput.getvalue(), '0.00\n0.00\n1.00\n1.00\n')
+
+    def test_write_averages(self):
+        """Should write the formatted averages a block at a time"""
+        out = StringIO()
+        with patch.object(out, 'write', wraps=out.write) as write:
+            average_degree.write_averages([0, 1, 2 / 3, 1.005, 2], out, block=2)
+            self.assertEqual(write.call_count, 3)
+        self.assertEqual(out.getvalue(), '0.00\n1.00\n0.67\n1.00\n2.00\n')
+
+    def test_sample_averages(self):
+        """Should yield the averages only at changes, seconds, or every N tweets"""
+        records = [(100, ['A', 'B']), (100, ['A', 'B']), (100, ['B', 'C']), (101, []), (103, ['C', 'D'])]
+        def sample(mode, every=1):
+            return list(average_degree.sample_averages(average_degree.TweetGraph(0, 60), records, mode, every))
+        self.assertEqual(sample('changes'), [(1, 1.0), (3, 4 / 3), (5, 1.5)])
+        self.assertEqual(sample('second'), [(100, 4 / 3), (101, 4 / 3), (103, 1.5)])
+        self.assertEqual(sample('every', 2), [(2, 1.0), (4, 4 / 3), (5, 1.5)])
+        with self.assertRaises(ValueError):
+            sample('never')
+
+    def test_main_changes(self):
+        """Should label the averages written when they change"""
+        lines = '\n'.join([self.json_3, self.json_3, self.json_1])
+        with patch('sys.argv', ['', '60', '--changes']), \
+             patch('sys.stdin', StringIO(lines)), \
+             patch('sys.stdout', new=StringIO()) as fakeOutput:
+            average_degree.main()
+            self.assertEqual(fakeOutput.getvalue(), '1 1.00\n')
+
+    def test_main_changes_windows(self):
+        """Should label the averages of several windows when any of them changes"""
+        late = '{"created_at":"Thu Nov 05 05:06:49 +0000 2015", "entities":{"hashtags":[{"text":"XY"}, {"text":"ZW"}, {"text":"Q"}]}}'
+        lines = '\n'.join([self.json_3, self.json_3, late])
+        with patch('sys.argv', ['', '5', '60', '--changes']), \
+             patch('sys.stdin', StringIO(lines)), \
+             patch('sys.stdout', new=StringIO()) as fakeOutput:
+            average_degree.main()
+            self.assertEqual(fakeOutput.getvalue(), '1 1.00 1.00\n3 2.00 1.60\n')
+
+    def test_main_snapshot_restore(self):
+        """Should continue from a snapshot saved by an earlier run"""
+        lines = [self.json_3, '{"created_at":"Thu Nov 05 05:06:40 +0000 2015", "entities":{"hashtags":[{"text":"ABCD"}, {"text":"XY"}]}}']
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'snapshot')
+            with patch('sys.argv', ['', '60', '--snapshot', path]), \
+                 patch('sys.stdin', StringIO(lines[0])), \
+                 patch('sys.stdout', new=StringIO()):
+                average_degree.main()
+            with patch('sys.argv', ['', '60', '--engine', 'wheel', '--restore', path]), \
+                 patch('sys.stdin', StringIO(lines[1])), \
+                 patch('sys.stdout', new=StringIO()) as fakeOutput:
+                average_degree.main()
+                self.assertEqual(fakeOutput.getvalue().strip(), '1.33')
+
+    def test_main_query(self):
+        """Should write the averages of each query as a run on its tweets alone would"""
+        line = '{"created_at":"Thu Nov 05 05:06:%02d +0000 2015", "lang":"%s", "entities":{"hashtags":[%s]}}\n'
+        lines = [line % (39, 'en', '{"text":"A"}, {"text":"B"}'),
+                 line % (40, 'fr', '{"text":"B"}, {"text":"C"}, {"text":"D"}'),
+                 line % (45, 'en', '{"text":"C"}, {"text":"D"}'),
+                 line % (20, 'fr', '{"text":"E"}, {"text":"F"}')]
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, name) for name in ('en', 'cd', 'all')]
+            with patch('sys.argv', ['', '--extract', '--query', paths[0], '60', 'lang=en',
+                                    '--query', paths[1], '3', 'hashtags=C,X', 'lang=en,fr',
+                                    '--query', paths[2], '10']), \
+                 patch('sys.stdin', StringIO(''.join(lines))):
+                average_degree.main()
+            outputs = []
+            for path in paths:
+                with open(path) as output:
+                    outputs.append(output.read())
+        self.assertEqual(outputs, ['1.00\n1.00\n', '2.00\n1.00\n', '1.00\n2.00\n2.00\n2.00\n'])
+
+    def test_query_matches(self):
+        """Should compare strings as they are and other values as json"""
+        fields = ['favorite_count', 'lang', 'place', 'retweeted']
+        conditions = {'retweeted': frozenset(['false']), 'lang': frozenset(['en']),
+                      'favorite_count': frozenset(['0', 'null'])}
+        query = average_degree.Query(average_degree.TweetGraph(0, 60), conditions, fields, None)
+        self.assertTrue(query.matches([], (0, 'en', None, False)))
+        self.assertTrue(query.matches([], (None, 'en', None, False)))
+        self.assertFalse(query.matches([], (0, 'en', None, True)))
+        self.assertFalse(query.matches([], (1, 'en', None, False)))
+        query = average_degree.Query(average_degree.TweetGraph(0, 60), {'place': frozenset(['US'])}, fields, None)
+        with self.assertRaises(ValueError):
+            query.matches([], (0, 'en', {'country_code': 'US'}, False))
+
+    def test_main_query_invalid(self):
+        """Should reject queries without a window, windows with queries, and objects as fields"""
+        for argv in (['', '--query', 'out'], ['', '--query', 'out', '60', 'lang'], ['', '60', '--query', 'out', '60']):
+            with patch('sys.argv', argv), patch('sys.stderr', new=StringIO()):
+                with self.assertRaises(SystemExit):
+                    average_degree.main()
+        # A field holding an object cannot be compared with a value.
+        with patch('sys.argv', ['', '--query', '-', '60', 'entities=US']), \
+             patch('sys.stdin', StringIO(self.json_3)), \
+             patch('sys.stdout', new=StringIO()), \
+             patch('sys.stderr', new=StringIO()) as fakeError:
+            with self.assertRaises(SystemExit):
+                average_degree.main()
+        self.assertIn('entities is not a string', fakeError.getvalue())
+
+    def test_main_conflicts(self):
+        """Should reject options that the chosen mode would ignore"""
+        for argv, message in ((['', '60', '--shards', '2', '--engine', 'wheel'], '--engine'),
+                              (['', '60', '--approximate', '--engine', 'wheel'], '--engine'),
+                              (['', '60', '3600', '--engine', 'wheel'], '--engine'),
+                              (['', '60', '--offline', 'cleaned.bin', '--timestamp-ms'], '--offline CLEANED'),
+                              (['', '60', '--offline', 'cleaned.bin', '--workers', '2'], '--offline CLEANED')):
+            with patch('sys.argv', argv), patch('sys.stderr', new=StringIO()) as fakeError:
+                with self.assertRaises(SystemExit):
+                    average_degree.main()
+            self.assertIn(message, fakeError.getvalue())
+
+    def test_main_window(self):
+        """Should reject a window that is not a positive number of seconds"""
+        for argv in (['', '0'], ['', '-5', '--engine', 'wheel'], ['', '60', '0'], ['', '--query', 'out.txt', '0']):
+            with patch('sys.argv', argv), patch('sys.stderr', new=StringIO()) as fakeError:
+                with self.assertRaises(SystemExit):
+                    average_degree.main()
+            self.assertIn('positive number of seconds', fakeError.getvalue())
+
+    def test_parse_size(self):
+        """Should parse sizes with binary suffixes"""
+        self.assertEqual([average_degree.parse_size(size) for size in ('100', '4k', '1.5M', '2G')],
+                         [100, 4096, 3 << 19, 2 << 30])
+        with self.assertRaises(ValueError):
+            average_degree.parse_size('-1K')
+
+    def test_main_max_memory(self):
+        """Should report the memory and the sheds of a graph over its budget"""
+        line = '{"created_at":"Thu Nov 05 05:06:%02d +0000 2015", "entities":{"hashtags":[{"text":"A%d"}, {"text":"B%d"}]}}\n'
+        lines = ''.join(line % (second, second, second) for second in range(10))
+        with patch('sys.argv', ['', '60', '--max-memory', '2K', '--stats']), \
+             patch('average_degree.MEMORY_CHECK_EDGES', 1), \
+             patch('sys.stdin', StringIO(lines)), \
+             patch('sys.stdout', new=StringIO()) as fakeOutput, \
+             patch('sys.stderr', new=StringIO()) as fakeError:
+            average_degree.main()
+        self.assertEqual(fakeOutput.getvalue(), '1.00\n' * 10)
+        stats = dict(pair.split('=') for pair in fakeError.getvalue().split()[1:])
+        self.assertLessEqual(int(stats['memory_bytes']), 2048)
+        self.assertGreater(int(stats['memory_sheds']), 0)
+        self.assertEqual(int(stats['edges_shed']), 10 - int(stats['edges']))
+
     def test_main_limit(self):
         """Should correctly discard limit"""
         with patch('sys.argv', ['', '60']), \
@@ -55,6 +389,68 @@ class TestFunctions(unittest.TestCase):
             self.assertEqual(fakeOutput.getvalue().strip(), '')
 
 
+def assert_memory_budget(test, engine):
+    """
+    Fill a graph of the engine over a budget of about 100 edges, and check
+    that it kept the newest edges, and consistent degrees.
+    """
+    graph = engine(0, 200)
+    budget = engine(0, 200)
+    for second in range(40):
+        budget.update_hashtags(1000 + second, ['A%d' % second, 'B%d' % second, 'C'])
+    graph.max_memory = budget.memory_bytes()
+    with patch('average_degree.MEMORY_CHECK_EDGES', 1):
+        for second in range(100):
+            graph.update_hashtags(1000 + second, ['A%d' % second, 'B%d' % second, 'C'])
+    test.assertLessEqual(graph.memory_bytes(), graph.max_memory)
+    test.assertGreater(graph.sheds, 0)
+    test.assertEqual(graph.shed, graph.added - len(graph.edges))
+    oldest = min(graph.edges.values())
+    test.assertEqual(sorted(set(graph.edges.values())), list(range(oldest, 1100)))
+    test.assertGreater(len(graph.edges), 3 * (1099 - oldest))
+    test.assertEqual(sum(graph.degrees().values()), 2 * len(graph.edges))
+    test.assertEqual(set(graph.degrees()), {tag for edge in graph.edge_times() for tag in edge})
+    return graph
+
+
+def assert_memory_estimate(test, engine, window):
+    """
+    Check the memory estimate of a graph of the engine against what
+    tracemalloc saw it allocate: within 20%, erring high.
+    """
+    rand = random.Random(3)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        graph = engine(0, window)
+        for index in range(8000):
+            # Hashtags of the typical length, with a long tail.
+            hashtags = {'hashtag%05d' % int(rand.paretovariate(0.8) * 3) for _ in range(rand.randrange(1, 6))}
+            graph.update_hashtags(1000 + index // 20 - rand.choice((0, 0, 3)), sorted(hashtags))
+        hashtags = None
+        gc.collect()
+        allocated = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    test.assertGreater(len(graph.edges), 1000)
+    test.assertGreaterEqual(graph.memory_bytes(), allocated)
+    test.assertLessEqual(graph.memory_bytes(), 1.2 * allocated)
+
+
+class TestEdgeHeap(unittest.TestCase):
+    def test_order(self):
+        """Should pop the entries in the order of their times"""
+        rand = random.Random(6)
+        entries = [(rand.randrange(100), key) for key in range(1, 500)]
+        heap = average_degree.EdgeHeap(entries[:100])
+        for ctime, key in entries[100:]:
+            heap.push(ctime, key)
+        popped = [heap.pop() for _ in range(len(heap))]
+        self.assertEqual([ctime for ctime, _ in popped], sorted(ctime for ctime, _ in entries))
+        self.assertEqual(sorted(popped), sorted(entries))
+
+
 class TestTweetGraph(unittest.TestCase):
     def setUp(self):
         self.cjson_1 = '{"ctime":100}'
@@ -64,14 +460,12 @@ class TestTweetGraph(unittest.TestCase):
         self.mytg = average_degree.TweetGraph(1000, 60)
 
         edges = {('A','B'): 999, ('A','C'): 1000, ('B','C'):1001}
-        self.mytg.edges = edges
         for k in edges.keys():
-            self.mytg.queue[k] = edges[k]
+            self.mytg.add_edge(edges[k], k)
 
     def set_current_edges(self, edges):
-        self.etg.edges = edges
         for k in edges.keys():
-            self.etg.queue[k] = edges[k]
+            self.etg.add_edge(edges[k], k)
 
     def test_in_window(self):
         """Should correctly determine if passed time is within window."""
@@ -86,22 +480,50 @@ class TestTweetGraph(unittest.TestCase):
         self.set_current_edges({('A','B'): 1001, ('A','C'): 1002})
 
         self.etg.add_edge(1003,('B','C'))
-        self.assertEqual(self.etg.edges, {('A','B'): 1001, ('A','C'): 1002, ('B','C'): 1003})
-        self.assertEqual(self.etg.queue.peekitem(), (('A','B'), 1001))
-        self.assertEqual(self.etg.queue[('B','C')], 1003)
-        self.assertEqual(self.etg.queue[('A','B')], 1001)
+        self.assertEqual(self.etg.edge_times(), {('A','B'): 1001, ('A','C'): 1002, ('B','C'): 1003})
+        self.assertEqual(self.etg.queue.pop(), (1001, self.etg.edge_key('A','B')))
+        self.assertEqual(self.etg.queue.pop(), (1002, self.etg.edge_key('A','C')))
+        self.assertEqual(self.etg.queue.pop(), (1003, self.etg.edge_key('B','C')))
 
     def test_add_edge_update(self):
         """Should update if an edge exists, and later time."""
         self.mytg.add_edge(1060,('B','C'))
-        self.assertEqual(self.mytg.edges, {('A','B'): 999, ('A','C'): 1000, ('B','C'): 1060})
+        self.assertEqual(self.mytg.edge_times(), {('A','B'): 999, ('A','C'): 1000, ('B','C'): 1060})
 
 
     def test_add_edge_no_expired(self):
         """Should not add an expired edge."""
         self.mytg.add_edge(1000,('B','C'))
-        self.assertEqual(self.mytg.edges, {('A','B'): 999, ('A','C'): 1000, ('B','C'): 1001})
+        self.assertEqual(self.mytg.edge_times(), {('A','B'): 999, ('A','C'): 1000, ('B','C'): 1001})
+
 
+    def test_add_edge_degree(self):
+        """Should count the degree of each hashtag once per edge."""
+        self.mytg.add_edge(1060,('B','C'))
+        self.mytg.add_edge(1061,('C','D'))
+        self.assertEqual(self.mytg.degrees(), {'A': 2, 'B': 2, 'C': 3, 'D': 1})
+        self.assertEqual(self.mytg.node_count, 4)
+
+    def test_intern_release(self):
+        """Should free the id of a hashtag without edges, and reuse it"""
+        self.mytg.latest = 1060
+        self.mytg.collect_garbage()
+        self.assertEqual(self.mytg.tag_ids, {'B': 1, 'C': 2})
+        self.assertEqual(self.mytg.free_ids, [0])
+        self.assertEqual(self.mytg.intern('D'), 0)
+        self.assertEqual(self.mytg.tags, ['D', 'B', 'C'])
+
+    def test_edge_key(self):
+        """Should pack an edge into the same key irrespective of order"""
+        key = self.mytg.edge_key('C', 'A')
+        self.assertEqual(key, self.mytg.edge_key('A', 'C'))
+        self.assertEqual(key, (0 << 32) | 2)
+        self.assertEqual(self.mytg.edge_tags(key), ('A', 'C'))
+
+    def test_update_hashtags_single(self):
+        """Should not intern the hashtag of a tweet without edges"""
+        self.etg.update_hashtags(1060, ['A'])
+        self.assertEqual(self.etg.tag_ids, {})
 
     def test_avg_vdegree_zero(self):
         """Should correctly return zero average vertex degree for empty"""
@@ -133,6 +555,7 @@ class TestTweetGraph(unittest.TestCase):
         # this should remove both 999 and 1000
         self.mytg.collect_garbage()
         self.assertEqual(len(self.mytg.edges.keys()), 1)
+        self.assertEqual(self.mytg.degrees(), {'B': 1, 'C': 1})
 
     def test_collect_garbage_all(self):
         """Should correctly garbage collect all expired"""
@@ -140,6 +563,8 @@ class TestTweetGraph(unittest.TestCase):
         # this should remove all
         self.mytg.collect_garbage()
         self.assertEqual(len(self.mytg.edges.keys()), 0)
+        self.assertEqual(self.mytg.node_count, 0)
+        self.assertEqual(self.mytg.avg_vdegree, 0)
 
     def test_gc_complete_empty(self):
         """Should correctly identify GC exit on empty graph"""
@@ -187,11 +612,285 @@ class TestTweetGraph(unittest.TestCase):
         self.assertEqual(ctime, 1060)
         self.assertEqual(len(htags), 2)
 
+    def test_process_batch(self):
+        """Should return the average after each record of a batch"""
+        records = [(1001, ['A', 'B']), (1002, ['C']), (1003, ['A', 'C', 'D']), (1062, [])]
+        self.assertEqual(self.etg.process_batch(records), [1, 1, 2, 2])
+        self.assertEqual(self.etg.process_batch([(1100, ['A'])]), [0])
+
+    def test_averages(self):
+        """Should lazily yield the average after each record"""
+        averages = self.etg.averages(iter([(1061, ['A', 'B']), (1062, ['B', 'C'])]))
+        self.assertEqual(next(averages), 1)
+        self.assertEqual(len(self.etg.edges), 1)
+        self.assertEqual(next(averages), 4 / 3)
+
+    def test_snapshot_restore(self):
+        """Should restore a snapshot into either engine"""
+        self.mytg.latest = 1030
+        self.mytg.update_hashtags(1040, ['A', 'D'])
+        self.mytg.collect_garbage()
+        state = self.mytg.snapshot()
+        for engine in (average_degree.TweetGraph, average_degree.WheelTweetGraph):
+            graph = engine.restore(state)
+            self.assertEqual(graph.edge_times(), self.mytg.edge_times())
+            self.assertEqual(graph.degrees(), self.mytg.degrees())
+            self.assertEqual(graph.latest, 1040)
+            graph.update_hashtags(1060, ['E', 'F'])
+            self.assertEqual(graph.edge_times(), {('A','D'): 1040, ('B','C'): 1001, ('E','F'): 1060})
+            self.assertEqual(graph.tag_ids, {'A': 0, 'B': 1, 'C': 2, 'D': 3, 'E': 4, 'F': 5})
+
+    def test_counters(self):
+        """Should count the added, refreshed and evicted edges"""
+        self.mytg.add_edge(1060, ('B','C'))
+        self.mytg.add_edge(1000, ('A','C'))
+        self.mytg.update_hashtags(1061, ['C', 'D'])
+        counters = self.mytg.counters()
+        self.assertEqual((counters['edges_added'], counters['edges_refreshed'], counters['edges_evicted']), (4, 1, 2))
+        self.assertEqual((counters['edges'], counters['nodes'], counters['gc_runs']), (2, 3, 1))
+
+    def test_top_hashtags(self):
+        """Should keep the degree index up to date once built"""
+        self.assertEqual(self.mytg.top_hashtags(2), [('A', 2), ('B', 2)])
+        self.mytg.add_edge(1030, ('C','D'))
+        self.assertEqual(self.mytg.top_hashtags(2), [('C', 3), ('A', 2)])
+        self.mytg.latest = 1060
+        self.mytg.collect_garbage()
+        self.assertEqual(self.mytg.top_hashtags(5), [('C', 2), ('B', 1), ('D', 1)])
+        self.assertEqual(self.mytg.top_hashtags(0), [])
+        self.assertEqual(self.mytg.degree_index.max_degree, 2)
+        self.assertEqual((self.mytg.hashtag_degree('C'), self.mytg.hashtag_degree('A')), (2, 0))
+
+    def test_top_hashtags_storm(self):
+        """Should move the highest degree by a step per update as one hashtag grows and shrinks"""
+        class ProbedDict(dict):
+            probes = 0
+
+            def __contains__(self, key):
+                ProbedDict.probes += 1
+                return super().__contains__(key)
+
+        tweetgraph = average_degree.TweetGraph(0, 60)
+        tweetgraph.top_hashtags(1)
+        tweetgraph.degree_index.buckets = ProbedDict(tweetgraph.degree_index.buckets)
+        for index in range(2000):
+            tweetgraph.update_hashtags(100, ['HUB', 'T%d' % index])
+        self.assertEqual(tweetgraph.top_hashtags(1), [('HUB', 2000)])
+        tweetgraph.update_hashtags(200, [])
+        self.assertEqual(tweetgraph.top_hashtags(1), [])
+        self.assertLess(ProbedDict.probes, 2 * 4000)
+
+    def test_queue_stale(self):
+        """Should rebuild the heap once the entries left by refreshes pile up"""
+        tweetgraph = average_degree.TweetGraph(0, 3600)
+        for second in range(3600):
+            tweetgraph.update_hashtags(second, ['A', 'B', 'C', 'D', 'E'])
+        self.assertEqual(len(tweetgraph.edges), 10)
+        self.assertLessEqual(len(tweetgraph.queue), average_degree.QUEUE_STALE_FACTOR * 10 + average_degree.QUEUE_SLACK + 1)
+        tweetgraph.update_hashtags(3600 + 3599, [])
+        self.assertEqual((len(tweetgraph.edges), tweetgraph.node_count), (0, 0))
+
+    def test_neighbors(self):
+        """Should keep the adjacency index up to date once built"""
+        self.assertEqual(self.mytg.neighbors('A'), {'B': 999, 'C': 1000})
+        self.mytg.add_edge(1030, ('A','B'))
+        self.mytg.add_edge(1031, ('C','D'))
+        self.assertEqual(self.mytg.neighbors('A'), {'B': 1030, 'C': 1000})
+        self.mytg.latest = 1060
+        self.mytg.collect_garbage()
+        self.assertEqual(self.mytg.neighbors('A'), {'B': 1030})
+        self.assertEqual(self.mytg.neighbors('C'), {'B': 1001, 'D': 1031})
+        self.assertEqual(self.mytg.neighbors('E'), {})
+
+    def test_main_lookup(self):
+        """Should write the lookups to stderr at the end"""
+        line = '{"created_at":"Thu Nov 05 05:06:39 +0000 2015", "entities":{"hashtags":[{"text":"A"}, {"text":"B"}]}}'
+        with patch('sys.argv', ['', '60', '--lookup', 'A', '--lookup', 'C']), \
+             patch('sys.stdin', StringIO(line)), \
+             patch('sys.stdout', new=StringIO()), \
+             patch('sys.stderr', new=StringIO()) as fakeError:
+            average_degree.main()
+            answers = [json.loads(answer) for answer in fakeError.getvalue().splitlines()]
+        self.assertEqual(answers, [{'tag': 'A', 'latest': 1446699999, 'degree': 1, 'neighbors': {'B': 1446699999}},
+                                   {'tag': 'C', 'latest': 1446699999, 'degree': 0, 'neighbors': {}}])
+
+    def test_memory_budget(self):
+        """Should shed the oldest edges to stay within the budget"""
+        assert_memory_budget(self, average_degree.TweetGraph)
+
+    def test_memory_estimate(self):
+        """Should estimate the memory of the graph closely"""
+        assert_memory_estimate(self, average_degree.TweetGraph, 300)
+
+    def test_restore_version(self):
+        """Should refuse a snapshot of another version"""
+        state = self.mytg.snapshot()
+        state['version'] = 0
+        with self.assertRaises(ValueError):
+            average_degree.TweetGraph.restore(state)
+
     def test_process_tweet(self):
         j = json.loads(self.cjson_2)
         vdegree = self.etg.process_tweet(j)
         self.assertEqual(vdegree, 1)
 
+class TestWheelTweetGraph(unittest.TestCase):
+    def setUp(self):
+        self.mytg = average_degree.WheelTweetGraph(1000, 60)
+        edges = {('A','B'): 999, ('A','C'): 1000, ('B','C'):1001}
+        for k in edges.keys():
+            self.mytg.add_edge(edges[k], k)
+
+    def test_add_edge_update(self):
+        """Should update if an edge exists, and later time."""
+        self.mytg.add_edge(1030,('B','C'))
+        self.assertEqual(self.mytg.edge_times(), {('A','B'): 999, ('A','C'): 1000, ('B','C'): 1030})
+        self.assertEqual(list(self.mytg.buckets[1030 % 60]), [self.mytg.edge_key('B','C')])
+
+    def test_add_edge_no_expired(self):
+        """Should not add an expired edge."""
+        self.mytg.add_edge(1000,('B','C'))
+        self.assertEqual(self.mytg.edge_times(), {('A','B'): 999, ('A','C'): 1000, ('B','C'): 1001})
+        self.assertEqual(list(self.mytg.buckets[1000 % 60]), [self.mytg.edge_key('A','C')])
+
+    def test_collect_garbage_noop(self):
+        """Should correctly exit gc when there is nothing to collect"""
+        self.mytg.latest = 1003
+        self.mytg.collect_garbage()
+        self.assertEqual(len(self.mytg.edges.keys()), 3)
+        self.assertEqual(self.mytg.gc_complete(), True)
+
+    def test_collect_garbage_1(self):
+        """Should correctly garbage collect"""
+        self.mytg.latest = 1060
+        self.assertEqual(self.mytg.gc_complete(), False)
+        self.mytg.collect_garbage()
+        self.assertEqual(self.mytg.edge_times(), {('B','C'): 1001})
+        self.assertEqual(self.mytg.degrees(), {'B': 1, 'C': 1})
+
+    def test_collect_garbage_refreshed(self):
+        """Should skip the stale entry of a refreshed edge"""
+        self.mytg.add_edge(1030,('A','B'))
+        self.mytg.latest = 1060
+        self.mytg.collect_garbage()
+        self.assertEqual(self.mytg.edge_times(), {('A','B'): 1030, ('B','C'): 1001})
+        self.assertEqual(self.mytg.avg_vdegree, 4 / 3)
+
+    def test_collect_garbage_all(self):
+        """Should correctly garbage collect all expired after a long gap"""
+        self.mytg.latest = 5000
+        self.mytg.collect_garbage()
+        self.assertEqual(len(self.mytg.edges.keys()), 0)
+        self.assertEqual(self.mytg.degrees(), {})
+        self.assertEqual(self.mytg.tags, [])
+        self.assertEqual(self.mytg.frontier, 4941)
+
+    def test_update_hashtags_with_gc(self):
+        """Should correctly start garbage collection on new tweet"""
+        self.mytg.latest = 1000
+        self.mytg.update_hashtags(1061, ('B','C'))
+        self.assertEqual(self.mytg.edge_times(), {('B','C'): 1061})
+
+    def test_counters(self):
+        """Should count the added, refreshed and evicted edges"""
+        self.mytg.update_hashtags(1030, ['B', 'C'])
+        self.mytg.update_hashtags(1061, ['C', 'D'])
+        counters = self.mytg.counters()
+        self.assertEqual((counters['edges_added'], counters['edges_refreshed'], counters['edges_evicted']), (4, 1, 2))
+
+    def test_neighbors_all(self):
+        """Should empty the adjacency index with the graph after a long gap"""
+        self.assertEqual(self.mytg.neighbors('B'), {'A': 999, 'C': 1001})
+        self.mytg.update_hashtags(5000, ['X', 'Y'])
+        self.assertEqual((self.mytg.neighbors('B'), self.mytg.neighbors('X')), ({}, {'Y': 5000}))
+
+    def test_top_hashtags_all(self):
+        """Should empty the degree index with the graph after a long gap"""
+        self.assertEqual(self.mytg.top_hashtags(1), [('A', 2)])
+        self.mytg.update_hashtags(5000, ['X', 'Y'])
+        self.assertEqual(self.mytg.top_hashtags(3), [('X', 1), ('Y', 1)])
+
+    def test_main_engine(self):
+        """Should select the wheel engine from the command line"""
+        line = '{"created_at":"Thu Nov 05 05:06:39 +0000 2015", "entities":{"hashtags":[{"text":"A"}, {"text":"B"}]}}'
+        with patch('sys.argv', ['', '60', '--engine', 'wheel']), \
+             patch('sys.stdin', StringIO(line)), \
+             patch('sys.stdout', new=StringIO()) as fakeOutput:
+            average_degree.main()
+            self.assertEqual(fakeOutput.getvalue().strip(), '1.00')
+
+
+    def test_memory_budget(self):
+        """Should shed whole seconds, and still evict the late tweets of a shed second"""
+        graph = assert_memory_budget(self, average_degree.WheelTweetGraph)
+        graph.max_memory = 0
+        graph.update_hashtags(1001, ['X', 'Y'])
+        self.assertEqual(graph.edge_times()[('X', 'Y')], 1001)
+        graph.update_hashtags(1601, [])
+        self.assertNotIn(('X', 'Y'), graph.edge_times())
+        self.assertNotIn('X', graph.degrees())
+
+    def test_memory_estimate(self):
+        """Should estimate the memory of the graph closely"""
+        assert_memory_estimate(self, average_degree.WheelTweetGraph, 300)
+
+
+class TestMultiWindowTweetGraph(unittest.TestCase):
+    def setUp(self):
+        self.mytg = average_degree.MultiWindowTweetGraph(1000, [60, 10])
+        self.mytg.update_hashtags(1000, ['A', 'B'])
+        self.mytg.update_hashtags(1005, ['B', 'C'])
+
+    def test_window_averages(self):
+        """Should compute the average of each window in the order given"""
+        self.assertEqual(self.mytg.window_averages, (4 / 3, 4 / 3))
+        self.mytg.update_hashtags(1012, ['D', 'E'])
+        self.assertEqual(self.mytg.window_averages, (1.2, 1))
+        self.assertEqual(self.mytg.views[0].degree, {self.mytg.tag_ids[tag]: 1 for tag in 'BCDE'})
+
+    def test_old_tweet(self):
+        """Should add an old tweet to the larger window only"""
+        self.mytg.update_hashtags(1020, ['A', 'B'])
+        self.mytg.update_hashtags(1009, ['C', 'D'])
+        self.assertEqual(self.mytg.window_averages, (1.5, 1))
+        self.assertEqual(self.mytg.views[0].edge_count, 1)
+
+    def test_refresh(self):
+        """Should count a refreshed edge once, and keep it until its new time expires"""
+        self.mytg.update_hashtags(1008, ['A', 'B'])
+        self.mytg.update_hashtags(1016, ['X', 'Y'])
+        self.assertEqual(self.mytg.window_averages, (1.2, 1))
+        self.assertEqual(self.mytg.views[0].edge_count, 2)
+
+    def test_memory_budget(self):
+        """Should keep the counts of the smaller windows when shedding"""
+        graph = average_degree.MultiWindowTweetGraph(0, [600, 30])
+        budget = average_degree.MultiWindowTweetGraph(0, [600, 30])
+        for second in range(40):
+            budget.update_hashtags(1000 + second, ['A%d' % second, 'B%d' % second, 'C'])
+        graph.max_memory = budget.memory_bytes()
+        with patch('average_degree.MEMORY_CHECK_EDGES', 1):
+            for second in range(100):
+                graph.update_hashtags(1000 + second, ['A%d' % second, 'B%d' % second, 'C'])
+                graph.update_hashtags(1000 + second - 20, ['A%d' % second, 'C'])
+        self.assertGreater(graph.sheds, 0)
+        view = graph.views[0]
+        live = [key for key, ctime in graph.edges.items() if ctime > graph.latest - view.window]
+        self.assertEqual(view.edge_count, len(live))
+        self.assertEqual(len(view.degree), len({tag_id for key in live for tag_id in (key >> 32, key & 0xffffffff)}))
+
+    def test_main_windows(self):
+        """Should write a column for each window"""
+        lines = '\n'.join([
+            '{"created_at":"Thu Nov 05 05:06:39 +0000 2015", "entities":{"hashtags":[{"text":"A"}, {"text":"B"}]}}',
+            '{"created_at":"Thu Nov 05 05:06:50 +0000 2015", "entities":{"hashtags":[{"text":"C"}, {"text":"D"}, {"text":"E"}]}}'])
+        with patch('sys.argv', ['', '60', '10']), \
+             patch('sys.stdin', StringIO(lines)), \
+             patch('sys.stdout', new=StringIO()) as fakeOutput:
+            average_degree.main()
+            self.assertEqual(fakeOutput.getvalue(), '1.00 1.00\n1.60 2.00\n')
+
+
 if __name__ == '__main__':
     unittest.main()
 
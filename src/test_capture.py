@@ -0,0 +1,109 @@
+import gzip
+import importlib.util
+import os
+import tempfile
+import time
+import unittest
+
+
+def load_capture():
+    """
+    Load data-gen/get-tweets.py, whose name is not a module name.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data-gen', 'get-tweets.py')
+    spec = importlib.util.spec_from_file_location('get_tweets', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+capture = load_capture()
+
+
+class TestCaptureWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.tmp.name, 'input.txt')
+        self.lines = ['{"id":%d, "text":"café %s"}\n' % (index, 'x' * (index % 50)) for index in range(500)]
+        with open(self.input, 'w', encoding='utf-8') as tweets:
+            tweets.writelines(self.lines)
+        self.output = os.path.join(self.tmp.name, 'tweets.txt')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, paths, opener=open):
+        content = ''
+        for path in paths:
+            with opener(path, 'rt', encoding='utf-8') as output:
+                content += output.read()
+        return content
+
+    def test_replay(self):
+        """Should capture a replayed stream as it was"""
+        writer = capture.CaptureWriter(self.output, flush_bytes=1000)
+        capture.replay_stream(self.input, capture.CaptureListener(writer))
+        writer.close()
+        self.assertEqual(writer.files, [self.output])
+        self.assertEqual(self.read(writer.files), ''.join(self.lines))
+
+    def test_flush_seconds(self):
+        """Should write out a small buffer after the flush interval"""
+        writer = capture.CaptureWriter(self.output, flush_seconds=0.01)
+        writer.write(self.lines[0])
+        deadline = time.monotonic() + 5
+        while not os.path.exists(self.output) or not os.path.getsize(self.output):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        writer.close()
+        self.assertEqual(self.read([self.output]), self.lines[0])
+
+    def test_rotate_bytes_gzip(self):
+        """Should rotate compressed files by size without splitting tweets"""
+        writer = capture.CaptureWriter(self.output, flush_bytes=1, rotate_bytes=4000, compress=True)
+        for line in self.lines:
+            writer.write(line)
+            # Flush every line, as a slow stream would.
+            writer.flush()
+        writer.close()
+        self.assertEqual(writer.files[:2], [os.path.join(self.tmp.name, 'tweets-0000.txt.gz'),
+                                            os.path.join(self.tmp.name, 'tweets-0001.txt.gz')])
+        self.assertEqual(self.read(writer.files, gzip.open), ''.join(self.lines))
+        for path in writer.files:
+            self.assertLessEqual(len(self.read([path], gzip.open).encode('utf-8')), 4000)
+        # A restart does not append to the files already rotated.
+        rotated = len(writer.files)
+        writer = capture.CaptureWriter(self.output, rotate_bytes=4000, compress=True)
+        writer.write(self.lines[0])
+        writer.close()
+        self.assertEqual(writer.files, [os.path.join(self.tmp.name, 'tweets-%04d.txt.gz' % rotated)])
+
+    def test_max_buffer(self):
+        """Should drop and count the tweets that do not fit in a full buffer"""
+        writer = capture.CaptureWriter(self.output, flush_seconds=60, max_buffer=1000)
+        with self.assertLogs('get-tweets', 'WARNING'):
+            for line in self.lines[:100]:
+                writer.write(line)
+        self.assertLessEqual(writer.buffered, 1000)
+        self.assertGreater(writer.dropped, 0)
+        with self.assertLogs('get-tweets', 'WARNING') as logs:
+            writer.close()
+        self.assertIn('dropped %d tweets' % writer.dropped, logs.output[-1])
+        self.assertEqual(len(self.read([self.output]).splitlines()) + writer.dropped, 100)
+
+    def test_rotate_hourly(self):
+        """Should start a new file when the hour changes"""
+        now = [1459207392.0]
+        writer = capture.CaptureWriter(self.output, rotate_hourly=True, clock=lambda: now[0])
+        writer.write(self.lines[0])
+        writer.flush()
+        now[0] += 3600
+        writer.write(self.lines[1])
+        writer.close()
+        self.assertEqual(writer.files, [os.path.join(self.tmp.name, 'tweets-2016032823.txt'),
+                                        os.path.join(self.tmp.name, 'tweets-2016032900.txt')])
+        self.assertEqual(self.read(writer.files), ''.join(self.lines[:2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import calendar
+import importlib.util
+import json
+import os
+import time
+import unittest
+
+
+def load_gen_tweet():
+    """
+    Load bin/gen-tweet.py, whose name is not a module name.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'gen-tweet.py')
+    spec = importlib.util.spec_from_file_location('gen_tweet', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+gen_tweet = load_gen_tweet()
+
+
+class TestTemplate(unittest.TestCase):
+    def test_tweet(self):
+        """Should write the template with the fields of the tweet, as json.dumps would"""
+        template = gen_tweet.Template()
+        hashtags = ['A', 'B"x', 'C%', 'café']
+        line = template.tweet(5, 3600, hashtags)
+        expected = json.loads(gen_tweet.JSONSTR)
+        expected['id'] += 5
+        expected['id_str'] = str(expected['id'])
+        expected['created_at'] = 'Tue Mar 29 00:23:12 +0000 2016'
+        expected['timestamp_ms'] = str(int(expected['timestamp_ms']) + 3600000)
+        expected['entities']['hashtags'] = [{'text': i, 'indices': [1, 2]} for i in hashtags]
+        self.assertEqual(line, json.dumps(expected))
+        tweet = json.loads(line)
+        self.assertEqual(calendar.timegm(time.strptime(tweet['created_at'], gen_tweet.TIME_FMT)),
+                         int(tweet['timestamp_ms']) // 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
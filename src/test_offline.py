@@ -0,0 +1,120 @@
+import average_degree
+import os
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from io import StringIO
+from unittest.mock import patch
+
+try:
+    import numpy
+    import offline
+except ImportError:
+    numpy = None
+
+
+def random_records(seed, count):
+    """
+    Records with stalls, late tweets, long gaps and few hashtags.
+    """
+    rand = random.Random(seed)
+    ctime = 1446699939
+    records = []
+    for index in range(count):
+        ctime += rand.choice((0, 0, 0, 1, 2, 7, 200 if index % 150 == 0 else 0))
+        tags = sorted({'T%d' % rand.randrange(15) for _ in range(rand.randrange(5))})
+        records.append((ctime - rand.choice((0, 0, 0, 5, 29, 31, 90)), tags))
+    return records
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestOffline(unittest.TestCase):
+    def test_coverage(self):
+        """Should count each group once where its intervals overlap or touch"""
+        groups = numpy.array([1, 1, 1, 2, 3])
+        starts = numpy.array([0, 2, 4, 1, 4])
+        ends = numpy.array([3, 4, 6, 2, 5])
+        self.assertEqual(offline.coverage(groups, starts, ends, 7).tolist(), [1, 2, 1, 1, 2, 1, 0])
+
+    def test_small(self):
+        """Should drop late tweets and evict edges as TweetGraph does"""
+        records = [(100, ['A', 'B', 'C']), (101, ['C', 'D']), (10, ['E', 'F']),
+                   (150, ['A']), (160, ['B', 'C']), (200, ['X', 'Y'])]
+        averages = offline.average_degrees(offline.load_records(records), 60)
+        self.assertEqual(averages.tolist(), average_degree.TweetGraph(0, 60).process_batch(records))
+
+    def test_random(self):
+        """Should match TweetGraph for every window"""
+        records = random_records(4, 800)
+        tweets = offline.load_records(records)
+        for window in (1, 2, 30, 60, 1000):
+            expected = average_degree.TweetGraph(0, window).process_batch(records)
+            self.assertEqual(offline.average_degrees(tweets, window).tolist(), expected)
+
+    def test_empty(self):
+        """Should give no averages for no tweets"""
+        self.assertEqual(offline.average_degrees(offline.load_records([]), 60).tolist(), [])
+
+    def test_load_cleaned(self):
+        """Should read the records of cleanit.py, stopping at a partial one"""
+        records = [(100, [-5, 1 << 40]), (101, [7]), (102, [-5, 3, 7])]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'tweets.bin')
+            with open(path, 'wb') as cleaned:
+                for ctime, nodes in records:
+                    cleaned.write(struct.pack('>QB%dq' % len(nodes), ctime, len(nodes), *nodes))
+                cleaned.write(struct.pack('>QB', 103, 2))
+            ctimes, offsets, tags = offline.load_cleaned(path)
+        self.assertEqual(ctimes.tolist(), [100, 101, 102])
+        self.assertEqual(offsets.tolist(), [0, 2, 3, 6])
+        self.assertEqual(tags.tolist(), [0, 3, 2, 0, 1, 2])
+
+    def test_cleaned(self):
+        """Should match TweetGraph on the records of cleanit.py"""
+        lines = ['{"created_at":"%s", "entities":{"hashtags":[%s]}}\n' % (
+            time.strftime(average_degree.TIME_FMT, time.gmtime(ctime)),
+            ', '.join('{"text":"%s"}' % tag for tag in tags)) for ctime, tags in random_records(5, 500)]
+        lines[10:10] = ['{"limit":{"track":262}}\n', '{"created_at":"Thu Nov 05"}\n', '{"created_at\n']
+        # More hashtags than a signed byte can count.
+        lines[20:20] = [lines[20].replace('[', '[%s, ' % ', '.join('{"text":"T%d"}' % tag for tag in range(150)), 1)]
+        cleanit = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'cleanit.py')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'tweets.bin')
+            with open(path, 'wb') as cleaned:
+                subprocess.run([sys.executable, cleanit], input=''.join(lines).encode('utf-8'),
+                               stdout=cleaned, check=True)
+            tweets = offline.load_cleaned(path)
+        records = average_degree.parse_records(lines)
+        for window in (1, 30, 60):
+            expected = average_degree.TweetGraph(0, window).process_batch(records)
+            self.assertEqual(offline.average_degrees(tweets, window).tolist(), expected)
+
+    def test_cleaned_stable(self):
+        """Should clean the same tweets to the same records in every process"""
+        line = '{"created_at":"Thu Nov 05 05:06:39 +0000 2015", "entities":{"hashtags":[%s]}}\n'
+        lines = ''.join(line % ', '.join('{"text":"T%d"}' % tag for tag in range(index % 7)) for index in range(50))
+        cleanit = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'cleanit.py')
+        outputs = [subprocess.run([sys.executable, cleanit], input=lines.encode('utf-8'), stdout=subprocess.PIPE,
+                                  env=dict(os.environ, PYTHONHASHSEED=seed), check=True).stdout
+                   for seed in ('1', '2')]
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_main_offline(self):
+        """Should compute the averages of several windows from the command line"""
+        line = '{"created_at":"Thu Nov 05 05:06:%02d +0000 2015", "entities":{"hashtags":[%s]}}\n'
+        lines = ''.join((line % (39, '{"text":"A"}, {"text":"B"}'),
+                         line % (45, '{"text":"B"}, {"text":"C"}, {"text":"D"}, {"text":"E"}')))
+        with patch('sys.argv', ['', '5', '60', '--offline']), \
+             patch('sys.stdin', StringIO(lines)), \
+             patch('sys.stdout', new=StringIO()) as fakeOutput:
+            average_degree.main()
+            self.assertEqual(fakeOutput.getvalue(), '1.00 1.00\n3.00 2.80\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import average_degree
+import os
+import random
+import replay
+import tempfile
+import time
+import unittest
+
+from io import StringIO
+from unittest.mock import patch
+
+
+TWEET = '{"created_at":"%s", "entities":{"hashtags":[%s]}}\n'
+
+
+def tweet(ctime, *tags):
+    created_at = time.strftime(average_degree.TIME_FMT, time.gmtime(ctime))
+    return TWEET % (created_at, ', '.join('{"text":"%s"}' % tag for tag in tags))
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'tweets.txt')
+        rand = random.Random(4)
+        ctime = 1446699939
+        with open(self.path, 'w') as tweets:
+            for index in range(600):
+                # Stalls, late tweets, long gaps and invalid lines.
+                ctime += rand.choice((0, 0, 0, 1, 2, 7, 200 if index % 150 == 0 else 0))
+                if index % 37 == 0:
+                    tweets.write('{"limit":{"track":1}}\n')
+                tags = ['T%d' % rand.randrange(15) for _ in range(rand.randrange(4))]
+                tweets.write(tweet(ctime - rand.choice((0, 0, 0, 5, 29, 31, 90)), *tags))
+        with open(self.path) as tweets:
+            records = average_degree.parse_records(tweets)
+        self.expected = ''.join('{:0.2f}\n'.format(average)
+                                for average in average_degree.TweetGraph(0, 30).process_batch(records))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_split_file(self):
+        """Should split at line ends, covering the whole file"""
+        ranges = replay.split_file(self.path, 7)
+        self.assertEqual((ranges[0][0], ranges[-1][1]), (0, os.path.getsize(self.path)))
+        with open(self.path, 'rb') as tweets:
+            for start, end in ranges[1:]:
+                tweets.seek(start - 1)
+                self.assertEqual(tweets.read(1), b'\n')
+
+    def test_scan_segment(self):
+        """Should keep only the records within the window of the latest"""
+        latest, tail = replay.scan_segment(self.path, 0, os.path.getsize(self.path), 30)
+        self.assertTrue(tail)
+        self.assertTrue(all(latest - ctime < 30 for ctime, _ in tail))
+
+    def test_replay(self):
+        """Should match a sequential run, whatever the segments"""
+        for segments, engine in [(1, 'heap'), (13, 'heap'), (50, 'wheel')]:
+            output = ''.join(replay.replay(self.path, 30, 2, engine, segments))
+            self.assertEqual(output, self.expected)
+
+    def test_main_replay(self):
+        """Should replay from the command line"""
+        with patch('sys.argv', ['', '30', '--replay', self.path, '--workers', '2']), \
+             patch('sys.stdout', new=StringIO()) as fakeOutput:
+            average_degree.main()
+            self.assertEqual(fakeOutput.getvalue(), self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
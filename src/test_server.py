@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import average_degree
+import server
+
+
+TWEET = '{"created_at":"Thu Nov 05 05:06:%02d +0000 2015", "entities":{"hashtags":[%s]}}\n'
+
+
+def tweet(second, *tags):
+    return TWEET % (second, ', '.join('{"text":"%s"}' % tag for tag in tags))
+
+
+class TestGraphServer(unittest.TestCase):
+    def setUp(self):
+        self.graph = average_degree.TweetGraph(0, 60)
+
+    def test_answer(self):
+        """Should answer avg and stats queries"""
+        srv = server.GraphServer(self.graph)
+        self.graph.update_hashtags(100, ['A', 'B', 'C'])
+        self.assertEqual(srv.answer('avg'), '2.00')
+        stats = json.loads(srv.answer('stats'))
+        self.assertEqual((stats['edges'], stats['nodes'], stats['latest']), (3, 3, 100))
+        self.assertTrue(srv.answer('nope').startswith('error'))
+
+    def test_answer_top(self):
+        """Should answer top and degree queries"""
+        srv = server.GraphServer(self.graph)
+        self.graph.update_hashtags(100, ['A', 'B', 'C'])
+        self.graph.update_hashtags(100, ['C', 'D'])
+        self.assertEqual(json.loads(srv.answer('top 2')), [['C', 3], ['A', 2]])
+        self.assertEqual(srv.answer('degree D'), '1')
+        self.assertEqual(srv.answer('degree E'), '0')
+        self.assertEqual(json.loads(srv.answer('neighbors C')), {'A': 100, 'B': 100, 'D': 100})
+        self.assertTrue(srv.answer('top x').startswith('error'))
+
+    def test_answer_metrics(self):
+        """Should answer the metrics in the prometheus text format"""
+        srv = server.GraphServer(self.graph)
+        self.graph.update_hashtags(100, ['A', 'B', 'C'])
+        metrics = srv.answer('metrics').split('\n')
+        self.assertIn('tweetgraph_edges_added_total 3', metrics)
+        self.assertEqual(metrics[-1], '# EOF')
+
+    def test_parse_address(self):
+        """Should tell unix socket paths from host:port"""
+        self.assertEqual(server.parse_address('localhost:9000'), ('localhost', 9000))
+        self.assertEqual(server.parse_address(':9000'), ('127.0.0.1', 9000))
+        self.assertEqual(server.parse_address('/tmp/ingest.sock'), (None, '/tmp/ingest.sock'))
+
+    def test_serve(self):
+        """Should apply tweets from several producers and answer queries"""
+        async def scenario(tmp):
+            srv = server.GraphServer(self.graph, queue_size=2)
+            ingest, query = os.path.join(tmp, 'ingest'), os.path.join(tmp, 'query')
+            task = asyncio.ensure_future(srv.serve(ingest, query))
+            while len(srv.servers) < 2:
+                await asyncio.sleep(0.01)
+            for lines in ([tweet(1, 'A', 'B'), '{"limit":{}}\n'], [tweet(2, 'B', 'C'), tweet(3, 'C', 'D')]):
+                _, writer = await asyncio.open_unix_connection(ingest)
+                writer.write(''.join(lines).encode('utf-8'))
+                await writer.drain()
+                writer.close()
+                await writer.wait_closed()
+            while srv.processed < 3:
+                await asyncio.sleep(0.01)
+            reader, writer = await asyncio.open_unix_connection(query)
+            writer.write(b'avg\nstats\n')
+            average = (await reader.readline()).decode().strip()
+            stats = json.loads((await reader.readline()).decode())
+            writer.close()
+            await writer.wait_closed()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return average, stats
+
+        with tempfile.TemporaryDirectory() as tmp:
+            average, stats = asyncio.run(scenario(tmp))
+        self.assertEqual(average, '1.50')
+        self.assertEqual((stats['processed'], stats['invalid'], stats['queued']), (3, 1, 0))
+
+    def test_serve_long_line(self):
+        """Should count a line over the limit as invalid and close its connection"""
+        async def scenario(tmp):
+            srv = server.GraphServer(self.graph)
+            ingest, query = os.path.join(tmp, 'ingest'), os.path.join(tmp, 'query')
+            task = asyncio.ensure_future(srv.serve(ingest, query))
+            while len(srv.servers) < 2:
+                await asyncio.sleep(0.01)
+            reader, writer = await asyncio.open_unix_connection(ingest)
+            writer.write(tweet(1, 'A', 'B').encode('utf-8') + b'x' * 200 + b'\n')
+            await writer.drain()
+            closed = await reader.read()
+            while srv.processed < 1:
+                await asyncio.sleep(0.01)
+            writer.close()
+            await writer.wait_closed()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return closed, srv.stats()
+
+        with tempfile.TemporaryDirectory() as tmp, patch('server.LINE_LIMIT', 128):
+            closed, stats = asyncio.run(scenario(tmp))
+        self.assertEqual(closed, b'')
+        self.assertEqual((stats['processed'], stats['invalid'], stats['producers']), (1, 1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import average_degree
+import sharded
+import unittest
+
+
+class TestShardTweetGraph(unittest.TestCase):
+    def setUp(self):
+        # With two shards, D and E are owned by shard 0, and A by shard 1.
+        self.shards = [sharded.ShardTweetGraph(1000, 60, shard, 2) for shard in range(2)]
+
+    def test_owner(self):
+        """Should assign hashtags to shards independently of the process"""
+        self.assertEqual([sharded.owner(tag, 2) for tag in 'ADE'], [1, 0, 0])
+
+    def test_counts(self):
+        """Should count each node and edge in exactly one shard"""
+        added_0, evicted_0 = self.shards[0].process((1000, [(0, 1000, 1000, [('A', 'D'), ('D', 'E')])]))
+        added_1, evicted_1 = self.shards[1].process((1000, [(0, 1000, 1000, [('A', 'D')])]))
+        self.assertEqual(list(added_0), [0, 1, 2])
+        self.assertEqual(list(added_1), [0, 1, 1])
+        self.assertEqual((list(evicted_0), list(evicted_1)), ([], []))
+        self.assertEqual(len(self.shards[1].edges), 1)
+
+    def test_eviction(self):
+        """Should report evictions at their expiry, even after a long gap"""
+        shard = self.shards[0]
+        added, evicted = shard.process((1030, [(0, 1000, 1000, [('A', 'D'), ('D', 'E')]),
+                                               (2, 1030, 1030, [('A', 'D')])]))
+        self.assertEqual(list(added), [0, 1, 2, 2, 0, 0])
+        self.assertEqual(list(evicted), [])
+        added, evicted = shard.process((5000, [(1, 1060, 1060, [('D', 'F')])]))
+        self.assertEqual(list(added), [1, 1, 1])
+        self.assertEqual(list(evicted), [1060, 1, 1, 1120, 1, 2])
+        self.assertEqual(shard.tag_ids, {})
+
+
+class TestShardedTweetGraph(unittest.TestCase):
+    def test_averages(self):
+        """Should produce the same averages as a single graph"""
+        records = [(1000, ['A', 'B', 'C']), (1001, ['B', 'D']), (900, ['X', 'Y']),
+                   (1040, ['C', 'E', 'F', 'G']), (1001, []), (1061, ['A', 'D']),
+                   (1100, ['E', 'H']), (3000, ['A'])]
+        expected = average_degree.TweetGraph(0, 60).process_batch(records)
+        with sharded.ShardedTweetGraph(0, 60, 3, batch=3) as graph:
+            self.assertEqual(graph.process_batch(records), expected)
+
+    def test_routing(self):
+        """Should send a shard only the records carrying its edges"""
+        with sharded.ShardedTweetGraph(0, 60, 2) as graph:
+            batches, latests = graph.route([(1000, ['A', 'D']), (1001, ['D', 'E']), (900, ['X', 'Y']), (1002, ['A'])])
+            self.assertEqual(latests, [1000, 1001, None, 1002])
+            self.assertEqual(batches[0], (1002, [(0, 1000, 1000, [('A', 'D')]), (1, 1001, 1001, [('D', 'E')])]))
+            self.assertEqual(batches[1], (1002, [(0, 1000, 1000, [('A', 'D')])]))
+
+
+if __name__ == '__main__':
+    unittest.main()